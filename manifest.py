@@ -0,0 +1,10 @@
+# Frozen modules of mpy_xoss_sync.py for ESP32 firmware; see, Makefile.
+#
+# Frozen modules are compiled on the build host (with the native/viper code for the target) and run from flash, so
+# nothing is compiled at boot and little heap is used for the bytecode.
+
+include("$(PORT_DIR)/boards/manifest.py")
+require("aioble")
+module("mpy_xoss_sync.py", opt=3)
+module("mpy_xoss_native.py", opt=3)
+module("xoss_fit.py", opt=3)
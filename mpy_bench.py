@@ -0,0 +1,108 @@
+# (c) 2024-2025 ekspla.
+# MIT License.  https://github.com/ekspla/xoss_sync
+#
+# Benchmark of the receive path of mpy_xoss_sync.py in MicroPython (ESP32 or the unix port); CPU time per block.
+#
+# Usage: >>> import mpy_bench
+#        >>> mpy_bench.run()
+#     SOH/STX blocks in packets of MTU 23/209, with the pure Python code and the viper code (mpy_xoss_native.py).
+#        >>> mpy_bench.transfer()
+#     A file fetched by mpy_xoss_sync.py from the simulated device of mpy_sim.py (no radio; e.g. the unix port) in
+#     SOH/STX; time and allocation per block (notify_handler, read_block and save_chunk_raw) and the total time.
+#     xoss_fit.py is required (Storage).
+
+import os
+import time
+import gc
+import asyncio
+import mpy_sim
+mpy_sim.install() # The simulation as aioble on ports without it; otherwise aioble is used (except in transfer()).
+import mpy_xoss_sync as client
+
+
+def make_block(num, stx, crc16_arc):
+    n = 1024 if stx else 128
+    data = bytearray((i * 7 + num) & 0xff for i in range(n))
+    crc = crc16_arc(data, 0)
+    return bytes([0x02 if stx else 0x01, num, 0xff ^ num]) + data + bytes([crc >> 8, crc & 0xff])
+
+
+def bench_block(funcs, stx, mtu, n=100):
+    '''Average time in us to receive a block; header check, copy of packets, CRC and (SOH) page buffering.
+    '''
+    block_append, check_header, check_block = funcs[:3]
+    block = make_block(1, stx, funcs[5])
+    size = len(block)
+    packets = [block[i:i + mtu - 3] for i in range(0, size, mtu - 3)]
+    buf = bytearray(1029)
+    block_data = memoryview(buf)[3:131]
+    write_buf = bytearray(512)
+    gc.collect()
+    t0 = time.ticks_us()
+    for _ in range(n):
+        if not check_header(packets[0], 0):
+            raise ValueError('header')
+        idx = 0
+        for packet in packets:
+            idx = block_append(buf, idx, size, packet)
+        if idx != size or not check_block(buf, size):
+            raise ValueError('block')
+        if not stx:
+            block_append(write_buf, 0, 512, block_data)
+    return time.ticks_diff(time.ticks_us(), t0) / n
+
+
+def run(n=100):
+    implementations = [('python', client.PY_RECEIVE_PATH)]
+    if client.NATIVE:
+        implementations.append(('viper', (client.block_append, client.check_header, client.check_block,
+            client.strip_zeros, client.crc8_xor, client.crc16_arc)))
+    else:
+        print('mpy_xoss_native.py is not installed (or not compiled for this port).')
+    for stx, mtu in ((False, 23), (False, 209), (True, 23), (True, 209)):
+        results = ', '.join(f'{name} {bench_block(funcs, stx, mtu, n):7.0f}' for name, funcs in implementations)
+        print(f"{'STX' if stx else 'SOH'}, MTU {mtu:3d}: {results} us/block")
+
+
+async def fetch(data, mtu, profile, directory, packets_per_event, name='20240715062336.fit'):
+    device = mpy_sim.Device({name: data}, packets_per_event=packets_per_event)
+    transfer = client.BluetoothFileTransfer(client.LinkPolicy(mtu=mtu), profile)
+    transfer.storage = client.Storage(directory)
+    try:
+        connection = await transfer.link_policy.connect(device)
+        async with connection:
+            if not await transfer.start_notify(connection):
+                return None
+            await transfer.set_link(connection)
+            gc.collect()
+            t0 = time.ticks_us()
+            fetched = await transfer.fetch_batch([name])
+            t_total = time.ticks_diff(time.ticks_us(), t0)
+    finally:
+        mpy_sim.DEVICES.remove(device)
+    return (fetched == 1, ) + device.block_stats() + (time.ticks_diff(device.t_eot, device.t_data), t_total)
+
+
+def transfer(size=65_536, profile=client.MEMORY_PROFILE, directory='/tmp/mpy_sim', packets_per_event=0):
+    '''Fetch a file of size bytes from the simulated device in SOH (MTU 23) and STX (MTU of the profile) with
+    the profile (see, MEMORY_PROFILES); packets_per_event paces the device by connection events (0: as fast as possible).
+    Time per block is between the ACKs (with the device's share), and allocation per block is of the heap in use.
+    '''
+    try:
+        os.mkdir(directory)
+    except OSError:
+        pass
+    data = mpy_sim.make_fit(size)
+    for mtu in sorted(set((23, client.MEMORY_PROFILES[profile]['mtu']))): # SOH only in 'minimal'.
+        result = asyncio.run(fetch(data, mtu, profile, directory, packets_per_event))
+        asyncio.new_event_loop() # Clear retained state.
+        if result is None:
+            continue
+        ok, blocks, us, us_max, alloc, t_data, t_total = result
+        print(f"{'STX' if mtu > 23 else 'SOH'}, MTU {mtu:3d}: {'OK' if ok else 'failed'}, {blocks} blocks, "
+            f"{us:.0f} us/block (max {us_max}), {alloc:.0f} bytes/block allocated; data {t_data / 1000:.0f} ms "
+            f"({size * 8_000 / t_data:.0f} kbps), total {t_total / 1000:.0f} ms.")
+
+
+if __name__ == '__main__':
+    run()
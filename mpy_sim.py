@@ -0,0 +1,347 @@
+# (c) 2024-2025 ekspla.
+# MIT License.  https://github.com/ekspla/xoss_sync
+#
+# Simulated aioble (the client side of a connection: scan, connect, characteristics and their notify queues) and a
+# simulated XOSS device behind it, for mpy_xoss_sync.py on the unix port of MicroPython without a radio.
+#
+# The device answers the commands (status, diskspace, fetch and delete) and sends YMODEM blocks in packets of MTU - 3
+# bytes into the notify queue of the TX characteristic, as aioble does on the notify IRQ; as fast as the client takes
+# them, or paced by connection events (packets_per_event).  On ACK of a data block, the time (ticks_us) and the heap
+# in use (gc.mem_alloc) are recorded without allocation; see, mpy_bench.transfer().
+#
+# Usage: >>> import mpy_sim
+#        >>> mpy_sim.install()                  # Before importing mpy_xoss_sync; as aioble (and bluetooth) if missing.
+#        >>> device = mpy_sim.Device({'20240715062336.fit': mpy_sim.make_fit(100_000)})
+
+import sys
+import time
+import gc
+import asyncio
+from collections import deque
+from array import array
+
+SIM_NAME = 'XOSS G-000000'
+SIM_ADDRESS = 'ec:37:9f:00:00:00'
+SIM_DISKSPACE = b'556/8104'
+SIM_MTU = 247 # The largest MTU of the device.
+
+_IRQ_CONNECTION_UPDATE = 27
+_ACK = 0x06
+_NAK = 0x15
+_CAN = 0x18
+_C = 0x43
+
+DEVICES = [] # Advertising; see, scan.
+
+
+def install():
+    # This module as aioble, and as bluetooth (UUID only) on ports without it (e.g. the unix port by default).
+    module = sys.modules[__name__]
+    try:
+        import bluetooth
+    except ImportError:
+        sys.modules['bluetooth'] = sys.modules['aioble'] = module
+        return
+    try:
+        import aioble
+    except ImportError:
+        sys.modules['aioble'] = module
+
+
+def make_fit(size, seed=1):
+    # A FIT file of size bytes (header, data and CRC) that passes FitValidator; the data are not records.
+    from mpy_xoss_sync import crc16_arc
+    n = size - 16
+    header = bytearray([14, 0x10, 0x34, 0x08]) + n.to_bytes(4, 'little') + b'.FIT'
+    header += crc16_arc(header, 0).to_bytes(2, 'little')
+    data = header + bytearray((i * 31 + seed) & 0xff for i in range(n))
+    return bytes(data + crc16_arc(data, 0).to_bytes(2, 'little'))
+
+
+class UUID:
+    def __init__(self, value):
+        self.value = str(value).lower()
+
+    def __eq__(self, other):
+        return str(self) == str(other).lower()
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __str__(self):
+        return self.value
+
+
+class _Core:
+    def __init__(self):
+        self.handlers = []
+
+    def register_irq_handler(self, irq, shutdown):
+        self.handlers.append(irq)
+
+    def irq(self, event, data):
+        for handler in self.handlers:
+            handler(event, data)
+
+core = _Core()
+
+
+class ScanResult:
+    def __init__(self, device):
+        self.device = device
+
+    def name(self):
+        return self.device.name
+
+
+class scan:
+    '''Advertisements of the simulated devices, as aioble.scan().
+    '''
+    def __init__(self, duration_ms, interval_us=None, window_us=None, active=False):
+        self.results = [ScanResult(x) for x in DEVICES]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await asyncio.sleep_ms(10)
+        if not self.results:
+            raise StopAsyncIteration
+        return self.results.pop(0)
+
+
+class Characteristic:
+    def __init__(self, device, uuid):
+        self.device = device
+        self.uuid = uuid
+        self._notify_queue = deque((), 16)                          # Replaced by the client, as in aioble.
+        self._notify_event = asyncio.ThreadSafeFlag()
+
+    async def write(self, data, response=False):
+        self.device.on_write(self, data)
+
+    async def subscribe(self, notify=True, indicate=False):
+        pass
+
+    async def notified(self, timeout_ms=None):
+        # As aioble; wait unless more than one is queued (the flag of the last one is cleared by waiting).
+        if len(self._notify_queue) <= 1:
+            if timeout_ms:
+                await asyncio.wait_for_ms(self._notify_event.wait(), timeout_ms)
+            else:
+                await self._notify_event.wait()
+        return self._notify_queue.popleft()
+
+    def on_notify(self, data):
+        self._notify_queue.append(data)
+        self._notify_event.set()
+
+
+class Service:
+    def __init__(self, device):
+        self.device = device
+
+    async def characteristic(self, uuid):
+        for x in (self.device.ctl, self.device.tx, self.device.rx):
+            if x.uuid == uuid:
+                return x
+        return None
+
+
+class Connection:
+    def __init__(self, device, conn_interval_us):
+        self.device = device
+        self.mtu = None
+        self.conn_interval_us = conn_interval_us
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.device.stop()
+
+    async def service(self, uuid):
+        return Service(self.device) if uuid == self.device.service_uuid else None
+
+    async def exchange_mtu(self, mtu=SIM_MTU):
+        self.mtu = min(mtu, SIM_MTU)
+        return self.mtu
+
+    async def disconnect(self):
+        self.device.stop()
+
+
+class Device:
+    '''A simulated XOSS device with files ({name: bytes}); filelist.txt is made from the FIT files if not given.
+    packets_per_event: packets sent per connection event (0: as fast as the client takes them).
+    '''
+    def __init__(self, files, name=SIM_NAME, address=SIM_ADDRESS, packets_per_event=0, min_conn_interval_us=7_500):
+        import bluetooth
+        self.files = files
+        if 'filelist.txt' not in files:
+            files['filelist.txt'] = ''.join(f'{x} {len(y)}\n' for x, y in sorted(files.items())
+                if x.endswith('.fit')).encode()
+        self.name = name
+        self.address = address
+        self.packets_per_event = packets_per_event
+        self.min_conn_interval_us = min_conn_interval_us
+        self.service_uuid = bluetooth.UUID('6e400001-b5a3-f393-e0a9-e50e24dcca9e')
+        self.ctl = Characteristic(self, bluetooth.UUID('6e400004-b5a3-f393-e0a9-e50e24dcca9e'))
+        self.tx = Characteristic(self, bluetooth.UUID('6e400003-b5a3-f393-e0a9-e50e24dcca9e'))
+        self.rx = Characteristic(self, bluetooth.UUID('6e400002-b5a3-f393-e0a9-e50e24dcca9e'))
+        self.connection = None
+        self.requests = deque((), 8) # (characteristic, value) of writes, served in order.
+        self.request_flag = asyncio.ThreadSafeFlag()
+        self.task = None
+        self.state = 'idle'
+        self.packets = [] # Packets of each block of the file in transfer; made before the transfer.
+        self.idx = 0
+        self.t_ack = array('I', [0]) # ticks_us of ACK per data block.
+        self.mem_ack = array('I', [0]) # gc.mem_alloc() on ACK per data block.
+        self.t_data = self.t_eot = 0 # ticks_us of the first data block and of EOT.
+        DEVICES.append(self)
+
+    def addr_hex(self):
+        return self.address
+
+    def __str__(self):
+        return f'Device({self.address})'
+
+    async def connect(self, timeout_ms=10_000, scan_duration_ms=None, min_conn_interval_us=None,
+            max_conn_interval_us=None):
+        interval = max(min_conn_interval_us or 50_000, self.min_conn_interval_us)
+        self.connection = Connection(self, interval)
+        self.task = asyncio.create_task(self.serve())
+        core.irq(_IRQ_CONNECTION_UPDATE, (0, interval // 1_250, 0, 400, 0))
+        return self.connection
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def on_write(self, characteristic, value):
+        # On the write of the client; served by serve() in order.  The value is not copied (no allocation).
+        if characteristic is self.rx and value[0] == _ACK and self.state == 'data' and self.idx < len(self.t_ack):
+            self.t_ack[self.idx] = time.ticks_us()
+            self.mem_ack[self.idx] = gc.mem_alloc()
+        self.requests.append((characteristic, value))
+        self.request_flag.set()
+
+    async def serve(self):
+        while True:
+            while not self.requests:
+                await self.request_flag.wait()
+            characteristic, value = self.requests.popleft()
+            if characteristic is self.ctl:
+                self.on_control(value)
+            else:
+                await self.on_download(value[0])
+
+    def command(self, cmd, payload):
+        value = bytearray([cmd]) + payload + bytearray([0])
+        crc = 0
+        for x in value:
+            crc ^= x
+        value[-1] = crc
+        return value
+
+    def on_control(self, value):
+        cmd, payload = value[0], bytes(value[1:-1])
+        if cmd in (0xff, 0x04):                                                # STATUS, IDLE
+            self.ctl.on_notify(b'\x04\x00\x04')
+        elif cmd == 0x09:                                                      # DISKSPACE
+            self.ctl.on_notify(self.command(0x0a, SIM_DISKSPACE))
+        elif cmd == 0x05:                                                      # FILE_FETCH
+            if (name := payload.decode()) not in self.files:
+                self.ctl.on_notify(self.command(0x12, payload))               # ERR_FILE_NA
+                return
+            self.make_packets(name)
+            self.state = 'block0'
+            self.ctl.on_notify(self.command(0x06, payload))
+        elif cmd == 0x0d:                                                      # FILE_DELETE
+            self.files.pop(payload.decode(), None)
+            self.ctl.on_notify(self.command(0x0e, payload))
+
+    def make_packets(self, name):
+        from mpy_xoss_sync import crc16_arc
+        data = self.files[name]
+        stx = (self.connection.mtu or 23) > 23
+        n = 1024 if stx else 128
+        mtu = (self.connection.mtu or 23) - 3
+
+        def block(num, payload, stx):
+            payload = bytes(payload) + bytes((1024 if stx else 128) - len(payload))
+            crc = crc16_arc(payload, 0)
+            b = bytes([2 if stx else 1, num, 0xff ^ num]) + payload + bytes([crc >> 8, crc & 0xff])
+            return [b[i:i + mtu] for i in range(0, len(b), mtu)]
+
+        self.packets = [block(0, f'{name} {len(data)}'.encode(), False)]
+        for i in range(0, len(data), n):
+            self.packets.append(block((i // n + 1) % 256, data[i:i + n], stx))
+        self.t_ack = array('I', bytes(4 * len(self.packets)))
+        self.mem_ack = array('I', bytes(4 * len(self.packets)))
+        gc.collect()
+
+    async def send_block(self, i):
+        n = self.packets_per_event
+        for j, packet in enumerate(self.packets[i]):
+            if n and j and j % n == 0:
+                await asyncio.sleep_ms(self.connection.conn_interval_us // 1000)
+            self.tx.on_notify(packet)
+            await asyncio.sleep_ms(0)
+
+    async def on_download(self, value):
+        if value == _C:
+            if self.state == 'block0':
+                await self.send_block(0)
+            elif self.state == 'block0_acked':
+                self.state, self.idx = 'data', 1
+                self.t_data = time.ticks_us()
+                await (self.send_block(1) if len(self.packets) > 1 else self.eot('eot1'))
+        elif value == _ACK:
+            if self.state == 'block0':
+                self.state = 'block0_acked'
+            elif self.state == 'data':
+                self.idx += 1
+                await (self.send_block(self.idx) if self.idx < len(self.packets) else self.eot('eot1'))
+            elif self.state == 'eot2':
+                self.state = 'idle'
+                self.packets = []
+                self.ctl.on_notify(b'\x04\x00\x04')
+        elif value == _NAK:
+            if self.state == 'block0':
+                await self.send_block(0)
+            elif self.state == 'data':
+                await self.send_block(self.idx)
+            elif self.state == 'eot1':
+                await self.eot('eot2')
+        elif value == _CAN:
+            self.state = 'idle'
+
+    async def eot(self, state):
+        if state == 'eot1':
+            self.t_eot = time.ticks_us()
+        self.state = state
+        self.tx.on_notify(b'\x04')
+
+    def block_stats(self):
+        '''Per data block from the ACKs of the last transfer; (blocks, us/block average and max, bytes allocated/block).
+        Blocks with a gc.collect() in between are not counted in the allocation.
+        '''
+        blocks = len(self.t_ack) - 1
+        us = us_max = alloc = n_alloc = 0
+        for i in range(2, blocks + 1):
+            dt = time.ticks_diff(self.t_ack[i], self.t_ack[i - 1])
+            us += dt
+            us_max = max(us_max, dt)
+            if (d := self.mem_ack[i] - self.mem_ack[i - 1]) >= 0:
+                alloc += d
+                n_alloc += 1
+        return blocks, us / max(1, blocks - 1), us_max, alloc / max(1, n_alloc)
@@ -0,0 +1,99 @@
+# (c) 2024-2025 ekspla.
+# MIT License.  https://github.com/ekspla/xoss_sync
+#
+# Viper code of the receive path in mpy_xoss_sync.py, run on every packet/block; copy of packets into the block buffer,
+# header check, CRC, padding scan and page buffering.  Optional; the same functions in pure Python in mpy_xoss_sync.py
+# are used without this file (or on ports without the native emitter).  See, mpy_bench.py.
+
+import micropython
+from array import array
+
+CRC16_ARC_TBL = array("H", (
+    0x0000, 0xCC01, 0xD801, 0x1400, 0xF001, 0x3C00, 0x2800, 0xE401,
+    0xA001, 0x6C00, 0x7800, 0xB401, 0x5000, 0x9C01, 0x8801, 0x4400,
+    ))
+
+
+@micropython.viper
+def block_append(buf, idx: int, limit: int, data) -> int:
+    '''Copy data (a packet) into buf at idx; returns the next idx, or -1 if it exceeds limit (the size of a block).
+    '''
+    n = int(len(data))
+    if idx + n > limit:
+        return -1
+    dst = ptr8(buf)
+    src = ptr8(data)
+    i = 0
+    while i < n:
+        dst[idx + i] = src[i]
+        i += 1
+    return idx + n
+
+
+@micropython.viper
+def check_header(data, block_num: int) -> bool:
+    '''Check header (SOH/STX, num, ~num) in the 1st packet of a block.
+    The previous num is also accepted as it is resent if our ACK was lost.
+    '''
+    if int(len(data)) < 3:
+        return False
+    p = ptr8(data)
+    if p[0] != 0x01 and p[0] != 0x02:
+        return False
+    if p[1] ^ p[2] != 0xff:
+        return False
+    return p[1] == ((block_num + 1) & 0xff) or (block_num >= 0 and p[1] == block_num)
+
+
+@micropython.viper
+def check_block(buf, size: int) -> bool:
+    '''CRC16/ARC of the data in a block (header, data and CRC in big endian) of size bytes.
+    '''
+    p = ptr8(buf)
+    table = ptr16(CRC16_ARC_TBL)
+    crc = 0
+    i = 3
+    end = size - 2
+    while i < end:
+        crc = (crc >> 4) ^ table[(crc ^ p[i]) & 0x0F]
+        crc = (crc >> 4) ^ table[(crc ^ (p[i] >> 4)) & 0x0F]
+        i += 1
+    return crc == (p[end] << 8 | p[end + 1])
+
+
+@micropython.viper
+def strip_zeros(data) -> int:
+    '''Length of data without the zero padding at the end.
+    '''
+    p = ptr8(data)
+    n = int(len(data))
+    while n > 0 and p[n - 1] == 0:
+        n -= 1
+    return n
+
+
+@micropython.viper
+def crc8_xor(data) -> int:
+    p = ptr8(data)
+    n = int(len(data))
+    crc = 0
+    i = 0
+    while i < n:
+        crc ^= p[i]
+        i += 1
+    return crc & 0xff
+
+
+@micropython.viper
+def crc16_arc(data, crc: int) -> int:
+    '''crc16/arc; pass the previous crc (or 0) to continue.
+    '''
+    p = ptr8(data)
+    n = int(len(data))
+    table = ptr16(CRC16_ARC_TBL)
+    i = 0
+    while i < n:
+        crc = (crc >> 4) ^ table[(crc ^ p[i]) & 0x0F]
+        crc = (crc >> 4) ^ table[(crc ^ (p[i] >> 4)) & 0x0F]
+        i += 1
+    return crc
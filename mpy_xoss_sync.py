@@ -15,6 +15,17 @@
 # 6. timings/delays were adjusted for my use case (XOSS G+, Micropython-1.23.0 on ESP32-WROOM-32E with SD card, and aioble).
 # 7. support for STX (1024-byte) block in YMODEM, though it's not well tested.
 # 8. support for parsing track list file in JSON format.
+# 9. early detection of broken blocks (header check on the 1st packet, stall timeout scaled to the connection interval).
+# 10. check FIT header, size and CRC while downloading, if xoss_fit.py is installed.
+# 11. convert FIT files to GPX/CSV tracks while downloading, optionally (see, TRACK_FORMATS).
+# 12. summaries of rides in a compact file, updated after each fetch, optionally (see, RIDE_LOG).
+# 13. files are written as .part and renamed on success; date-sharded layout, optionally (see, STORAGE_LAYOUT).
+# 14. delete old rides on the device after they are verified locally, optionally (see, RETENTION_DAYS).
+# 15. frozen into the firmware or precompiled to .mpy for a fast start (see, manifest.py and Makefile).
+# 16. viper code of the receive path (copy of packets, header check, CRC, ...), optionally (see, mpy_xoss_native.py).
+# 17. discovery of known addresses by a passive scan, optionally (see, _TARGET_ADDRESSES).
+# 18. fetch files in a batch with one notify task; the next request is sent as soon as the device is IDLE (see, fetch_batch).
+# 19. memory profiles of buffers, queue and list parsing, with heap usage per phase (see, MEMORY_PROFILE and HeapReport).
 #
 # TODO:
 # 1. some brush-up, esp. in handling notify packets from aioble.
@@ -29,13 +40,20 @@ import aioble
 import bluetooth
 import re
 import os
+import time
 import gc
 from collections import deque
 from array import array
+try:
+    from xoss_fit import FitValidator, TrackWriter, FitDecoder, RideSummary, RideLog, hexlify, Storage, \
+        check_fit_file                                                                    # Optional; copy xoss_fit.py
+except ImportError:                                                                       # to check/convert FIT files.
+    FitValidator = TrackWriter = RideLog = Storage = check_fit_file = None
 
 
 #_TARGET_NAME = "XOSS G-040989"
 _TARGET_NAME = "XOSS"
+_TARGET_ADDRESSES = () # e.g. ('ec:37:9f:xx:yy:zz', ); connect as soon as one of the known devices advertises.
 _SERVICE_UUID = bluetooth.UUID("6e400001-b5a3-f393-e0a9-e50e24dcca9e")
 _CTL_CHARACTERISTIC_UUID = bluetooth.UUID("6e400004-b5a3-f393-e0a9-e50e24dcca9e")
 _TX_CHARACTERISTIC_UUID = bluetooth.UUID("6e400003-b5a3-f393-e0a9-e50e24dcca9e")
@@ -48,8 +66,8 @@ OK_FILE_FETCH = bytearray([0x06]) # r
 #OK_FILE_SEND = bytearray([0x08]) # r
 VALUE_DISKSPACE = bytearray([0x09, 0x00, 0x09]) # w
 OK_DISKSPACE = bytearray([0x0a]) # r
-#FILE_DELETE = bytearray([0x0d]) # w
-#OK_FILE_DELETE = bytearray([0x0e]) # r
+FILE_DELETE = bytearray([0x0d]) # w
+OK_FILE_DELETE = bytearray([0x0e]) # r
 #VALUE_STOP = bytearray([0x1f, 0x00, 0x1f]) # w
 #VALUE_ERR_CMD = bytearray([0x11, 0x00, 0x11]) # r
 #ERR_FILE_NA = bytearray([0x12]) # r
@@ -69,38 +87,150 @@ VALUE_CAN = bytearray([0x18])                             # CAN
 
 AWAIT_NEW_DATA = bytearray(b'AwaitNewData')
 
-class BluetoothFileTransfer:
+PACKET_TIMEOUT_CONN_EVENTS = 8 # A block stalls if no packet arrives within these connection events.
+DRAIN_CONN_EVENTS = 3 # Garbage of a broken block is gone if the link is quiet for these connection events.
+MAX_BLOCK_RETRIES = 10 # Cancel the transfer after these successive errors in a block.
+REFETCH_RETRIES = 1 # Re-fetch a broken file in the same session.
+RESPONSE_DELAY_MS = 100 # Delay after a request answered by the device; 0 in a batch (see, fetch_batch).
+TRACK_FORMATS = () # e.g. ('gpx', 'csv'); convert FIT files to tracks while downloading (xoss_fit.py is required).
+RIDE_LOG = None # e.g. '/sd/rides.bin'; summaries of rides, updated after each fetch (xoss_fit.py is required).
+STORAGE_LAYOUT = '' # e.g. '{year}/{month}'; sub-directories of FIT files in /sd ('' = flat; xoss_fit.py is required).
+RETENTION_DAYS = None # e.g. 90; delete rides older than this on the device at the end of the session (xoss_fit.py is required).
+RETENTION_KEEP = 10 # The newest rides are kept on the device anyway.
+DELETE_DRY_RUN = True # Only show the rides to be deleted.
+
+MIN_CONN_INTERVAL_US = 7_500 # The minimum connection interval in BLE.
+MTU_SIZE = 209 # An STX block of 1029 bytes fits well in 206 * 5 (see, README).
+
+MEMORY_PROFILE = 'balanced' # 'minimal' (e.g. next to a web UI on ESP32-WROOM), 'balanced' or 'max' (throughput).
+MEMORY_PROFILES = {
+    # mtu: STX blocks (1029-byte block buffer instead of 133) only if > 23; pages: SOH blocks (128 bytes) per write to
+    # SD; queue: notify queue in packets (a block is 7 packets at MTU 23); gc_blocks: gc.collect() every these blocks;
+    # stream: parse the track list chunk by chunk instead of readlines()/json.load().
+    'minimal': {'mtu': 23, 'pages': 1, 'queue': 7, 'gc_blocks': 32, 'stream': True},
+    'balanced': {'mtu': MTU_SIZE, 'pages': 4, 'queue': 7, 'gc_blocks': 128, 'stream': True},
+    'max': {'mtu': MTU_SIZE, 'pages': 8, 'queue': 10, 'gc_blocks': 256, 'stream': False},
+}
+
+
+class HeapReport:
+    '''Heap usage (gc.mem_alloc) per phase; the peak is sampled (see, sample) and the steady state is after
+    gc.collect() at the end of the phase.
+    '''
     def __init__(self):
+        self.phases = [] # [(name, peak, steady), ...]
+        self.name = None
+        self.peak = 0
+
+    def start(self, name):
+        self.finish()
+        self.name = name
+        self.peak = gc.mem_alloc()
+
+    def sample(self):
+        if (n := gc.mem_alloc()) > self.peak:
+            self.peak = n
+
+    def finish(self):
+        if self.name is None:
+            return
+        self.sample()
+        gc.collect()
+        self.phases.append((self.name, self.peak, gc.mem_alloc()))
+        self.name = None
+
+    def report(self):
+        self.finish()
+        for name, peak, steady in self.phases:
+            print(f'Heap: {name}: peak {peak}, steady {steady} bytes.')
+        print(f'Heap: free {gc.mem_free()} bytes.')
+
+_IRQ_CONNECTION_UPDATE = 27
+
+class LinkPolicy:
+    '''Request the tightest connection parameters via aioble and read back what was granted.
+    Connection parameters require aioble after commit 68e3e07 (see, README).
+    '''
+    def __init__(self, conn_interval_us=MIN_CONN_INTERVAL_US, mtu=MTU_SIZE):
+        self.conn_interval_us = conn_interval_us
+        self.mtu = mtu
+        self.conn_interval_granted = None
+        aioble.core.register_irq_handler(self._irq, None)
+
+    def _irq(self, event, data):
+        if event == _IRQ_CONNECTION_UPDATE:                                        # Only if updated after connecting.
+            _, conn_interval, _, _, status = data
+            if status == 0:
+                self.conn_interval_granted = conn_interval * 1_250                # In units of 1.25 ms.
+
+    async def connect(self, device):
+        self.conn_interval_granted = None
+        return await device.connect(
+            timeout_ms=60_000,
+            scan_duration_ms=5_000, min_conn_interval_us=self.conn_interval_us, max_conn_interval_us=self.conn_interval_us)
+
+    async def apply(self, connection):
+        # Returns the granted values (None if unknown).
+        await connection.exchange_mtu(mtu=self.mtu)
+        mtu = connection.mtu or 23
+        return {
+            'conn_interval_us': self.conn_interval_granted,
+            'mtu': mtu,
+            'data_length': None,
+            'stx': mtu > 23, # STX (1024-byte) blocks only with an increased MTU.
+        }
+
+
+class BluetoothFileTransfer:
+    def __init__(self, link_policy=None, profile=MEMORY_PROFILE):
         #self.lock = asyncio.Lock()
         self.ctl_characteristic = None
         self.tx_characteristic = None
         self.rx_characteristic = None
         # **Packet**
         self.mtu_size = 23
-        self.notification_data = bytearray()
+        self.conn_interval_us = 50_000 # Connection interval; 50 ms (aioble default) unless requested.
+        self.profile = MEMORY_PROFILES[profile]
+        self.heap = HeapReport()
+        self.link_policy = link_policy or LinkPolicy(mtu=self.profile['mtu'])
+        self.link = {} # Granted connection parameters.
+        self.notification_data = bytearray() # Updated in place; AWAIT_NEW_DATA is copied, not bound.
+        self.notify_task = None # notify_handler(), which takes the notifications of tx_characteristic.
+        self.response_delay_ms = RESPONSE_DELAY_MS
+        self.overhead_ms = 0 # Time of the last fetch out of the data blocks; request, block 0 and EOT.
+        self.t_packet = 0 # Arrival time (ticks_ms) of the last packet.
+        self.is_garbage = False # True while dropping the rest of a broken block.
         # **Block**
         self.is_block = False
         self.use_stx = False # True/False = STX/SOH
-        self.block_buf = bytearray(3 + 1024 + 2)                                 # Header(SOH/STX, num, ~num); data(128 or 1024 bytes); CRC16
+        stx = self.profile['mtu'] > 23
+        self.block_buf = bytearray(3 + (1024 if stx else 128) + 2)              # Header(SOH/STX, num, ~num); data(128 or 1024 bytes); CRC16
         self.block_num = 0 # Block number(0-255).
+        self.block_count = 0 # Number of data blocks received; block_num wraps around at 256.
         self.idx_block_buf = 0 # Index in block_buf.
         self.mv_block_buf = memoryview(self.block_buf)
         self.block_size = None
         self.block_data = None
         self.block_crc = None
+        soh = (3 + 128 + 2, self.mv_block_buf[3:131], self.mv_block_buf[131:133], )
         self.block_size_data_crc = (
-            (3 + 128 + 2, self.mv_block_buf[3:131], self.mv_block_buf[131:133], ), # SOH
-            (3 + 1024 + 2, self.mv_block_buf[3:-2], self.mv_block_buf[-2:], ),     # STX
+            soh,                                                                 # SOH
+            (3 + 1024 + 2, self.mv_block_buf[3:-2], self.mv_block_buf[-2:], ) if stx else soh, # STX; an error if no buffer.
         )
         self.block_error = False
         # **File**                                                               A file is made of blocks; a block is made of packets.
         self.data_size = 0
         self.data_written = 0
         self.filename = ''
+        self.file_path = '' # Path of the file in transfer; written to file_path + '.part'.
+        self.storage = Storage('/sd', STORAGE_LAYOUT) if Storage else None
         self.is_write_mode = False
-        self.write_buf = bytearray(128 * 4)                                      # This write buffer is exclusively used in SOH blocks.
+        self.fit_validator = None
+        self.track_writers = ()
+        self.ride_summary = None # (FitDecoder, RideSummary, hash) of the file in transfer.
+        self.write_pages = self.profile['pages']
+        self.write_buf = bytearray(128 * self.write_pages)                       # This write buffer is exclusively used in SOH blocks.
         self.mv_write_buf = memoryview(self.write_buf)
-        self.write_buf_page = tuple(self.mv_write_buf[i * 128:(i+1) * 128] for i in range(4))
         self.idx_write_buf = 0
 
     async def notify_handler(self):
@@ -109,9 +239,10 @@ class BluetoothFileTransfer:
         queue = self.tx_characteristic._notify_queue
 
         def append_to_block_buf(data):
-            if (len_data := len(data)):
-                self.block_buf[self.idx_block_buf:self.idx_block_buf + len_data] = data
-                self.idx_block_buf += len_data
+            if (idx := block_append(self.block_buf, self.idx_block_buf, self.block_size, data)) < 0:
+                self.is_garbage = True
+            else:
+                self.idx_block_buf = idx
 
         async def fill_queue(n, timeout_ms):
             async def q():
@@ -128,36 +259,68 @@ class BluetoothFileTransfer:
             if data == _EOT:                                                        # Receive EOT.
                 self.is_block = False
                 self.notification_data[:] = data
+            elif self.is_block and self.is_garbage:                                 # Drop the rest of a broken block.
+                self.t_packet = time.ticks_ms()
             elif self.is_block:                                                     # Packets should be combined to make a block.
-                self.use_stx = True if data[0] == _STX else False
-                self.block_size, self.block_data, self.block_crc = self.block_size_data_crc[int(self.use_stx)]
-                if (n := self.block_size - len(data)) > 0:
-                    await fill_queue(n, timeout_ms=150)
+                if self.idx_block_buf == 0:                                         # The 1st packet of a block.
+                    if not check_header(data, self.block_num):
+                        self.is_garbage = True
+                        self.t_packet = time.ticks_ms()
+                        continue
+                    self.use_stx = True if data[0] == _STX else False
+                    self.block_size, self.block_data, self.block_crc = self.block_size_data_crc[int(self.use_stx)]
+                if (n := self.block_size - self.idx_block_buf - len(data)) > 0:
+                    await fill_queue(n, timeout_ms=self.packet_timeout_ms())
                 append_to_block_buf(data)
                 while len(queue) >= 1:
                     append_to_block_buf(queue.popleft())
                 self.tx_characteristic._notify_event.clear()                        # Make sure to clear the flag.
+                self.t_packet = time.ticks_ms()
             else:
                 self.notification_data[:] = data                                    # Other messages/responses.
             await asyncio.sleep(0)
 
+    async def start_notify_handler(self):
+        if self.notify_task is None:
+            self.notify_task = asyncio.create_task(self.notify_handler())
+            await asyncio.sleep(1)
+
+    def stop_notify_handler(self):
+        if self.notify_task is not None:
+            self.notify_task.cancel()
+            self.notify_task = None
+
     async def clear_notify_queue(self):
+        # Wait until the rest of a broken block has gone, i.e. no packets for a few connection events.
         queue = self.tx_characteristic._notify_queue
-        await asyncio.sleep_ms(200)
+        self.is_garbage = True
+        quiet_ms = max(30, DRAIN_CONN_EVENTS * self.conn_interval_us // 1000)
+        t_start = time.ticks_ms()
+        while (time.ticks_diff(t := time.ticks_ms(), self.t_packet) < quiet_ms and
+            time.ticks_diff(t, t_start) < 1_000):
+            await asyncio.sleep_ms(2)
         while len(queue) >= 1:
             _ = queue.popleft()
         self.tx_characteristic._notify_event.clear()                                # Make sure to clear the flag.
-
-    async def discover_device(self, target_name):
-        # Scan for 20 seconds, in active mode, with very low interval/window (to maximise detection rate).
-        async with aioble.scan(duration_ms=20_000, interval_us=30000, window_us=30000, active=True) as scanner:
+        self.idx_block_buf = 0
+        self.is_garbage = False
+
+    async def discover_device(self, target_name, addresses=_TARGET_ADDRESSES):
+        # Scan for 20 seconds at most, with very low interval/window (to maximise detection rate); returns on the first
+        # advertisement of the addresses (passive scan, no need to wait for scan responses) or of target_name (active).
+        print(f"Scanning at {time.ticks_ms()} ms after boot...")                  # Startup time (see, README).
+        addresses = tuple(x.lower() for x in addresses)
+        async with aioble.scan(duration_ms=20_000, interval_us=30000, window_us=30000, active=not addresses) as scanner:
             async for result in scanner:
-                # See if it matches target_name.
-                if (name := result.name()) is not None and target_name in name:
+                if addresses:
+                    if result.device.addr_hex() in addresses:
+                        print(f"Found target device: {result.device}")
+                        return result.device
+                elif (name := result.name()) is not None and target_name in name: # See if it matches target_name.
                     print(f"Found target device: {name} - {result.device}")
                     return result.device
 
-        print(f"Device with name {target_name} not found.")
+        print(f"Device {', '.join(addresses) or f'with name {target_name}'} not found.")
         return None
 
     async def send_cmd(self, char, value, delay_ms):
@@ -168,7 +331,7 @@ class BluetoothFileTransfer:
         await asyncio.sleep_ms(delay_ms)
 
     async def get_idle_status(self):
-        self.notification_data = AWAIT_NEW_DATA
+        self.notification_data[:] = AWAIT_NEW_DATA
         self.is_block = False
         await self.send_cmd(self.ctl_characteristic, VALUE_STATUS, 5_000)         # Send STATUS (0xff, 0x00, 0xff)
         await self.wait_until_data(self.ctl_characteristic)
@@ -187,18 +350,22 @@ class BluetoothFileTransfer:
         self.idx_block_buf = 0
         self.is_block = True
         self.block_error = False
-        await self.send_cmd(self.rx_characteristic, VALUE_C, 100)                     # Send 'C'.
+        await self.send_cmd(self.rx_characteristic, VALUE_C, 0)                       # Send 'C'.
         await self.read_block()
 
-    async def read_block(self):
+    async def read_block(self, timeout_ms=10_000):
         # [ESP32] A cleaner implementation with asyncio.Event() than this polling function lead to a decreased throughput.
         async def check_block_buf():
-            while self.is_block and self.idx_block_buf == 0:
+            while self.is_block and self.idx_block_buf == 0 and not self.is_garbage:
                 #await asyncio.sleep_ms(10)
                 await asyncio.sleep_ms(2)
             await asyncio.sleep_ms(0)
             block_size = self.block_size
-            while self.is_block and self.idx_block_buf < block_size: # block_size = 133/1029 bytes in SOH/STX (one block)
+            packet_timeout_ms = self.packet_timeout_ms()
+            while self.is_block and self.idx_block_buf < block_size and not self.is_garbage: # block_size = 133/1029 bytes in SOH/STX (one block)
+                if time.ticks_diff(time.ticks_ms(), self.t_packet) > packet_timeout_ms:
+                    self.is_garbage = True                                                # Stalled; a packet was lost.
+                    break
                 #await asyncio.sleep_ms(10)
                 await asyncio.sleep_ms(2)
 
@@ -207,9 +374,9 @@ class BluetoothFileTransfer:
                 if self.idx_write_buf > 0: flush_write_buf()
                 self.save_chunk_raw(data)
             else:
-                self.write_buf_page[self.idx_write_buf][:] = data
+                block_append(self.write_buf, self.idx_write_buf * 128, len(self.write_buf), data)
                 self.idx_write_buf += 1
-                if self.idx_write_buf == 4:
+                if self.idx_write_buf == self.write_pages:
                     self.save_chunk_raw(self.write_buf)
                     self.idx_write_buf = 0
                 elif (self.data_written + self.block_size - 5) == self.data_size:
@@ -221,9 +388,15 @@ class BluetoothFileTransfer:
             self.idx_write_buf = 0
 
         try:
-            await asyncio.wait_for(check_block_buf(), timeout=10)
+            await asyncio.wait_for_ms(check_block_buf(), timeout_ms)
             if not self.is_block: return # The 1st EOT may arrive very late.
-            if int.from_bytes(self.block_crc, 'big') != self.crc16_arc(self.block_data):
+            if self.is_garbage or not check_block(self.block_buf, self.block_size):
+                self.block_error = True
+            elif self.block_num >= 0 and self.block_buf[1] == self.block_num:           # Resent as our ACK was lost; discard and ACK again.
+                print(f'Duplicate block{self.block_num} (#{self.block_count}).')
+                self.block_error = False
+            elif self.is_write_mode and self.data_written >= self.data_size:             # Beyond the expected total from block 0.
+                print(f'Unexpected block{self.block_buf[1]} after {self.block_count} blocks.')
                 self.block_error = True
             else:
                 if self.is_write_mode:                                                    # Blocks should be combined to make a file.
@@ -231,15 +404,10 @@ class BluetoothFileTransfer:
                         self.data_written += write_to_buf(self.block_data)
                     else:
                         if self.idx_write_buf > 0: flush_write_buf()
-                        mv_block_data = memoryview(self.block_data)
-                        i = -1
-                        while self.block_data[i] == 0x00: # Remove padded zeros at the end.
-                            i -= 1
-                        self.data_written += self.save_chunk_raw(mv_block_data[:i+1])
-                if self.block_buf[1] == (self.block_num + 1) % 256:
-                    if self.block_error: print(f'Fixed error in block{self.block_buf[1]}.')
-                else:
-                    print(f'Unexpected block: {self.block_num} -> {self.block_buf[1]}')
+                        mv_block_data = memoryview(self.block_data)                    # Remove padding at the end.
+                        self.data_written += self.save_chunk_raw(mv_block_data[:self.data_size - self.data_written])
+                    self.block_count += 1
+                if self.block_error: print(f'Fixed error in block{self.block_buf[1]}.')
                 self.block_num = self.block_buf[1]
                 self.block_error = False
         except asyncio.TimeoutError:
@@ -247,31 +415,37 @@ class BluetoothFileTransfer:
         # Prepare for the next data block.
         self.idx_block_buf = 0
 
+    def packet_timeout_ms(self):
+        return max(100, PACKET_TIMEOUT_CONN_EVENTS * self.conn_interval_us // 1000)
+
+    def block_timeout_ms(self):
+        # The 1st packet of a data block; the device may need several connection events to respond to ACK/NAK.
+        return max(1_000, 10 * PACKET_TIMEOUT_CONN_EVENTS * self.conn_interval_us // 1000)
+
     async def end_of_transfer(self):
-        # The first EOT was received already.
-        await asyncio.sleep_ms(100) # This avoids NAK to be sent too fast.
-        self.notification_data = AWAIT_NEW_DATA
-        await self.send_cmd(self.rx_characteristic, VALUE_NAK, 100) # Send NAK.
+        # The first EOT was received already; each reply is sent as soon as the notification arrives.
+        self.notification_data[:] = AWAIT_NEW_DATA
+        await self.send_cmd(self.rx_characteristic, VALUE_NAK, 0)                           # Send NAK.
         await self.wait_until_data(self.tx_characteristic)                                   # Receive the second EOT.
-        await asyncio.sleep_ms(100) # This avoids ACK to be sent too fast.
-        self.notification_data = AWAIT_NEW_DATA
-        await self.send_cmd(self.rx_characteristic, VALUE_ACK, 100) # Send ACK.
+        self.notification_data[:] = AWAIT_NEW_DATA
+        await self.send_cmd(self.rx_characteristic, VALUE_ACK, 0)                           # Send ACK.
         await self.wait_until_data(self.ctl_characteristic)                                   # Receive IDLE (0x04, 0x00, 0x04)
 
     async def fetch_file(self, filename):
+        t_start = time.ticks_ms()
         if self.notification_data != VALUE_IDLE:
-            if not await self.get_idle_status(): return
+            if not await self.get_idle_status(): return False
         # Request the File
         self.filename = filename
-        self.notification_data = AWAIT_NEW_DATA
+        self.notification_data[:] = AWAIT_NEW_DATA
         value_file_fetch = self.make_command(FILE_FETCH, filename)
-        await self.send_cmd(self.ctl_characteristic, value_file_fetch, 100)                   # Request starts with 0x05
+        await self.send_cmd(self.ctl_characteristic, value_file_fetch, self.response_delay_ms) # Request starts with 0x05
         await self.wait_until_data(self.ctl_characteristic)
 
         if self.notification_data == self.make_command(OK_FILE_FETCH, filename):              # Response starts with 0x06
             self.is_write_mode = False                                                         # Do not write block 0
-            notify_handler_task = asyncio.create_task(self.notify_handler())
-            await asyncio.sleep(1)
+            own_task = self.notify_task is None                                               # Or kept running in a batch.
+            await self.start_notify_handler()
             retries = 3
             while retries > 0:
                 await self.read_block_zero() # Block 0 consists of name and size of the file.
@@ -283,38 +457,115 @@ class BluetoothFileTransfer:
                     break
             if retries == 0: # Too many errors in reading block zero; cancel transport.
                 await self.send_cmd(self.rx_characteristic, VALUE_CAN, 100)                   # Send CAN (cancel).
-                notify_handler_task.cancel()
-                return
+                if own_task: self.stop_notify_handler()
+                return False
 
-            self.data_size = int(bytes(self.block_data).rstrip(b'\x00').decode('utf-8').split()[1])
+            self.data_size = int(bytes(self.block_data[:strip_zeros(self.block_data)]).decode('utf-8').split()[1])
 
-            await self.send_cmd(self.rx_characteristic, VALUE_ACK, 100)                       # Send ACK.
-            await self.send_cmd(self.rx_characteristic, VALUE_C, 100)                         # Send 'C'.
+            await self.send_cmd(self.rx_characteristic, VALUE_ACK, 0)                         # Send ACK.
+            await self.send_cmd(self.rx_characteristic, VALUE_C, 0)                           # Send 'C'.
+            t_data = time.ticks_ms()
 
             # Blocks of num>=1 should be combined to obtain the file.
+            self.file_path = self.storage.path(filename) if self.storage else f'/sd/{filename}'
+            try:
+                os.remove(f'{self.file_path}.part')                                           # Chunks are appended.
+            except OSError:
+                pass
+            self.fit_validator = FitValidator(crc16_arc) if FitValidator and filename.endswith('.fit') else None
+            if TrackWriter and filename.endswith('.fit'):
+                self.track_writers = tuple(TrackWriter(f"{self.file_path.rsplit('.', 1)[0]}.{x}") for x in TRACK_FORMATS)
+            if RideLog and RIDE_LOG and filename.endswith('.fit'):
+                try:
+                    import hashlib
+                    sha256 = hashlib.sha256()
+                except (ImportError, AttributeError):
+                    sha256 = None
+                self.ride_summary = (FitDecoder(summary := RideSummary()), summary, sha256)
             self.is_write_mode = True
-            self.data_written = 0
+            self.data_written = self.block_count = 0
             self.idx_write_buf = 0
+            errors = 0
             while self.is_block:                                                              # Receive EOT to exit this loop.
-                await self.read_block()
+                await self.read_block(self.block_timeout_ms())
                 if not self.is_block: break # The 1st EOT may arrive very late.
-                if self.block_num % 128 == 0: gc.collect()
+                if self.block_count % self.profile['gc_blocks'] == 0:
+                    self.heap.sample()
+                    gc.collect()
                 if self.block_error:
+                    if (errors := errors + 1) > MAX_BLOCK_RETRIES:                             # Too many errors; cancel transport.
+                        self.is_block = False
+                        await self.send_cmd(self.rx_characteristic, VALUE_CAN, 100)           # Send CAN (cancel).
+                        if own_task: self.stop_notify_handler()
+                        print(f'Error: too many errors in block{(self.block_num + 1) % 256}.')
+                        self.close_tracks(False)
+                        self.ride_summary = None
+                        self.commit_file(False)
+                        return False
                     await self.clear_notify_queue()
                     #await self.send_cmd(self.rx_characteristic, VALUE_NAK, 10)               # Send NAK on error.
                     await self.send_cmd(self.rx_characteristic, VALUE_NAK, 2)               # Send NAK on error.
                 else:
+                    errors = 0
                     #await self.send_cmd(self.rx_characteristic, VALUE_ACK, 10)               # Send ACK.
                     await self.send_cmd(self.rx_characteristic, VALUE_ACK, 2)               # Send ACK.
-            notify_handler_task.cancel()
+            t_eot = time.ticks_ms()
+            if own_task: self.stop_notify_handler()
             await self.end_of_transfer()
+            self.overhead_ms = time.ticks_diff(t_data, t_start) + time.ticks_diff(time.ticks_ms(), t_eot)
+            self.heap.sample()
+            ok = False
             if self.data_written != self.data_size:
                 print(f"Error: {self.data_written}(file size) != {self.data_size}(spec)")
+            elif self.fit_validator and not self.fit_validator.close():
+                print(f"Error: {filename}: {self.fit_validator.error}")
             else:
                 print(f"Successfully wrote combined data to {filename}")
+                ok = True
+            self.fit_validator = None
+            self.commit_file(ok)
+            self.close_tracks(ok)
+            if self.ride_summary:
+                decoder, summary, sha256 = self.ride_summary
+                if decoder.close(ok):
+                    RideLog(RIDE_LOG).add(summary.ride(filename, self.data_written, hexlify(sha256.digest()) if sha256 else ''))
+                self.ride_summary = None
             gc.collect()
+            return ok
+        return False
+
+    async def fetch_batch(self, filenames):
+        '''Fetch files in a batch with one notify_handler task and no delays after requests answered by the device;
+        the next request is sent as soon as the device is IDLE.  Returns the number of files fetched.
+        '''
+        fetched = overhead_ms = 0
+        self.response_delay_ms = 0
+        await self.start_notify_handler()
+        try:
+            for filename in filenames:
+                print(f"Retrieving {filename}")
+                for retry in range(REFETCH_RETRIES + 1):
+                    if retry: print(f"Re-fetching {filename}")
+                    if (ok := await self.fetch_file(filename)): break
+                if ok:
+                    fetched += 1
+                    overhead_ms += self.overhead_ms
+        finally:
+            self.stop_notify_handler()
+            self.response_delay_ms = RESPONSE_DELAY_MS
+        if fetched:
+            print(f"Fetched {fetched} files; overhead {overhead_ms // fetched} ms/file.")
+        return fetched
 
     async def wait_until_data(self, char):
+        if char is self.tx_characteristic and self.notify_task is not None:              # Taken by notify_handler.
+            t_start = time.ticks_ms()
+            while self.notification_data == AWAIT_NEW_DATA:
+                if time.ticks_diff(time.ticks_ms(), t_start) > 10_000:
+                    print(f"Something went wrong. No new notification data.")
+                    break
+                await asyncio.sleep_ms(2)
+            return
         try:
             self.notification_data[:] = await char.notified(timeout_ms=10_000)
         except asyncio.TimeoutError:
@@ -322,16 +573,61 @@ class BluetoothFileTransfer:
 
     async def read_diskspace(self):
         # Read Diskspace; e.g. bytearray(b'\n556/8104\x1e')
-        self.notification_data = AWAIT_NEW_DATA
+        self.notification_data[:] = AWAIT_NEW_DATA
         self.is_block = False
         await self.send_cmd(self.ctl_characteristic, VALUE_DISKSPACE, 100)                   # Request starts with 0x09
         await self.wait_until_data(self.ctl_characteristic)                                  # Response starts with 0x0a(b'\n')
-        if (self.crc8_xor(self.notification_data) == 0 and 
+        if (crc8_xor(self.notification_data) == 0 and 
             self.notification_data[0] == OK_DISKSPACE[0]):
             diskspace = self.notification_data[1:-1].decode('utf-8')
             print(f"Free Diskspace: {diskspace}kb")
 
+    def select_for_deletion(self, fit_files, exists):
+        '''Rides to be deleted on the device; older than RETENTION_DAYS (by the timestamp in the name) except the newest
+        RETENTION_KEEP, and verified locally (size and CRC).
+        '''
+        cutoff = '%04d%02d%02d%02d%02d%02d' % time.localtime(time.time() - RETENTION_DAYS * 86_400)[:6]
+        names = sorted(x for x in fit_files if x[:14].isdigit())
+        selected = []
+        for fit_file in names[:max(0, len(names) - RETENTION_KEEP)]:
+            if fit_file[:14] >= cutoff:
+                break
+            if not exists(fit_file):
+                continue
+            try:
+                check_fit_file(self.storage.existing(fit_file) if self.storage else f'/sd/{fit_file}')
+            except (ValueError, OSError) as e:
+                print(f'Keep {fit_file} on the device: {e}')
+                continue
+            selected.append(fit_file)
+        return selected
+
+    async def delete_files(self, filenames):
+        # Delete files on the device in a batch.
+        if DELETE_DRY_RUN:
+            for filename in filenames:
+                print(f'Would delete: {filename}')
+            return
+        deleted = 0
+        if filenames and (self.notification_data == VALUE_IDLE or await self.get_idle_status()):
+            for filename in filenames:
+                self.notification_data[:] = AWAIT_NEW_DATA
+                await self.send_cmd(self.ctl_characteristic, self.make_command(FILE_DELETE, filename), 100) # Request starts with 0x0d
+                await self.wait_until_data(self.ctl_characteristic)
+                if self.notification_data == self.make_command(OK_FILE_DELETE, filename):          # Response starts with 0x0e
+                    deleted += 1
+                else:
+                    print(f'Failed to delete {filename}: {self.notification_data}')
+        print(f'Deleted {deleted} of {len(filenames)} files on the device.')
+
     async def run(self):
+        try:
+            await self.session()
+        finally:
+            self.heap.report()
+
+    async def session(self):
+        self.heap.start('connect')
         device = await self.discover_device(_TARGET_NAME)
         if not device:
             return
@@ -340,9 +636,7 @@ class BluetoothFileTransfer:
         while True:
             try:
                 #connection = await device.connect(timeout_ms=60_000)
-                connection = await device.connect(
-                    timeout_ms=60_000, 
-                    scan_duration_ms=5_000, min_conn_interval_us=7_500, max_conn_interval_us=7_500)
+                connection = await self.link_policy.connect(device)
                 break
             except asyncio.TimeoutError:
                 retries -= 1
@@ -352,38 +646,64 @@ class BluetoothFileTransfer:
 
         async with connection:
             print(f"Connected to {device}")
-            try:
-                service = await connection.service(_SERVICE_UUID)
-                self.ctl_characteristic = await service.characteristic(_CTL_CHARACTERISTIC_UUID)
-                self.tx_characteristic = await service.characteristic(_TX_CHARACTERISTIC_UUID)
-                self.tx_characteristic._notify_queue = deque((), 7)                     # TODO: check if 7 is sufficient for STX.
-                self.rx_characteristic = await service.characteristic(_RX_CHARACTERISTIC_UUID)
-                await self.ctl_characteristic.subscribe(notify=True)
-                await self.tx_characteristic.subscribe(notify=True)
-                print(f"Notifications started")
-            except Exception as ex:
-                print(f"Failed to discover service/characteristics: {ex}")
+            if not await self.start_notify(connection):
                 return
 
             await self.read_diskspace()
 
             # Increase MTU
-            await connection.exchange_mtu(mtu=209)
-            self.mtu_size = connection.mtu or self.mtu_size
-            print(f"MTU: {self.mtu_size}")
+            await self.set_link(connection)
 
             # The name of the list may be 'workouts.json' on new devices.
+            self.heap.start('list')
             if 'filelist.txt' in os.listdir('/sd'):
                 os.rename('/sd/filelist.txt', '/sd/filelist.old')
             await self.fetch_file('filelist.txt')
             fit_files = self.extract_fit_filenames('/sd/filelist.txt')
 
+            if self.storage:
+                if (n := self.storage.recover()): print(f'Removed {n} stale .part files.')
+                exists = self.storage.exists
+            else:
+                names = set(os.listdir('/sd'))                                                # List once; not per file.
+                exists = lambda x: x in names
+            fetches = []
             for fit_file in fit_files:
-                if fit_file in os.listdir('/sd'):
+                if exists(fit_file):
                     print(f'Skip: {fit_file}')
                 else:
-                    print(f"Retrieving {fit_file}")
-                    await self.fetch_file(fit_file)
+                    fetches.append(fit_file)
+            self.heap.start('fetch')
+            await self.fetch_batch(sorted(fetches))
+            if self.storage: self.storage.sync()                                             # Before deleting the rides on the device.
+
+            if RETENTION_DAYS is not None and check_fit_file:
+                self.heap.start('delete')
+                await self.delete_files(self.select_for_deletion(fit_files, exists))
+
+    async def start_notify(self, connection):
+        # Characteristics of the service and their notifications; returns False on failure.
+        try:
+            service = await connection.service(_SERVICE_UUID)
+            self.ctl_characteristic = await service.characteristic(_CTL_CHARACTERISTIC_UUID)
+            self.tx_characteristic = await service.characteristic(_TX_CHARACTERISTIC_UUID)
+            self.tx_characteristic._notify_queue = deque((), self.profile['queue'])  # TODO: check if 7 is sufficient for STX.
+            self.rx_characteristic = await service.characteristic(_RX_CHARACTERISTIC_UUID)
+            await self.ctl_characteristic.subscribe(notify=True)
+            await self.tx_characteristic.subscribe(notify=True)
+            print(f"Notifications started")
+            return True
+        except Exception as ex:
+            print(f"Failed to discover service/characteristics: {ex}")
+            return False
+
+    async def set_link(self, connection):
+        self.link = await self.link_policy.apply(connection)
+        self.mtu_size = self.link['mtu']
+        if self.link['conn_interval_us']:
+            self.conn_interval_us = self.link['conn_interval_us'] # Otherwise the timeouts assume the default.
+        print(f"Link: interval {self.link['conn_interval_us']} us, MTU {self.mtu_size}, "
+            f"data length {self.link['data_length']}, {'STX' if self.link['stx'] else 'SOH'}")
 
     def extract_fit_filenames(self, file_path):
         '''The list should be either a plain text (e.g. filelist.txt) or a JSON file.
@@ -394,11 +714,14 @@ class BluetoothFileTransfer:
             with open(file_path, 'r') as file:
                 if not any((file_path.endswith(x) for x in ("json", "JSON"))): # TODO: this workaround is not required any more after MPY-1.25.0 (PR 16812).
                     pattern = re.compile(r'\d+\.fit')
-                    lines = file.readlines()
+                    lines = file if self.profile['stream'] else file.readlines() # Line by line, or all at once.
                     for line in lines:
                         match = pattern.search(line)
                         if match:
                             fit_files.add(match.group(0))
+                        self.heap.sample()
+                elif self.profile['stream']:
+                    scan_workouts(file, fit_files)
                 else:
                     import json
                     json_dict = json.load(file)
@@ -409,45 +732,122 @@ class BluetoothFileTransfer:
 
         return fit_files
 
+    def commit_file(self, ok):
+        # Rename the .part into place on success; remove it otherwise.
+        try:
+            if not ok:
+                os.remove(f'{self.file_path}.part')
+            elif self.storage:
+                self.storage.commit(self.filename)
+            else:
+                try:
+                    os.remove(self.file_path)
+                except OSError:
+                    pass
+                os.rename(f'{self.file_path}.part', self.file_path)
+        except OSError as e:
+            print(f'Error: {self.file_path}: {e}')
+
+    def close_tracks(self, ok):
+        for writer in self.track_writers:
+            if writer.close(ok): print(f'Converted to {writer.path}')
+        self.track_writers = ()
+
     def save_chunk_raw(self, data):
-        with open(f'/sd/{self.filename}', 'ab') as f:
+        if self.fit_validator: self.fit_validator.write(data)
+        for writer in self.track_writers: writer.write(data)
+        if self.ride_summary:
+            self.ride_summary[0].write(data)
+            if self.ride_summary[2]: self.ride_summary[2].update(data)
+        with open(f'{self.file_path}.part', 'ab') as f:
             return f.write(data)
 
-    def crc8_xor(self, data):
-        '''crc8/xor
-        See make_command() how to use.
-        '''
-        crc = 0
-        for x in data:
-            crc ^= x
-        return crc & 0xff
-
-    @micropython.viper
-    def crc16_arc(self, byte_array) -> int:
-        '''crc16/arc
-        XOSS uses CRC16/ARC instead of CRC16/XMODEM.
-        '''
-        crc: int = 0
-        data = ptr8(byte_array)
-        length = int(len(byte_array))
-        table = ptr16(CRC16_ARC_TBL)
-        i: int = 0
-        while i < length:
-            crc = (crc >> 4) ^ table[(crc ^ data[i]) & 0x0F]
-            crc = (crc >> 4) ^ table[(crc ^ (data[i] >> 4)) & 0x0F]
-            i += 1
-        return crc
-
     def make_command(self, cmd, string=None):
         byte_array = cmd + bytearray(string.encode('utf-8') if string is not None else b'\x00') + bytearray([0x00])
-        byte_array[-1] = self.crc8_xor(byte_array) # Replace the padded zero with crc8_xor.
+        byte_array[-1] = crc8_xor(byte_array) # Replace the padded zero with crc8_xor.
         return byte_array
 
+
+def scan_workouts(file, fit_files, chunk_size=256):
+    # Names ('[' followed by a 14-digit number, e.g. [20240715062336, ...] in "workouts") in a JSON file, chunk by chunk;
+    # the tail of a chunk is kept for a name split across chunks.
+    tail = ''
+    while (chunk := file.read(chunk_size)):
+        text = tail + chunk
+        i = text.find('[')
+        while i >= 0:
+            j = i + 1
+            while j < len(text) and text[j] in ' \t\r\n"':
+                j += 1
+            k = j
+            while k < len(text) and text[k].isdigit():
+                k += 1
+            if k == len(text):                                                    # Maybe split; see the next chunk.
+                break
+            if k - j == 14:
+                fit_files.add(f'{text[j:k]}.fit')
+            i = text.find('[', i + 1)
+        tail = text[i:] if i >= 0 else ''
+    return fit_files
+
+
+# The receive path (per packet/block) in pure Python; replaced by viper code if mpy_xoss_native.py is installed.
+def block_append(buf, idx, limit, data):
+    # Copy data (a packet) into buf at idx; returns the next idx, or -1 if it exceeds limit (the size of a block).
+    if idx + (n := len(data)) > limit:
+        return -1
+    buf[idx:idx + n] = data
+    return idx + n
+
+def check_header(data, block_num):
+    '''Check header (SOH/STX, num, ~num) in the 1st packet of a block.
+    The previous num is also accepted as it is resent if our ACK was lost.
+    '''
+    return (len(data) >= 3 and data[0] in (VALUE_SOH[0], VALUE_STX[0]) and data[1] ^ data[2] == 0xff and
+        (data[1] == (block_num + 1) % 256 or (block_num >= 0 and data[1] == block_num)))
+
+def check_block(buf, size):
+    # CRC16/ARC of the data in a block (header, data and CRC in big endian) of size bytes.
+    return crc16_arc(memoryview(buf)[3:size - 2], 0) == buf[size - 2] << 8 | buf[size - 1]
+
+def strip_zeros(data):
+    # Length of data without the zero padding at the end.
+    n = len(data)
+    while n > 0 and data[n - 1] == 0:
+        n -= 1
+    return n
+
+def crc8_xor(data):
+    '''crc8/xor
+    See make_command() how to use.
+    '''
+    crc = 0
+    for x in data:
+        crc ^= x
+    return crc & 0xff
+
+def crc16_arc(data, crc):
+    '''crc16/arc; pass the previous crc (or 0) to continue.
+    XOSS uses CRC16/ARC instead of CRC16/XMODEM.
+    '''
+    table = CRC16_ARC_TBL
+    for x in data:
+        crc = (crc >> 4) ^ table[(crc ^ x) & 0x0F]
+        crc = (crc >> 4) ^ table[(crc ^ (x >> 4)) & 0x0F]
+    return crc
+
 CRC16_ARC_TBL = array("H", (
     0x0000, 0xCC01, 0xD801, 0x1400, 0xF001, 0x3C00, 0x2800, 0xE401,
     0xA001, 0x6C00, 0x7800, 0xB401, 0x5000, 0x9C01, 0x8801, 0x4400,
     ))
 
+PY_RECEIVE_PATH = (block_append, check_header, check_block, strip_zeros, crc8_xor, crc16_arc) # See, mpy_bench.py.
+try:
+    from mpy_xoss_native import block_append, check_header, check_block, strip_zeros, crc8_xor, crc16_arc # Optional;
+    NATIVE = True                                                                         # copy mpy_xoss_native.py.
+except (ImportError, SyntaxError, ValueError): # ValueError on .mpy of another arch.
+    NATIVE = False
+
 
 def start():
     if not "sd" in os.listdir():
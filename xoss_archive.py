@@ -0,0 +1,701 @@
+#!/usr/bin/env python
+#coding:utf-8
+#
+# (c) 2024-2025 ekspla.
+# MIT License.  https://github.com/ekspla/xoss_sync
+#
+# Archive of FIT files fetched by xoss_sync.py (CPython).
+#
+# Layout of the archive (e.g. ARCHIVE_DIR = 'archive' in xoss_sync.py):
+#   archive.sqlite                  # Index of (device, name) to SHA-256.
+#   objects/ab/abcdef...            # Content; a ride fetched from two devices or twice is stored once.
+#   devices/EC379Fxxyyzz/NAME.fit   # Hard links to the objects, for browsing (in sub-directories by the layout).
+#   tmp/                            # Files in transfer.
+#
+# Compressed objects (see, ARCHIVE_COMPRESSION) are abcdef....gz or .zst, linked as NAME.fit.gz or NAME.fit.zst.
+# The content is compressed as it arrives, in frames of FRAME_SIZE compressed independently, followed by a seek index;
+# the file is a standard gzip (or zstd) stream (zcat works), and FrameReader reads at any offset by decompressing
+# one frame.  Objects stored before the compression was changed are read as they are.
+#
+# Usage: python xoss_archive.py rebuild [directory]     # Rebuild the index of rides (rides.sqlite) in parallel.
+#        python xoss_archive.py [stats]                 # Monthly totals from the index.
+#        python xoss_archive.py audit [ROOT] [LIST ...] # Check header, size and CRC of the files in parallel; a re-fetch
+#                                                       # plan (refetch.json) of rides truncated, corrupt or missing.
+# ROOT of audit is an archive (with archive.sqlite) or a directory of FIT files (default '.'); LISTs are track lists
+# of devices (e.g. EC379Fxxyyzz_filelist.txt), for rides missing locally and their sizes if listed.
+
+import io
+import os
+import sys
+import json
+import time
+import struct
+import sqlite3
+from xoss_fit import summarize_fit_file, layout_dir
+
+RIDE_INDEX = 'rides.sqlite'
+ARCHIVE_DB = 'archive.sqlite'
+RIDE_COLUMNS = ('name', 'start', 'elapsed', 'timer', 'distance', 'ascent', 'size', 'sha256')
+ARCHIVE_COMPRESSION = None # e.g. 'gzip:6' or 'zstd:3' (zstandard, or Python 3.14+); None for plain files.
+FRAME_SIZE = 65536 # Bytes of content per frame; a seek decompresses a frame at most.
+SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+INDEX_MAGIC = b'XFZ1'
+INDEX_FOOTER = '<4sIIQ' # Magic, frame size, number of frames, size of the content; after the offsets of the frames.
+GZIP_INDEX_TAIL = 10 # Empty deflate block, CRC32 and ISIZE after the index in the extra field of the last member.
+ZSTD_SKIPPABLE = 0x184D2A5E # Magic of the skippable frame holding the index.
+AUDIT_PLAN = 'refetch.json' # {device: [name, ...]} to be re-fetched; '' for rides of any device.
+AUDIT_CHUNK = 1 << 20 # Bytes per update of the CRC.
+
+
+def parse_compression(spec):
+    # 'gzip:6' to ('gzip', 6); None or '' to (None, None).
+    if not spec:
+        return None, None
+    codec, _, level = spec.partition(':')
+    if codec not in SUFFIXES:
+        raise ValueError(f'Unknown compression: {spec}')
+    return codec, int(level) if level else (6 if codec == 'gzip' else 3)
+
+
+def zstd_module():
+    # compression.zstd of Python 3.14+, or the zstandard package; both are optional.
+    try:
+        from compression import zstd
+        return zstd, zstd.compress, zstd.decompress
+    except ImportError:
+        import zstandard
+        return (zstandard, lambda data, level: zstandard.ZstdCompressor(level=level).compress(data),
+            lambda data: zstandard.ZstdDecompressor().decompress(data))
+
+
+def compressor(codec, level):
+    # A function compressing a frame into a gzip member or a zstd frame.
+    if codec == 'gzip':
+        import zlib
+        def compress(data):
+            c = zlib.compressobj(level, zlib.DEFLATED, 31) # 31: with the gzip header and trailer.
+            return c.compress(data) + c.flush()
+        return compress
+    _, compress, _ = zstd_module()
+    return lambda data: compress(data, level)
+
+
+def decompressor(codec):
+    if codec == 'gzip':
+        import zlib
+        return lambda data: zlib.decompress(data, 31)
+    return zstd_module()[2]
+
+
+def decompress_error(codec):
+    # Exception of the decompressor on a corrupt frame.
+    if codec == 'gzip':
+        import zlib
+        return zlib.error
+    return zstd_module()[0].ZstdError
+
+
+def compressed_suffix(path):
+    # '.gz' or '.zst' of a compressed object or view, otherwise ''.
+    return next((x for x in SUFFIXES.values() if path.endswith(x)), '')
+
+
+class FrameWriter:
+    '''Compress chunks into a file as they arrive, a frame every FRAME_SIZE bytes, and write the seek index on close.
+    cpu is the process time spent in compression.
+    '''
+    def __init__(self, file, codec='gzip', level=6, frame_size=FRAME_SIZE):
+        self.file = file
+        self.codec = codec
+        self.compress = compressor(codec, level)
+        self.frame_size = frame_size
+        self.buf = bytearray()
+        self.offsets = [] # End of each frame in the file.
+        self.size = self.compressed = 0
+        self.cpu = 0.0
+
+    def write(self, chunk):
+        self.buf += chunk
+        self.size += len(chunk)
+        while len(self.buf) >= self.frame_size:
+            self.frame(self.buf[:self.frame_size])
+            del self.buf[:self.frame_size]
+
+    def frame(self, data):
+        t0 = time.process_time()
+        frame = self.compress(bytes(data))
+        self.cpu += time.process_time() - t0
+        self.file.write(frame)
+        self.compressed += len(frame)
+        self.offsets.append(self.compressed)
+
+    def close(self):
+        if self.buf or not self.offsets:
+            self.frame(self.buf)
+        payload = (struct.pack(f'<{len(self.offsets)}I', *self.offsets)
+            + struct.pack(INDEX_FOOTER, INDEX_MAGIC, self.frame_size, len(self.offsets), self.size))
+        if self.codec == 'gzip': # An empty member with the index in its extra field; gunzip skips it.
+            field = b'XF' + struct.pack('<H', len(payload)) + payload
+            index = (bytes([0x1f, 0x8b, 8, 4, 0, 0, 0, 0, 0, 0xff]) + struct.pack('<H', len(field)) + field
+                + b'\x03\x00' + bytes(8))
+        else: # A skippable frame.
+            index = struct.pack('<II', ZSTD_SKIPPABLE, len(payload)) + payload
+        self.file.write(index)
+        self.compressed += len(index)
+
+
+class FrameReader(io.RawIOBase):
+    '''Read a file written by FrameWriter as the content, with seek; a frame is decompressed when it is read.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        magic = self.file.read(4)
+        self.codec = 'gzip' if magic[:2] == b'\x1f\x8b' else 'zstd' if magic == b'\x28\xb5\x2f\xfd' else None
+        tail = GZIP_INDEX_TAIL if self.codec == 'gzip' else 0
+        n = struct.calcsize(INDEX_FOOTER)
+        self.file.seek(-(n + tail), 2)
+        footer = self.file.read(n)
+        if self.codec is None or len(footer) < n or footer[:4] != INDEX_MAGIC:
+            self.file.close()
+            raise ValueError(f'{path}: not a compressed archive file')
+        _, self.frame_size, frames, self.size = struct.unpack(INDEX_FOOTER, footer)
+        self.file.seek(-(n + tail + 4 * frames), 2)
+        self.offsets = (0, *struct.unpack(f'<{frames}I', self.file.read(4 * frames)))
+        self.decompress = decompressor(self.codec)
+        self.error = decompress_error(self.codec)
+        self.pos = 0
+        self.cached = (-1, b'') # (frame, content).
+
+    def frame(self, i):
+        # Content of the frame; ValueError if it is corrupt or not of the size in the index.
+        if self.cached[0] != i:
+            if i + 1 >= len(self.offsets):
+                raise ValueError(f'{self.path}: frame {i}: not in the index')
+            self.file.seek(self.offsets[i])
+            try:
+                data = self.decompress(self.file.read(self.offsets[i + 1] - self.offsets[i]))
+            except self.error as e:
+                raise ValueError(f'{self.path}: frame {i}: {e}') from e
+            if len(data) != (n := min(self.frame_size, self.size - i * self.frame_size)):
+                raise ValueError(f'{self.path}: frame {i}: {len(data)} bytes, {n} expected')
+            self.cached = (i, data)
+        return self.cached[1]
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        if self.pos >= self.size:
+            return 0
+        i, start = divmod(self.pos, self.frame_size)
+        data = self.frame(i)
+        n = min(len(b), len(data) - start)
+        b[:n] = data[start:start + n]
+        self.pos += n
+        return n
+
+    def seek(self, offset, whence=0):
+        self.pos = max(0, (0, self.pos, self.size)[whence] + offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+        super().close()
+
+
+def open_object(path):
+    # Content of a plain or compressed object (or view) as a binary file.
+    return FrameReader(path) if compressed_suffix(path) else open(path, 'rb')
+
+
+def unix_time(t):
+    # datetime.date/datetime (local time if naive) or unix time to unix time.
+    if t is None or isinstance(t, (int, float)):
+        return t
+    if not hasattr(t, 'timestamp'): # date
+        import datetime
+        t = datetime.datetime(t.year, t.month, t.day)
+    return int(t.timestamp())
+
+
+class RideIndex:
+    '''Summaries of rides (start time, duration, distance, ascent, size and SHA-256) in SQLite,
+    so that stats are served without opening the FIT files.  Times are in unix time; distances in m.
+    '''
+    def __init__(self, path=RIDE_INDEX):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS rides (name TEXT PRIMARY KEY, start INTEGER, elapsed REAL, '
+            'timer REAL, distance REAL, ascent INTEGER, size INTEGER, sha256 TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS rides_start ON rides (start)')
+        self.db.commit()
+
+    def add(self, ride):
+        self.add_many((ride, ))
+
+    def add_many(self, rides):
+        with self.db:
+            self.db.executemany(f'INSERT OR REPLACE INTO rides VALUES ({", ".join("?" * len(RIDE_COLUMNS))})',
+                ([x[k] for k in RIDE_COLUMNS] for x in rides))
+
+    def add_file(self, path):
+        self.add(ride := summarize_fit_file(path))
+        return ride
+
+    def names(self):
+        return set(x for x, in self.db.execute('SELECT name FROM rides'))
+
+    def get(self, name):
+        row = self.db.execute('SELECT * FROM rides WHERE name = ?', (name, )).fetchone()
+        return dict(zip(RIDE_COLUMNS, row)) if row else None
+
+    def rides(self, since=None, until=None):
+        '''Rides started in [since, until); datetime, date or unix time.
+        '''
+        return [dict(zip(RIDE_COLUMNS, x)) for x in self.db.execute(
+            'SELECT * FROM rides WHERE start >= ? AND start < ? ORDER BY start', self.period(since, until))]
+
+    def totals(self, since=None, until=None):
+        '''Number of rides, distance, elapsed/timer time and ascent of rides started in [since, until).
+        '''
+        row = self.db.execute('SELECT COUNT(*), TOTAL(distance), TOTAL(elapsed), TOTAL(timer), TOTAL(ascent) '
+            'FROM rides WHERE start >= ? AND start < ?', self.period(since, until)).fetchone()
+        return dict(zip(('count', 'distance', 'elapsed', 'timer', 'ascent'), row))
+
+    def monthly(self, since=None, until=None):
+        '''Totals by month (local time); [(YYYY-MM, count, distance, elapsed, ascent), ...].
+        '''
+        return self.db.execute("SELECT strftime('%Y-%m', start, 'unixepoch', 'localtime') AS month, COUNT(*), "
+            'TOTAL(distance), TOTAL(elapsed), TOTAL(ascent) FROM rides WHERE start >= ? AND start < ? '
+            'GROUP BY month ORDER BY month', self.period(since, until)).fetchall()
+
+    def period(self, since, until):
+        return (unix_time(since) or 0, 2**63 - 1 if until is None else unix_time(until))
+
+    def rebuild(self, directory='.', max_workers=None, full=False):
+        '''Summarize FIT files (plain or compressed) under the directory, in any layout (e.g. the views of an Archive), in
+        parallel across cores; only new files unless full.  Returns the number of files indexed.
+        '''
+        from concurrent.futures import ProcessPoolExecutor
+        paths = fit_paths(directory)
+        if not full:
+            known = self.names()
+            paths = {name: path for name, path in paths.items() if name not in known}
+        rides = []
+        with ProcessPoolExecutor(max_workers) as pool:
+            futures = [pool.submit(summarize_fit_file, path) for _, path in sorted(paths.items())]
+            for future in futures:
+                try:
+                    rides.append(future.result())
+                except Exception as e:
+                    print(f"Error: {e}")
+        self.add_many(rides)
+        return len(rides)
+
+    def close(self):
+        self.db.close()
+
+
+class Archive:
+    '''Content-addressed store of fetched files, keyed by SHA-256, with an index of (device, name).
+    A hash hit skips the storage work; the size of the archive scales with unique ride data.
+    '''
+    def __init__(self, root='archive', links=True, layout='', compression=ARCHIVE_COMPRESSION):
+        self.root = root
+        self.links = links # Hard links of devices/DEVICE/NAME to the objects.
+        self.layout = layout # e.g. '{year}/{month}' for devices/DEVICE/YYYY/MM/NAME.
+        self.codec, self.level = parse_compression(compression) # Of new objects.
+        self.suffix = SUFFIXES.get(self.codec, '')
+        os.makedirs(os.path.join(root, 'tmp'), exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(root, ARCHIVE_DB))
+        self.db.execute('CREATE TABLE IF NOT EXISTS files (device TEXT, name TEXT, sha256 TEXT, size INTEGER, '
+            'added INTEGER, PRIMARY KEY (device, name))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)')
+        self.db.commit()
+        self.stored = self.deduplicated = 0 # In this session.
+
+    def object_path(self, sha256, suffix=''):
+        return os.path.join(self.root, 'objects', sha256[:2], sha256 + suffix)
+
+    def find_object(self, sha256):
+        # Path of the object, plain or compressed, or None.
+        for suffix in (self.suffix, '', *SUFFIXES.values()):
+            if os.path.exists(obj := self.object_path(sha256, suffix)):
+                return obj
+        return None
+
+    def view_path(self, device, name):
+        return os.path.join(self.root, 'devices', device or 'unknown', layout_dir(name, self.layout), name)
+
+    def view(self, device, name):
+        # Path of the link of the file (NAME.fit, NAME.fit.gz, ...), or None.
+        view = self.view_path(device, name)
+        return next((view + x for x in ('', *SUFFIXES.values()) if os.path.exists(view + x)), None)
+
+    def temp_path(self, device, name):
+        return os.path.join(self.root, 'tmp', f'{device}-{name}.part')
+
+    def has(self, sha256):
+        return self.find_object(sha256) is not None
+
+    def lookup(self, device, name):
+        row = self.db.execute('SELECT sha256 FROM files WHERE device = ? AND name = ?', (device, name)).fetchone()
+        return row[0] if row else None
+
+    def path(self, device, name):
+        # Path of the content, or None if not in the archive.
+        return self.find_object(sha256) if (sha256 := self.lookup(device, name)) else None
+
+    def open(self, device, name):
+        '''Content of the file as a binary file with seek (FrameReader if compressed), or None if not in the archive.
+        '''
+        return open_object(path) if (path := self.path(device, name)) else None
+
+    def writer(self, file):
+        # A writer of new objects into the file; compressing, or the file itself.
+        return FrameWriter(file, self.codec, self.level) if self.codec else file
+
+    def put(self, device, name, temp, sha256, size, replace=False):
+        '''Store a file (temp, written by writer(); renamed into the archive, or removed on a hash hit) of the device.
+        replace overwrites the object, e.g. of a ride re-fetched as the object was corrupt (see, audit).
+        Returns True if the content is stored.
+        '''
+        obj = self.object_path(sha256, self.suffix)
+        if (new := (existing := self.find_object(sha256)) is None or replace):
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            if existing is not None and existing != obj:
+                os.remove(existing)
+            os.replace(temp, obj)
+            self.stored += 1
+            if existing is not None and self.links: # The links of the other names are to the old file.
+                for x in self.db.execute('SELECT device, name FROM files WHERE sha256 = ?', (sha256, )).fetchall():
+                    self.link(obj, self.view_path(*x))
+        else:
+            os.remove(temp)
+            self.deduplicated += 1
+        self.index(device, name, sha256, size)
+        return new
+
+    def index(self, device, name, sha256, size):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                (device, name, sha256, size, int(time.time())))
+        if self.links:
+            self.link(self.find_object(sha256), self.view_path(device, name))
+
+    def link(self, obj, view):
+        # Link the view (plain path) to the object by the suffix of the object; the views of the other suffixes,
+        # e.g. of the compression before, are removed.
+        os.makedirs(os.path.dirname(view), exist_ok=True)
+        for x in ('', *SUFFIXES.values()):
+            try:
+                os.remove(view + x)
+            except FileNotFoundError:
+                pass
+        try:
+            os.link(obj, view + compressed_suffix(obj))
+        except OSError: # e.g. FAT; the index is the reference (see, view).
+            pass
+
+    def add_file(self, device, path):
+        '''Import a local file (e.g. fetched before the archive was used) of the device.
+        '''
+        import hashlib, shutil
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while (chunk := f.read(65536)):
+                sha256.update(chunk)
+        name = os.path.basename(path)
+        if self.has(digest := sha256.hexdigest()):
+            self.deduplicated += 1
+            self.index(device, name, digest, os.path.getsize(path))
+            return False
+        if self.codec:
+            with open(path, 'rb') as src, open(temp := self.temp_path(device, name), 'wb') as f:
+                writer = self.writer(f)
+                while (chunk := src.read(65536)):
+                    writer.write(chunk)
+                writer.close()
+        else:
+            shutil.copy2(path, temp := self.temp_path(device, name))
+        return self.put(device, name, temp, digest, os.path.getsize(path))
+
+    def devices(self):
+        return [x for x, in self.db.execute('SELECT DISTINCT device FROM files ORDER BY device')]
+
+    def names(self, device):
+        return set(x for x, in self.db.execute('SELECT name FROM files WHERE device = ?', (device, )))
+
+    def usage(self):
+        '''Number of files, unique objects and their bytes.
+        '''
+        files, = self.db.execute('SELECT COUNT(*) FROM files').fetchone()
+        objects, size = self.db.execute('SELECT COUNT(*), TOTAL(size) FROM '
+            '(SELECT sha256, MAX(size) AS size FROM files GROUP BY sha256)').fetchone()
+        return {'files': files, 'objects': objects, 'bytes': int(size)}
+
+    def audit_entries(self):
+        '''Entries of audit_file(), one per object; keys are SHA-256.  Returns (entries, {sha256: [(device, name), ...]}).
+        '''
+        entries, names = [], {}
+        for device, name, sha256, size in self.db.execute('SELECT device, name, sha256, size FROM files'):
+            if sha256 not in names:
+                names[sha256] = []
+                entries.append((sha256, self.find_object(sha256) or self.object_path(sha256, self.suffix), size, sha256))
+            names[sha256].append((device, name))
+        return entries, names
+
+    def close(self):
+        self.db.close()
+
+
+def fit_size(header):
+    # File size by a FIT header (the first 12 or 14 bytes), or None if it is not one.
+    if len(header) < 12 or header[0] not in (12, 14) or header[8:12] != b'.FIT':
+        return None
+    return header[0] + int.from_bytes(header[4:8], 'little') + 2
+
+
+def audit_file(path, size=None, sha256=None):
+    '''Check a FIT file (plain, memory-mapped; or compressed) for the header and the size against the header and
+    size (e.g. of the index or the track list); then the content by sha256 if recorded when it was fetched and
+    verified (a match skips the CRC), or by the file CRC.  Returns (status, detail); status is 'ok', 'truncated',
+    'corrupt' or 'missing'.
+    '''
+    import hashlib, mmap
+    from xoss_fit import FitValidator
+    try:
+        f = open_object(path)
+    except FileNotFoundError:
+        return 'missing', 'no file'
+    except (OSError, ValueError) as e:
+        return 'corrupt', str(e)
+    try:
+        with f:
+            n = f.size if isinstance(f, FrameReader) else os.fstat(f.fileno()).st_size
+            if size is not None and n != size:
+                return 'truncated' if n < size else 'corrupt', f'{n} bytes, {size} expected'
+            header = f.read(14)
+            if (expected := fit_size(header)) is None:
+                return 'truncated' if len(header) < 12 else 'corrupt', 'not a FIT header'
+            if n != expected:
+                return 'truncated' if n < expected else 'corrupt', f'{n} bytes, {expected} in the header'
+            if isinstance(f, FrameReader):
+                def chunks():
+                    f.seek(0)
+                    return iter(lambda: f.read(AUDIT_CHUNK), b'')
+                if sha256:
+                    h = hashlib.sha256()
+                    for chunk in chunks():
+                        h.update(chunk)
+                    if h.hexdigest() == sha256:
+                        return 'ok', 'hash'
+                return check_chunks(chunks(), FitValidator(crc16_arc_wide))
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if sha256 and hashlib.sha256(mm).hexdigest() == sha256:
+                    return 'ok', 'hash'
+                return check_chunks((mm[i:i + AUDIT_CHUNK] for i in range(0, n, AUDIT_CHUNK)),
+                    FitValidator(crc16_arc_wide))
+    except (OSError, ValueError) as e: # e.g. a corrupt frame of a compressed object.
+        return 'corrupt', str(e)
+
+
+CRC16_WIDE_TBL = [] # CRC16/ARC of two bytes (little endian) at a time; made on the first use.
+
+
+def crc16_arc_wide(data, crc):
+    '''crc16_arc of xoss_fit.py, two bytes per step (about twice as fast in CPython).
+    '''
+    from xoss_fit import crc16_arc, CRC16_ARC_TBL
+    if sys.byteorder != 'little':
+        return crc16_arc(data, crc)
+    if not (tbl := CRC16_WIDE_TBL):
+        for x in range(65536):
+            c = (x >> 8) ^ CRC16_ARC_TBL[x & 0xff]
+            tbl.append((c >> 8) ^ CRC16_ARC_TBL[c & 0xff])
+    mv = memoryview(data).cast('B')
+    n = len(mv) & ~1
+    for x in mv[:n].cast('H'):
+        crc = tbl[crc ^ x]
+    return crc16_arc(mv[n:], crc) if n < len(mv) else crc
+
+
+def check_chunks(chunks, validator):
+    for chunk in chunks:
+        validator.write(chunk)
+    if validator.close():
+        return 'ok', 'CRC'
+    return 'corrupt', validator.error
+
+
+def audit_entry(entry):
+    # (key, path, size, sha256) to (key, status, detail); in the process pool.
+    key, path, size, sha256 = entry
+    return (key, *audit_file(path, size, sha256))
+
+
+def audit(entries, max_workers=None, chunksize=16):
+    '''Audit entries ((key, path, size, sha256), ...) in parallel across cores; yields (key, status, detail).
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers) as pool:
+        yield from pool.map(audit_entry, entries, chunksize=chunksize)
+
+
+def read_track_list(path):
+    '''Rides in a track list of a device; (device, {name: size or None}).  The device is by the prefix of the file
+    (EC379Fxxyyzz_filelist.txt; '' if none), and the size by the number in the column after the name, if it is the last
+    one on the line (None otherwise).
+    '''
+    import re, json
+    device = os.path.basename(path).rsplit('_', 1)[0] if '_' in os.path.basename(path) else ''
+    with open(path, 'r') as f:
+        text = f.read()
+    if path.endswith(('.json', '.JSON')):
+        return device, {f'{x[0]}.fit': None for x in json.loads(text)['workouts']}
+    return device, {m.group(1): int(m.group(2)) if m.group(2) else None
+        for m in re.finditer(r'(\d{14}\.fit)(?:[ \t,]+(\d+)(?=[ \t,]*$))?', text, re.M)}
+
+
+def audit_archive(archive, lists=(), max_workers=None):
+    '''Audit the objects of an archive; a problem of an object is of all the names of it.  Rides in the track
+    lists are checked against the index (missing, or of another size).  Returns [(device, name, status, detail), ...].
+    '''
+    entries, names = archive.audit_entries()
+    results = []
+    for sha256, status, detail in audit(entries, max_workers):
+        results.extend((device, name, status, detail) for device, name in names[sha256])
+    indexed = {(x[0], x[1]): x for x in archive.db.execute('SELECT device, name, sha256, size FROM files')}
+    devices = archive.devices()
+    for path in lists:
+        device, rides = read_track_list(path)
+        for name, size in rides.items():
+            found = [indexed[(x, name)] for x in ([device] if device else devices) if (x, name) in indexed]
+            if not found:
+                results.append((device, name, 'missing', f'in {os.path.basename(path)}'))
+            for x in found:
+                if size is not None and x[3] != size:
+                    results.append((x[0], name, 'truncated' if x[3] < size else 'corrupt',
+                        f'{x[3]} bytes, {size} in {os.path.basename(path)}'))
+    return results
+
+
+def fit_paths(root):
+    # {NAME.fit: path} of FIT files (NAME.fit, NAME.fit.gz, ...) under root; the first one in walking order.
+    paths = {}
+    for directory, dirs, files in os.walk(root):
+        dirs.sort()
+        for x in sorted(files):
+            if (name := x[:len(x) - len(compressed_suffix(x))]).endswith('.fit'):
+                paths.setdefault(name, os.path.join(directory, x))
+    return paths
+
+
+def audit_directory(root='.', lists=(), index=None, max_workers=None):
+    '''Audit FIT files (plain or compressed) under root, in any layout; sizes by the track lists and SHA-256 by the
+    index of rides (RideIndex), if given.  Returns [(device, name, status, detail), ...]; device by the track list.
+    '''
+    paths = fit_paths(root)
+    listed = {} # name: (device, size)
+    for path in lists:
+        device, rides = read_track_list(path)
+        listed.update((name, (device, size)) for name, size in rides.items())
+    hashes = {} if index is None else dict(index.db.execute('SELECT name, sha256 FROM rides'))
+    entries = [(name, path, listed.get(name, (None, None))[1], hashes.get(name)) for name, path in sorted(paths.items())]
+    results = [(listed.get(name, ('', ))[0], name, status, detail) for name, status, detail in audit(entries, max_workers)]
+    results.extend((device, name, 'missing', 'in the track list') for name, (device, _) in listed.items()
+        if name not in paths)
+    return results
+
+
+def load_plan(path=AUDIT_PLAN):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_plan(plan, path=AUDIT_PLAN):
+    # Devices without rides are dropped; the file is removed if nothing is left.
+    plan = {k: sorted(set(v)) for k, v in plan.items() if v}
+    if not plan:
+        if os.path.exists(path): os.remove(path)
+        return
+    with open(path + '.part', 'w') as f:
+        json.dump(plan, f, indent=1)
+    os.replace(path + '.part', path)
+
+
+def make_plan(results, path=AUDIT_PLAN):
+    '''Re-fetch plan of the rides not 'ok', merged into the plan file; re-fetched in the next session of the device
+    (see, REFETCH_PLAN in xoss_sync.py).  Returns the number of rides planned.
+    '''
+    plan = load_plan(path)
+    n = 0
+    for device, name, status, _ in results:
+        if status != 'ok' and name not in plan.setdefault(device, []):
+            plan[device].append(name)
+            n += 1
+    save_plan(plan, path)
+    return n
+
+
+def done_plan(device, names, path=AUDIT_PLAN):
+    # Rides re-fetched; removed from the plan (of the device, and of any device).
+    plan = load_plan(path)
+    for key in (device, ''):
+        if key in plan:
+            plan[key] = [x for x in plan[key] if x not in names]
+    save_plan(plan, path)
+
+
+def main(argv):
+    command = argv[1] if len(argv) > 1 else 'stats'
+    index = RideIndex() if command == 'rebuild' or os.path.exists(RIDE_INDEX) else None # Not created by the others.
+    try:
+        if command == 'rebuild':
+            t0 = time.perf_counter()
+            n = index.rebuild(argv[2] if len(argv) > 2 else '.', full=True)
+            print(f"Indexed {n} rides in {time.perf_counter() - t0:.1f} s.")
+        elif command == 'audit':
+            root = argv[2] if len(argv) > 2 else '.'
+            t0 = time.perf_counter()
+            if os.path.exists(os.path.join(root, ARCHIVE_DB)):
+                archive = Archive(root)
+                results = audit_archive(archive, argv[3:])
+                archive.close()
+            else:
+                results = audit_directory(root, argv[3:], index)
+            t = time.perf_counter() - t0
+            totals = {}
+            for device, name, status, detail in results:
+                totals[status] = totals.get(status, 0) + 1
+                if status != 'ok':
+                    print(f"{status}: {device}/{name}: {detail}")
+            hashed = sum(1 for x in results if x[3] == 'hash') # Proved by SHA-256 of the index, without the CRC.
+            print(f"Audited {len(results)} rides in {t:.1f} s: "
+                f"{', '.join(f'{n} {x}' for x, n in sorted(totals.items())) or 'nothing'} ({hashed} by hash).")
+            if (n := make_plan(results)):
+                print(f"Re-fetch plan: {n} rides added to {AUDIT_PLAN}.")
+        elif command == 'stats' and index is None:
+            print(f"No index of rides: {RIDE_INDEX}")
+        elif command == 'stats':
+            for month, count, distance, elapsed, ascent in index.monthly():
+                print(f"{month}: {count:3d} rides, {distance / 1000:8.1f} km, {elapsed / 3600:6.1f} h, {ascent:6.0f} m")
+        else:
+            print(f"Unknown command: {command}")
+    finally:
+        if index is not None: index.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+#coding:utf-8
+#
+# (c) 2024-2025 ekspla.
+# MIT License.  https://github.com/ekspla/xoss_sync
+#
+# Benchmarks of xoss_sync.py without a device (except batch).
+#
+# Usage: python xoss_bench.py decode [20260328072816.fit]
+#     A synthetic ride of about the same size (688 KB) is used if no file is given.
+#        python xoss_bench.py startup [scan]
+#     Time to import xoss_sync and to the first scan in fresh interpreters; the scan is started only with 'scan'
+#     (an adapter is required), otherwise up to the scanner being ready.  See 'Scanning at ...' of mpy_xoss_sync.py for ESP32.
+#        python xoss_bench.py batch [N] [ADDRESS]
+#     Overhead per file (request, block 0 and EOT) of the newest N (default 5) rides fetched one by one and in a batch;
+#     a device is required.  The files are fetched into a temporary directory.
+#        python xoss_bench.py archive [20260328072816.fit] [gzip:6 zstd:3 ...]
+#     Compression ratio and CPU time per MB of the compressed archive, compared to the time the radio takes for a MB,
+#     and a random read (the CRC at the end) from the compressed file.
+
+import sys
+import time
+import struct
+from xoss_fit import crc16_arc, FIT_EPOCH, SEMICIRCLES, FitDecoder, RideColumns
+
+
+def make_ride(n_records=25_500, start=1774683296):
+    '''A synthetic FIT file of a ride; file_id, records (1 Hz, every 4th with a full timestamp) and session.
+    '''
+    import math
+
+    def definition(local, mesg_num, fields):
+        return (bytes([0x40 | local, 0, 0]) + struct.pack('<HB', mesg_num, len(fields))
+            + b''.join(bytes(x) for x in fields))
+
+    record_fields = [(0, 4, 0x85), (1, 4, 0x85), (78, 4, 0x86), (3, 1, 0x02), (4, 1, 0x02),
+        (5, 4, 0x86), (73, 4, 0x86), (7, 2, 0x84), (13, 1, 0x01)]
+    records = bytearray(definition(0, 0, [(0, 1, 0x00), (4, 4, 0x86)]) + struct.pack('<BBI', 0, 4, start - FIT_EPOCH))
+    records += definition(1, 20, [(253, 4, 0x86)] + record_fields)
+    records += definition(2, 20, record_fields) # With compressed timestamp headers.
+    lat, lon, distance = 35.0, 139.0, 0.0
+    for i in range(n_records):
+        timestamp = start - FIT_EPOCH + i
+        lat += 0.00004 * math.cos(i / 500)
+        lon += 0.00004 * math.sin(i / 500)
+        distance += 6.0
+        values = struct.pack('<iiIBBIIHb', round(lat / SEMICIRCLES), round(lon / SEMICIRCLES),
+            round((100 + 50 * math.sin(i / 300) + 500) * 5), 120 + i % 40, 85, round(distance * 100), 6000 + i % 500,
+            180 + i % 60, 25)
+        if i % 4:
+            records += bytes([0x80 | (2 << 5) | (timestamp & 0x1f)]) + values
+        else:
+            records += bytes([1]) + struct.pack('<I', timestamp) + values
+    records += definition(3, 18, [(253, 4, 0x86), (2, 4, 0x86), (7, 4, 0x86), (8, 4, 0x86), (9, 4, 0x86), (22, 2, 0x84)])
+    records += bytes([3]) + struct.pack('<IIIIIH', start - FIT_EPOCH + n_records, start - FIT_EPOCH,
+        n_records * 1000, n_records * 1000, round(distance * 100), 1234)
+    header = bytearray([14, 0x10]) + struct.pack('<HI', 2100, len(records)) + b'.FIT'
+    header += struct.pack('<H', crc16_arc(header))
+    data = header + records
+    return bytes(data + struct.pack('<H', crc16_arc(data)))
+
+
+def bench_decode(data, chunk_size=1024, repeat=5):
+    '''Decode in chunks of an STX block, as inline on the download; returns the best time and the columns.
+    '''
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        decoder = FitDecoder(columns := RideColumns())
+        for i in range(0, len(data), chunk_size):
+            decoder.write(data[i:i + chunk_size])
+        if not decoder.close():
+            raise ValueError(decoder.error)
+        t = time.perf_counter() - t0
+        best = t if best is None else min(best, t)
+    return best, columns
+
+
+RADIO_RATE = 15_000 / 8 # Bytes/s of a fetch at about 15 kbps.
+ARCHIVE_SPECS = ('gzip:1', 'gzip:6', 'gzip:9', 'zstd:1', 'zstd:3', 'zstd:9')
+
+
+def bench_archive(data, spec, chunk_size=1024, repeat=3):
+    '''Compress in chunks of an STX block, as ArchiveSink does on the download; returns the ratio, the best CPU time
+    and the time to read the last 2 bytes from the file (FrameReader).
+    '''
+    import os, io, tempfile
+    from xoss_archive import FrameWriter, FrameReader, parse_compression, SUFFIXES
+    codec, level = parse_compression(spec)
+    cpu = None
+    for _ in range(repeat):
+        writer = FrameWriter(f := io.BytesIO(), codec, level)
+        for i in range(0, len(data), chunk_size):
+            writer.write(data[i:i + chunk_size])
+        writer.close()
+        cpu = writer.cpu if cpu is None else min(cpu, writer.cpu)
+    with tempfile.TemporaryDirectory() as d:
+        with open(path := os.path.join(d, 'ride.fit' + SUFFIXES[codec]), 'wb') as out:
+            out.write(f.getvalue())
+        t0 = time.perf_counter()
+        with FrameReader(path) as reader:
+            reader.seek(-2, 2)
+            crc = reader.read(2)
+        t_seek = time.perf_counter() - t0
+    if crc != data[-2:]:
+        raise ValueError(f'{spec}: random read failed')
+    return len(data) / writer.compressed, cpu, t_seek
+
+
+STARTUP_SCRIPT = '''
+import time
+t0 = time.perf_counter()
+import asyncio, xoss_sync
+t1 = time.perf_counter()
+async def scan():
+    from bleak import BleakScanner
+    scanner = BleakScanner()
+    if {scan}:
+        await scanner.start()
+        t = time.perf_counter()
+        await scanner.stop()
+        return t
+    return time.perf_counter()
+print(t1 - t0, asyncio.run(scan()) - t0)
+'''
+
+
+def bench_startup(repeat=5, scan=False):
+    '''Medians of (import, first scan, process) times in sec, each in a fresh interpreter.
+    '''
+    import os, subprocess, statistics
+    results = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT.format(scan=scan)], capture_output=True, text=True,
+            check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        results.append([float(x) for x in out.split()[-2:]] + [time.perf_counter() - t0])
+    return tuple(statistics.median(x) for x in zip(*results))
+
+
+async def bench_batch(transfer, client, names):
+    '''Average overheads per file in sec fetched (one by one, in a batch) on a connected device.
+    '''
+    import os, tempfile
+    cwd = os.getcwd()
+    results = []
+    try:
+        for batch in (False, True):
+            with tempfile.TemporaryDirectory() as tmp:
+                os.chdir(tmp) # FIT files in the current directory.
+                overhead = []
+                if batch:
+                    async for _, ok in transfer.transfer_batch(client, fetches=names):
+                        if ok: overhead.append(transfer.overhead)
+                else:
+                    for name in names:
+                        if await transfer.fetch_file(client, name): overhead.append(transfer.overhead)
+                os.chdir(cwd)
+            results.append(sum(overhead) / len(overhead) if overhead else None)
+    finally:
+        os.chdir(cwd)
+    return tuple(results)
+
+
+async def batch_main(n=5, address=None):
+    from xoss_sync import BytesSink, TARGET_NAME
+    from xoss_gateway import Session
+    if address is None:
+        from xoss_sync import BluetoothFileTransfer
+        if (device := await BluetoothFileTransfer().discover_device(TARGET_NAME)) is None:
+            return
+        address = device.address
+    session = Session(address)
+    try:
+        await session.open()
+        transfer, client = session.transfer, session.client
+        if not await transfer.fetch_to(client, 'filelist.txt', sink := BytesSink()):
+            print("Failed to fetch filelist.txt")
+            return
+        names = sorted(transfer.parse_fit_filenames(sink.getvalue().decode(), False))[-n:]
+        single, batch = await bench_batch(transfer, client, names)
+        if single is None or batch is None:
+            print("Failed to fetch the files.")
+        else:
+            print(f"{len(names)} files; overhead one by one {single * 1000:.0f} ms/file, "
+                f"batch {batch * 1000:.0f} ms/file.")
+    finally:
+        await session.close()
+
+
+def main(argv):
+    command = argv[1] if len(argv) > 1 else 'decode'
+    if command == 'decode':
+        if len(argv) > 2:
+            with open(argv[2], 'rb') as f:
+                data = f.read()
+        else:
+            data = make_ride()
+        t, columns = bench_decode(data)
+        size = sum(len(x) * x.itemsize for x in columns.columns.values())
+        print(f"Decoded {len(data):,} bytes, {len(columns):,} records in {t * 1000:.1f} ms "
+            f"({len(data) / t / 1e6:.1f} MB/s, {len(columns) / t / 1e3:.0f} k records/s); columns {size:,} bytes.")
+        try:
+            import fitparse, io
+        except ImportError:
+            return
+        t0 = time.perf_counter()
+        n = sum(1 for x in fitparse.FitFile(io.BytesIO(data)).get_messages('record') if x.get_values())
+        print(f"fitparse (record by record): {n:,} records in {(time.perf_counter() - t0) * 1000:.1f} ms.")
+    elif command == 'startup':
+        t_import, t_scan, t_process = bench_startup(scan=len(argv) > 2 and argv[2] == 'scan')
+        print(f"import xoss_sync {t_import * 1000:.0f} ms, first scan {t_scan * 1000:.0f} ms "
+            f"(process {t_process * 1000:.0f} ms).")
+    elif command == 'batch':
+        import asyncio
+        asyncio.run(batch_main(int(argv[2]) if len(argv) > 2 else 5, argv[3] if len(argv) > 3 else None))
+    elif command == 'archive':
+        if len(argv) > 2 and argv[2].endswith('.fit'):
+            with open(argv[2], 'rb') as f:
+                data = f.read()
+            specs = argv[3:]
+        else:
+            data = make_ride()
+            specs = argv[2:]
+        radio = 1e6 / RADIO_RATE # Seconds per MB over the air.
+        print(f"{len(data):,} bytes; the radio takes {radio:.0f} s per MB.")
+        for spec in specs or ARCHIVE_SPECS:
+            try:
+                ratio, cpu, t_seek = bench_archive(data, spec)
+            except ImportError as e:
+                print(f"{spec}: {e}")
+                continue
+            per_mb = cpu / (len(data) / 1e6)
+            print(f"{spec}: ratio {ratio:.2f}, CPU {per_mb * 1000:.0f} ms/MB "
+                f"({per_mb / radio * 100:.3f} % of the radio time), random read {t_seek * 1000:.1f} ms.")
+    else:
+        print(f"Unknown command: {command}")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+#coding:utf-8
+#
+# (c) 2024-2025 ekspla.
+# MIT License.  https://github.com/ekspla/xoss_sync
+#
+# Bumble (https://github.com/google/bumble) backend of xoss_sync.py; the Bluetooth host stack runs in Python on an HCI
+# controller (e.g. a USB dongle), so that the connection interval, MTU and data length are requested explicitly instead
+# of by the OS (50 ms on BlueZ).  Bumble's virtual controllers on a local link run the whole stack against a simulated
+# XOSS device (VirtualXoss) without a radio.
+#
+# Usage: python xoss_bumble.py [TRANSPORT]              # e.g. usb:0, serial:/dev/ttyACM0 (see, BUMBLE_TRANSPORT).
+#        python xoss_bumble.py virtual [FIT_FILE ...]   # Sync from a simulated device into a temporary directory.
+#     pip install bumble.  The controller has to be detached from the OS (e.g. WinUSB driver by Zadig on Windows,
+#     'hciconfig hci0 down' or a dongle not used by BlueZ on Linux).
+
+import asyncio
+import os
+import sys
+from xoss_sync import (BluetoothFileTransfer, LinkPolicy, SERVICE_UUID, CTL_CHARACTERISTIC_UUID,
+    TX_CHARACTERISTIC_UUID, RX_CHARACTERISTIC_UUID, MIN_CONN_INTERVAL_US, MTU_SIZE, VALUE_IDLE, VALUE_STATUS, FILE_FETCH,
+    OK_FILE_FETCH, FILE_SEND, OK_FILE_SEND, VALUE_DISKSPACE, FILE_DELETE, OK_FILE_DELETE, TIME_SET, VALUE_C, VALUE_ACK,
+    VALUE_NAK, VALUE_EOT, VALUE_CAN)
+from xoss_fit import crc16_arc, Storage
+
+BUMBLE_TRANSPORT = 'usb:0' # HCI transport of Bumble, e.g. 'usb:0', 'serial:/dev/ttyACM0', 'tcp-client:127.0.0.1:9001'.
+BUMBLE_ADDRESS = 'F0:F1:F2:F3:F4:F5' # Random static address of our host.
+SUPERVISION_TIMEOUT = 4_000 # in ms.
+DATA_LENGTH = (251, 2120) # Requested LL data length (octets, time in us); an STX packet of MTU 209 in one LL packet.
+VIRTUAL_DISKSPACE = '556/8104' # Free/total in kb of VirtualXoss.
+
+
+class BumbleHost:
+    '''Our Bumble device on an HCI transport, or on a virtual link (see, virtual); opened once and shared by clients.
+    '''
+    def __init__(self, transport=BUMBLE_TRANSPORT, address=BUMBLE_ADDRESS):
+        self.transport_name = transport
+        self.address = address
+        self.transport = None
+        self.device = None
+
+    @classmethod
+    def virtual(cls, link, address=BUMBLE_ADDRESS):
+        # A virtual controller on link (bumble.link.LocalLink), e.g. with VirtualXoss.
+        from bumble.controller import Controller
+        from bumble.device import Device
+        from bumble.hci import Address
+        from bumble.host import Host
+        from bumble.transport.common import AsyncPipeSink
+        host = cls(None, address)
+        controller = Controller('xoss_sync', link=link)
+        host.device = Device(name='xoss_sync', address=Address(address), host=Host(controller, AsyncPipeSink(controller)))
+        return host
+
+    async def open(self):
+        if self.device is None:
+            from bumble.device import Device
+            from bumble.hci import Address
+            from bumble.transport import open_transport
+            self.transport = await open_transport(self.transport_name)
+            self.device = Device.with_hci('xoss_sync', Address(self.address), self.transport.source,
+                self.transport.sink)
+        await self.device.power_on()
+        return self
+
+    async def close(self):
+        if self.device is not None:
+            await self.device.power_off()
+        if self.transport is not None:
+            await self.transport.close()
+            self.transport = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
+def address_str(address):
+    return address.to_string(False)
+
+
+class BumbleScanner:
+    '''BleakScanner-like; calls detection_callback(device, advertisement_data) with the attributes used in xoss_sync.py.
+    '''
+    def __init__(self, host, detection_callback, service_uuids=None):
+        self.host = host
+        self.detection_callback = detection_callback
+        self.service_uuids = set(x.lower() for x in service_uuids or ())
+        self.names = {} # Names by address; a name may be only in the scan response.
+
+    def on_advertisement(self, advertisement):
+        from types import SimpleNamespace
+        from bumble.core import AdvertisingData
+        address = address_str(advertisement.address)
+        data = advertisement.data
+        if (name := data.get(AdvertisingData.COMPLETE_LOCAL_NAME) or data.get(AdvertisingData.SHORTENED_LOCAL_NAME)):
+            self.names[address] = name
+        uuids = [str(x).lower() for x in (data.get(AdvertisingData.COMPLETE_LIST_OF_128_BIT_SERVICE_CLASS_UUIDS) or
+            data.get(AdvertisingData.INCOMPLETE_LIST_OF_128_BIT_SERVICE_CLASS_UUIDS) or ())]
+        if self.service_uuids and not self.service_uuids.intersection(uuids):
+            return
+        name = self.names.get(address)
+        self.detection_callback(SimpleNamespace(address=address, name=name, bumble_address=advertisement.address),
+            SimpleNamespace(local_name=name, service_uuids=uuids, rssi=advertisement.rssi))
+
+    async def __aenter__(self):
+        device = self.host.device
+        device.on('advertisement', self.on_advertisement)
+        await device.start_scanning(filter_duplicates=False)
+        return self
+
+    async def __aexit__(self, *args):
+        device = self.host.device
+        device.remove_listener('advertisement', self.on_advertisement)
+        await device.stop_scanning()
+
+
+class BumbleClient:
+    '''BleakClient-like client of the attributes used in xoss_sync.py, on a Bumble connection.
+    '''
+    def __init__(self, host, device, conn_interval_us=MIN_CONN_INTERVAL_US, timeout=60.0):
+        self.host = host
+        self.device = device # As found by BumbleScanner.
+        self.address = device.address
+        self.conn_interval_us = conn_interval_us
+        self.timeout = timeout
+        self.connection = None
+        self.peer = None
+        self.characteristics = {}
+
+    @property
+    def is_connected(self):
+        return self.connection is not None
+
+    @property
+    def mtu_size(self):
+        return self.connection.att_mtu if self.connection else 23
+
+    async def connect(self):
+        from bumble.device import ConnectionParametersPreferences, Peer
+        from bumble.hci import HCI_LE_1M_PHY
+        interval = self.conn_interval_us / 1000 # in ms.
+        preferences = ConnectionParametersPreferences(connection_interval_min=interval,
+            connection_interval_max=interval, supervision_timeout=SUPERVISION_TIMEOUT)
+        self.connection = await self.host.device.connect(getattr(self.device, 'bumble_address', self.address),
+            connection_parameters_preferences={HCI_LE_1M_PHY: preferences}, timeout=self.timeout)
+        self.connection.on('disconnection', self.on_disconnection)
+        self.peer = Peer(self.connection)
+        await self.peer.discover_services()
+        for service in self.peer.services:
+            await service.discover_characteristics()
+            for characteristic in service.characteristics:
+                self.characteristics[str(characteristic.uuid).lower()] = characteristic
+        return True
+
+    def on_disconnection(self, reason):
+        self.connection = None
+
+    async def disconnect(self):
+        if self.connection is not None:
+            await self.connection.disconnect()
+            self.connection = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.disconnect()
+
+    async def start_notify(self, uuid, callback):
+        # Called as callback(characteristic, data); coroutines in tasks, as in Bleak.
+        characteristic = self.characteristics[uuid.lower()]
+        def subscriber(value):
+            if asyncio.iscoroutinefunction(callback):
+                asyncio.ensure_future(callback(characteristic, bytearray(value)))
+            else:
+                callback(characteristic, bytearray(value))
+        await characteristic.subscribe(subscriber)
+
+    async def stop_notify(self, uuid):
+        if self.connection is not None:
+            await self.characteristics[uuid.lower()].unsubscribe()
+
+    async def write_gatt_char(self, uuid, data, response=False):
+        await self.characteristics[uuid.lower()].write_value(bytes(data), with_response=response)
+
+
+class BumbleLinkPolicy(LinkPolicy):
+    '''The connection interval is requested on connecting (see, BumbleClient); MTU and data length after that.
+    The granted values are read back from the controller.
+    '''
+    def __init__(self, conn_interval_us=MIN_CONN_INTERVAL_US, mtu=MTU_SIZE, data_length=DATA_LENGTH):
+        super().__init__(conn_interval_us, mtu)
+        self.data_length = data_length
+
+    async def apply(self, client):
+        connection = client.connection
+        interval = self.conn_interval_us / 1000
+        if connection.parameters.connection_interval != interval: # Not granted on connecting; ask again.
+            try:
+                await asyncio.wait_for(connection.update_parameters(interval, interval, 0, SUPERVISION_TIMEOUT), 5)
+            except Exception as e:
+                print(f"Failed to update connection parameters: {e}")
+        try:
+            await client.peer.request_mtu(self.mtu)
+        except Exception as e:
+            print(f"Failed to request MTU: {e}")
+        if self.data_length:
+            try:
+                await connection.set_data_length(*self.data_length)
+            except Exception as e:
+                print(f"Failed to set data length: {e}")
+        return self.make_link(round(connection.parameters.connection_interval * 1000), connection.att_mtu,
+            connection.data_length.max_tx_octets)
+
+
+class BumbleFileTransfer(BluetoothFileTransfer):
+    '''BluetoothFileTransfer on a BumbleHost; e.g.
+        async with BumbleHost('usb:0') as host:
+            await BumbleFileTransfer(host).run()
+    '''
+    def __init__(self, host, link_policy=None):
+        super().__init__(link_policy or BumbleLinkPolicy())
+        self.host = host
+
+    def make_scanner(self, detection_callback, **kwargs):
+        return BumbleScanner(self.host, detection_callback, **kwargs)
+
+    def make_client(self, device):
+        return BumbleClient(self.host, device, self.link_policy.conn_interval_us)
+
+
+class VirtualXoss:
+    '''A simulated XOSS device on a virtual link; the YMODEM sender (fetch) and receiver (send) on the Nordic UART
+    service, with the control commands (status, diskspace, delete, time).  Files are {name: bytes}; filelist.txt is
+    made from the FIT files if not given.
+    '''
+    def __init__(self, link, files, name='XOSS G-000000', address='EC:37:9F:00:00:00'):
+        self.link = link
+        self.files = files
+        self.name = name
+        self.address = address
+        self.device = None
+        self.requests = asyncio.Queue() # (uuid, value) of writes, handled in order.
+        self.state = 'idle'
+        self.blocks = []
+        self.idx = 0
+        self.upload = None # [name, size, data, buf] while receiving a file.
+        self.received = {} # Files sent to the device.
+
+    async def start(self):
+        from bumble.controller import Controller
+        from bumble.core import AdvertisingData
+        from bumble.device import Device
+        from bumble.gatt import Service, Characteristic, CharacteristicValue
+        from bumble.hci import Address
+        from bumble.host import Host
+        from bumble.transport.common import AsyncPipeSink
+        controller = Controller('xoss', link=self.link, public_address=self.address)
+        self.device = Device(name=self.name, address=Address(self.address),
+            host=Host(controller, AsyncPipeSink(controller)))
+        def writer(uuid):
+            return CharacteristicValue(write=lambda connection, value: self.requests.put_nowait((uuid, bytes(value))))
+        write = Characteristic.Properties.WRITE | Characteristic.Properties.WRITE_WITHOUT_RESPONSE
+        self.ctl = Characteristic(CTL_CHARACTERISTIC_UUID, write | Characteristic.Properties.NOTIFY,
+            Characteristic.WRITEABLE, writer(CTL_CHARACTERISTIC_UUID))
+        self.tx = Characteristic(TX_CHARACTERISTIC_UUID, Characteristic.Properties.NOTIFY, Characteristic.READABLE, b'')
+        self.rx = Characteristic(RX_CHARACTERISTIC_UUID, write, Characteristic.WRITEABLE,
+            writer(RX_CHARACTERISTIC_UUID))
+        self.device.add_service(Service(SERVICE_UUID, [self.rx, self.tx, self.ctl]))
+        self.device.advertising_data = bytes(AdvertisingData([
+            (AdvertisingData.FLAGS, bytes([0x06])),
+            (AdvertisingData.COMPLETE_LOCAL_NAME, self.name.encode()),
+            ]))
+        await self.device.power_on()
+        await self.device.start_advertising(auto_restart=True)
+        self.task = asyncio.create_task(self.serve())
+        return self
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        await self.device.power_off()
+
+    async def notify(self, characteristic, data):
+        await self.device.notify_subscribers(characteristic, bytes(data))
+
+    def command(self, cmd, payload):
+        value = bytearray(cmd) + payload + bytearray([0])
+        value[-1] = BluetoothFileTransfer.crc8_xor(value[:-1])
+        return value
+
+    def make_blocks(self, name, stx):
+        data = self.files[name]
+        header = f'{name} {len(data)}'.encode().ljust(128, b'\x00')
+        blocks = [frame(0, header, False)]
+        n = 1024 if stx else 128
+        for i in range(0, len(data), n):
+            blocks.append(frame((i // n + 1) % 256, data[i:i + n].ljust(n, b'\x00'), stx))
+        return blocks
+
+    async def send_block(self, i):
+        block = self.blocks[i]
+        n = self.mtu() - 3
+        for j in range(0, len(block), n):
+            await self.notify(self.tx, block[j:j + n])
+
+    def mtu(self):
+        return min((x.att_mtu for x in self.device.connections.values()), default=23)
+
+    async def serve(self):
+        while True:
+            uuid, value = await self.requests.get()
+            try:
+                if uuid == CTL_CHARACTERISTIC_UUID:
+                    await self.on_control(value)
+                elif self.upload is not None:
+                    await self.on_upload(value)
+                else:
+                    await self.on_download(value)
+            except Exception as e:
+                print(f"VirtualXoss: {e}")
+
+    async def on_control(self, value):
+        cmd, payload = value[:1], value[1:-1]
+        if BluetoothFileTransfer.crc8_xor(value) != 0:
+            return
+        if value in (VALUE_STATUS, VALUE_IDLE):
+            await self.notify(self.ctl, VALUE_IDLE)
+        elif cmd == FILE_FETCH:
+            if (name := payload.decode()) not in self.files and name == 'filelist.txt':
+                self.files[name] = ''.join(f'{x} {len(y)}\n' for x, y in sorted(self.files.items())
+                    if x.endswith('.fit')).encode()
+            if name not in self.files:
+                return await self.notify(self.ctl, self.command(bytes([0x12]), payload)) # ERR_FILE_NA
+            self.blocks = self.make_blocks(name, self.mtu() > 23)
+            self.state = 'block0'
+            await self.notify(self.ctl, self.command(OK_FILE_FETCH, payload))
+        elif cmd == FILE_SEND:
+            self.upload = [payload.decode(), 0, bytearray(), bytearray()]
+            await self.notify(self.ctl, self.command(OK_FILE_SEND, payload))
+            await self.notify(self.tx, VALUE_C)
+        elif value == VALUE_DISKSPACE:
+            await self.notify(self.ctl, self.command(bytes([0x0a]), VIRTUAL_DISKSPACE.encode()))
+        elif cmd == FILE_DELETE:
+            self.files.pop(payload.decode(), None)
+            await self.notify(self.ctl, self.command(OK_FILE_DELETE, payload))
+        elif cmd == TIME_SET:
+            pass # No response, as XOSS-G+ gen1.
+
+    async def on_download(self, value):
+        if value == VALUE_C:
+            if self.state == 'block0':
+                await self.send_block(0)
+            elif self.state == 'block0_acked':
+                self.state, self.idx = 'data', 1
+                await (self.send_block(1) if len(self.blocks) > 1 else self.eot('eot1'))
+        elif value == VALUE_ACK:
+            if self.state == 'block0':
+                self.state = 'block0_acked'
+            elif self.state == 'data':
+                self.idx += 1
+                await (self.send_block(self.idx) if self.idx < len(self.blocks) else self.eot('eot1'))
+            elif self.state == 'eot2':
+                self.state = 'idle'
+                await self.notify(self.ctl, VALUE_IDLE)
+        elif value == VALUE_NAK:
+            if self.state == 'block0':
+                await self.send_block(0)
+            elif self.state == 'data':
+                await self.send_block(self.idx)
+            elif self.state == 'eot1':
+                await self.eot('eot2')
+        elif value == VALUE_CAN:
+            self.state = 'idle'
+
+    async def eot(self, state):
+        self.state = state
+        await self.notify(self.tx, VALUE_EOT)
+
+    async def on_upload(self, value):
+        name, size, data, buf = self.upload
+        if value == VALUE_EOT:
+            if self.state != 'upload_eot': # NAK the first EOT, ACK the second.
+                self.state = 'upload_eot'
+                return await self.notify(self.tx, VALUE_NAK)
+            await self.notify(self.tx, VALUE_ACK)
+            self.received[name] = self.files[name] = bytes(data[:size])
+            self.upload, self.state = None, 'idle'
+            return await self.notify(self.ctl, VALUE_IDLE)
+        buf += value
+        if len(buf) < (n := 133 if buf[0] == 1 else 1029):
+            return
+        block = buf[:n]
+        del buf[:]
+        if crc16_arc(block[3:-2]) != int.from_bytes(block[-2:], 'big'):
+            return await self.notify(self.tx, VALUE_NAK)
+        if block[1] == 0 and size == 0 and not data:
+            self.upload[1] = int(bytes(block[3:-2]).rstrip(b'\x00').split()[1])
+            await self.notify(self.tx, VALUE_ACK)
+            await self.notify(self.tx, VALUE_C)
+        else:
+            data += block[3:-2]
+            await self.notify(self.tx, VALUE_ACK)
+
+
+def frame(num, data, stx):
+    # A YMODEM block; header (SOH/STX, num, ~num), data and CRC16 (big endian).
+    return bytes([2 if stx else 1, num, 0xff ^ num]) + bytes(data) + crc16_arc(data).to_bytes(2, 'big')
+
+
+async def sync_virtual(files, directory=None):
+    '''Sync from a VirtualXoss of files ({name: bytes}) over Bumble's virtual link into directory; returns the device.
+    A temporary directory (removed afterwards) by default, so that rides in the current directory are not skipped or
+    overwritten.
+    '''
+    import tempfile
+    from bumble.link import LocalLink
+    from xoss_sync import STORAGE_LAYOUT
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = directory or tmp
+        link = LocalLink()
+        xoss = await VirtualXoss(link, files).start()
+        host = BumbleHost.virtual(link)
+        try:
+            await host.open()
+            transfer = BumbleFileTransfer(host)
+            transfer.storage = Storage(directory, STORAGE_LAYOUT) # FIT files and the track list in the directory.
+            transfer.list_prefix = os.path.join(directory, '')
+            await transfer.run()
+        finally:
+            await host.close()
+            await xoss.stop()
+    return xoss
+
+
+async def main(argv):
+    if len(argv) > 1 and argv[1] == 'virtual':
+        files = {}
+        for path in argv[2:]:
+            with open(path, 'rb') as f:
+                files[os.path.basename(path)] = f.read()
+        await sync_virtual(files)
+    else:
+        async with BumbleHost(argv[1] if len(argv) > 1 else BUMBLE_TRANSPORT) as host:
+            await BumbleFileTransfer(host).run()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv))
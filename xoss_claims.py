@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+#coding:utf-8
+#
+# (c) 2024-2025 ekspla.
+# MIT License.  https://github.com/ekspla/xoss_sync
+#
+# Claims of rides shared by sync workers on many hosts (e.g. stations at several benches, in range of the same device),
+# so that a ride is fetched by one worker only.  A claim is a lease; it is renewed while the worker is alive, and
+# expires after LEASE_TTL if the worker crashed, so that another worker picks the ride up.  A ride fetched and verified
+# is marked done and never claimed again.
+#
+# Stores (see, open_store):
+#   claims.sqlite       # SQLite on a shared disk; CLAIMS_DB = '/mnt/shared/claims.sqlite' in xoss_sync.py.
+#   claims.json         # JSON file under an exclusive file lock (fcntl), for file systems where SQLite is not safe.
+# A store of the other backends (e.g. a server) implements ClaimStore.  Clocks of the hosts should be in sync (NTP).
+#
+# Usage: python xoss_claims.py [list] [STORE]        # Claims and their owners.
+#        python xoss_claims.py reset KEY [STORE]     # Make a ride (e.g. EC379Fxxyyzz/20240715062336.fit) claimable again.
+
+import asyncio
+import functools
+import json
+import os
+import socket
+import sys
+import time
+
+CLAIMS_DB = 'claims.sqlite'
+LEASE_TTL = 120 # A claim expires after this in sec unless renewed; longer than a ride takes to fetch at worst.
+
+
+class ClaimStore:
+    '''Interface of the stores; keys are 'DEVICE/NAME', owners are unique per worker, times are unix time.
+    '''
+    def claim(self, key, owner, ttl):
+        '''Take the claim if it is free, expired or ours, and not done; returns True if taken.
+        '''
+        raise NotImplementedError
+
+    def renew(self, key, owner, ttl):
+        '''Extend our claim; returns False if it was lost (expired and taken by another worker, or reset).
+        '''
+        raise NotImplementedError
+
+    def release(self, key, owner, done=False):
+        '''Give up our claim; done (fetched and verified) keeps the ride from being claimed again.
+        '''
+        raise NotImplementedError
+
+    def reset(self, key):
+        raise NotImplementedError
+
+    def reopen(self, key):
+        '''Make a ride done (or an expired claim) claimable again; a live claim of a worker is kept.
+        '''
+        raise NotImplementedError
+
+    def claims(self):
+        '''[(key, owner, expires, done), ...].
+        '''
+        raise NotImplementedError
+
+
+class SqliteClaimStore(ClaimStore):
+    '''Claims in SQLite; a claim is taken by a single conditional upsert, atomic across processes and hosts
+    (on file systems with working locks).  The connection is used from worker threads, one call at a time (see, Claims).
+    '''
+    def __init__(self, path=CLAIMS_DB):
+        import sqlite3
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS claims (key TEXT PRIMARY KEY, owner TEXT, expires REAL, '
+            'done INTEGER)')
+        self.db.commit()
+
+    def claim(self, key, owner, ttl):
+        now = time.time()
+        with self.db:
+            return self.db.execute('INSERT INTO claims VALUES (?, ?, ?, 0) ON CONFLICT (key) DO UPDATE SET '
+                'owner = excluded.owner, expires = excluded.expires '
+                'WHERE NOT claims.done AND (claims.owner = excluded.owner OR claims.expires < ?)',
+                (key, owner, now + ttl, now)).rowcount == 1
+
+    def renew(self, key, owner, ttl):
+        with self.db:
+            return self.db.execute('UPDATE claims SET expires = ? WHERE key = ? AND owner = ? AND NOT done',
+                (time.time() + ttl, key, owner)).rowcount == 1
+
+    def release(self, key, owner, done=False):
+        with self.db:
+            if done:
+                self.db.execute('UPDATE claims SET done = 1, expires = 0 WHERE key = ? AND owner = ?', (key, owner))
+            else:
+                self.db.execute('DELETE FROM claims WHERE key = ? AND owner = ? AND NOT done', (key, owner))
+
+    def reset(self, key):
+        with self.db:
+            self.db.execute('DELETE FROM claims WHERE key = ?', (key, ))
+
+    def reopen(self, key):
+        with self.db:
+            self.db.execute('DELETE FROM claims WHERE key = ? AND (done OR expires < ?)', (key, time.time()))
+
+    def claims(self):
+        return self.db.execute('SELECT key, owner, expires, done FROM claims ORDER BY key').fetchall()
+
+
+class FileClaimStore(ClaimStore):
+    '''Claims in a JSON file ({key: [owner, expires, done]}), read and rewritten under an exclusive lock of
+    path + '.lock' (fcntl; POSIX, and NFS with lockd).
+    '''
+    def __init__(self, path='claims.json'):
+        self.path = path
+
+    def update(self, func):
+        # Run func(claims) -> (result, changed) under the lock; the file is rewritten only if changed.
+        import fcntl
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.path, 'rb') as f:
+                        claims = json.loads(f.read().decode('utf-8'))
+                except (OSError, ValueError):
+                    claims = {}
+                result, changed = func(claims)
+                if changed:
+                    with open(self.path + '.part', 'wb') as f:
+                        f.write(json.dumps(claims, separators=(',', ':')).encode('utf-8'))
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(self.path + '.part', self.path)
+                return result
+            finally:
+                fcntl.lockf(lock, fcntl.LOCK_UN)
+
+    def claim(self, key, owner, ttl):
+        def func(claims):
+            now = time.time()
+            if (x := claims.get(key)) and (x[2] or (x[0] != owner and x[1] >= now)):
+                return False, False
+            claims[key] = [owner, now + ttl, False]
+            return True, True
+        return self.update(func)
+
+    def renew(self, key, owner, ttl):
+        def func(claims):
+            if not (x := claims.get(key)) or x[0] != owner or x[2]:
+                return False, False
+            x[1] = time.time() + ttl
+            return True, True
+        return self.update(func)
+
+    def release(self, key, owner, done=False):
+        def func(claims):
+            if not (x := claims.get(key)) or x[0] != owner or x[2]:
+                return None, False
+            if done:
+                claims[key] = [owner, 0, True]
+            else:
+                del claims[key]
+            return None, True
+        self.update(func)
+
+    def reset(self, key):
+        self.update(lambda claims: (None, claims.pop(key, None) is not None))
+
+    def reopen(self, key):
+        def func(claims):
+            if not (x := claims.get(key)) or not (x[2] or x[1] < time.time()):
+                return None, False
+            del claims[key]
+            return None, True
+        self.update(func)
+
+    def claims(self):
+        return [(k, *v) for k, v in sorted(self.update(lambda claims: (claims, False)).items())]
+
+
+def open_store(path=CLAIMS_DB):
+    # By the extension; .json for FileClaimStore, otherwise SQLite.
+    return FileClaimStore(path) if path.endswith('.json') else SqliteClaimStore(path)
+
+
+class Claims:
+    '''Claims of a worker; e.g.
+        claims = Claims(open_store('/mnt/shared/claims.sqlite'))
+        keepalive = asyncio.create_task(claims.keepalive())
+        async for name in claims.filter('EC379Fxxyyzz', names): # Claimed one by one, as the caller iterates.
+            await claims.release(claims.key('EC379Fxxyyzz', name), done=await fetch(name))
+        keepalive.cancel()
+        await claims.release_all()
+    Calls to the store (blocking, e.g. on a lock of the shared disk) run in a thread, one at a time, so that the event
+    loop keeps serving the BLE link.
+    '''
+    def __init__(self, store, owner=None, ttl=LEASE_TTL):
+        self.store = store
+        self.owner = owner or f'{socket.gethostname()}:{os.getpid()}:{os.urandom(3).hex()}' # Unique per worker.
+        self.ttl = ttl
+        self.held = set()
+        self.skipped = 0 # Names not claimed by the last filter().
+        self.lock = asyncio.Lock()
+
+    @staticmethod
+    def key(device_id, name):
+        return f'{device_id}/{name}'
+
+    async def call(self, method, *args):
+        async with self.lock:
+            return await asyncio.get_running_loop().run_in_executor(None, functools.partial(method, *args))
+
+    async def claim(self, key):
+        if await self.call(self.store.claim, key, self.owner, self.ttl):
+            self.held.add(key)
+            return True
+        return False
+
+    async def release(self, key, done=False):
+        self.held.discard(key)
+        await self.call(self.store.release, key, self.owner, done)
+
+    async def release_all(self):
+        # Claims not done are given back at the end of a session, e.g. on disconnection.
+        for key in list(self.held):
+            await self.release(key)
+
+    async def reopen(self, key):
+        await self.call(self.store.reopen, key)
+
+    async def filter(self, device_id, names):
+        '''Yield the names claimed; a name is claimed just before it is yielded.  The others are counted in skipped.
+        '''
+        self.skipped = 0
+        for name in names:
+            if await self.claim(self.key(device_id, name)):
+                yield name
+            else:
+                self.skipped += 1
+
+    async def keepalive(self):
+        # Renew the leases at a third of the TTL; a lost claim is dropped (the other worker fetches the ride, too).
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            for key in list(self.held):
+                if not await self.call(self.store.renew, key, self.owner, self.ttl):
+                    print(f'Claim lost: {key}')
+                    self.held.discard(key)
+
+
+def main(argv):
+    command = argv[1] if len(argv) > 1 else 'list'
+    if command == 'list':
+        now = time.time()
+        for key, owner, expires, done in open_store(argv[2] if len(argv) > 2 else CLAIMS_DB).claims():
+            state = 'done' if done else 'expired' if expires < now else f'{expires - now:.0f} s left'
+            print(f'{key}\t{owner}\t{state}')
+    elif command == 'reset':
+        open_store(argv[3] if len(argv) > 3 else CLAIMS_DB).reset(argv[2])
+    else:
+        print(f"Unknown command: {command}")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
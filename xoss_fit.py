@@ -0,0 +1,685 @@
+# (c) 2024-2025 ekspla.
+# MIT License.  https://github.com/ekspla/xoss_sync
+#
+# Helpers for FIT files, shared by xoss_sync.py (CPython) and mpy_xoss_sync.py (MicroPython).
+# Only the subset of Python that works on both is used here.
+#
+# FIT file = header (12 or 14 bytes), data records, and CRC16 (little endian) of the preceding bytes.
+# Header = header size, protocol version, profile version (2), data size (4), '.FIT', and CRC16 of the header (2, optional).
+# Record = header byte, and definition (reserved, architecture, global message number (2), fields) or data message.
+
+from array import array
+import struct
+import os
+
+
+def make_crc16_arc_table():
+    table = array('H', bytearray(512))
+    for i in range(256):
+        x = i
+        for _ in range(8):
+            x = (x >> 1) ^ 0xa001 if x & 0x0001 else x >> 1
+        table[i] = x
+    return table
+
+CRC16_ARC_TBL = make_crc16_arc_table()
+
+def crc16_arc(data, crc=0):
+    '''crc16/arc (table-driven); pass the previous crc to continue.
+    XOSS uses CRC16/ARC instead of CRC16/XMODEM; so does FIT.
+    '''
+    tbl = CRC16_ARC_TBL
+    for x in data:
+        crc = (crc >> 8) ^ tbl[(crc ^ x) & 0xff]
+    return crc
+
+
+class FitValidator:
+    '''Check header, data size and CRC of a FIT file incrementally, as chunks arrive.
+    Call write(chunk) for each chunk and close() at the end; then see ok and error.
+    crc16(data, crc) may be replaced by a faster one (e.g. viper in MicroPython).
+    '''
+    def __init__(self, crc16=crc16_arc):
+        self.crc16 = crc16
+        self.header = bytearray()
+        self.size = 0 # Bytes received.
+        self.expected = None # File size from the header.
+        self.crc = 0
+        self.error = None
+        self.ok = False
+
+    def write(self, chunk):
+        if self.error is not None:
+            return
+        self.crc = self.crc16(chunk, self.crc)
+        self.size += len(chunk)
+        if self.expected is None:
+            self.header.extend(chunk[:14 - len(self.header)])
+            if len(self.header) == 14: # The shortest FIT file is 14 bytes.
+                self.check_header()
+        elif self.size > self.expected:
+            self.error = f'{self.size}(file size) > {self.expected}(header)'
+
+    def check_header(self):
+        header = self.header
+        header_size = header[0]
+        if header_size not in (12, 14) or header[8:12] != b'.FIT':
+            self.error = 'not a FIT file.'
+            return
+        self.expected = header_size + int.from_bytes(header[4:8], 'little') + 2
+        if header_size == 14 and (crc := int.from_bytes(header[12:14], 'little')) != 0:
+            if self.crc16(header[:12], 0) != crc:
+                self.error = 'header CRC error.'
+
+    def close(self, ok=True):
+        if self.error is None:
+            if self.expected is None:
+                self.error = 'truncated header.'
+            elif self.size != self.expected:
+                self.error = f'{self.size}(file size) != {self.expected}(header)'
+            elif self.crc != 0: # CRC of data followed by its CRC (little endian) is zero.
+                self.error = 'file CRC error.'
+        self.ok = self.error is None
+        return self.ok
+
+
+def is_compressed(path):
+    # A FIT file compressed in the archive of xoss_archive.py (NAME.fit.gz or NAME.fit.zst).
+    return path.endswith('.gz') or path.endswith('.zst')
+
+
+def open_fit(path):
+    '''A FIT file, plain or compressed (see FrameReader in xoss_archive.py), as a binary file.
+    '''
+    if is_compressed(path):
+        from xoss_archive import FrameReader
+        return FrameReader(path)
+    return open(path, 'rb')
+
+
+def check_fit_file(path, chunk_size=4096):
+    '''Check header, size and CRC of a FIT file; raises ValueError if it is truncated or corrupt.
+    '''
+    validator = FitValidator()
+    buf = bytearray(chunk_size)
+    mv = memoryview(buf)
+    with open_fit(path) as f:
+        while (n := f.readinto(buf)):
+            validator.write(mv[:n])
+    if not validator.close():
+        raise ValueError(f'{path}: {validator.error}')
+    return f'{path}: OK'
+
+
+FIT_EPOCH = 631065600 # 1989-12-31T00:00:00Z in unix time.
+SEMICIRCLES = 180 / 2**31 # Degrees per semicircle.
+NAN = float('nan')
+
+# Base type (lower 5 bits) to struct format of a single value.  Strings, byte arrays and arrays of values are skipped.
+BASE_TYPE_FMT = ('B', 'b', 'B', 'h', 'H', 'i', 'I', None, 'f', 'd', 'B', 'H', 'I', None, 'q', 'Q', 'Q')
+try:
+    SKIP_FMT = 'x' if struct.calcsize('<2x') == 2 else 's'
+except Exception:
+    SKIP_FMT = 's' # MicroPython; skipped fields are unpacked as bytes.
+
+
+class FitDecoder:
+    '''Decode FIT data messages incrementally, as chunks arrive (works as a sink, see fetch_to()).
+    Only the current definition messages and a partial record are kept in memory.  The handler has
+        wanted: {global message number: field numbers}, messages to decode, and
+        message(mesg_num, nums, values, timestamp), called for each data message of them;
+            nums/values are the field numbers (None for a skipped field) and the values in the record.
+    A struct format is made once per definition message, so that a record is unpacked by a single call.
+    '''
+    def __init__(self, handler):
+        self.handler = handler
+        self.definitions = {} # Local message type: (global message number, record size, format, field numbers, index of timestamp).
+        self.buf = bytearray()
+        self.header_size = None
+        self.data_left = 0 # Bytes of records not yet decoded.
+        self.timestamp = 0 # The last timestamp (FIT epoch) for compressed timestamp headers.
+        self.error = None
+        self.ok = False
+
+    def write(self, chunk):
+        if self.error is not None:
+            return
+        buf = self.buf
+        buf.extend(chunk)
+        pos = 0
+        if self.header_size is None:
+            if len(buf) < 12:
+                return
+            if buf[0] not in (12, 14) or buf[8:12] != b'.FIT':
+                self.error = 'not a FIT file.'
+                return
+            self.header_size = buf[0]
+            self.data_left = int.from_bytes(buf[4:8], 'little')
+        if self.header_size > 0:
+            if len(buf) < self.header_size:
+                return
+            pos, self.header_size = self.header_size, 0
+        try:
+            pos = self.decode(buf, pos)
+        except Exception as e: # Broken definition or record.
+            self.error = f'decode error: {e}'
+        if pos:
+            self.buf = buf[pos:] # No slice deletion of bytearray in MicroPython.
+
+    def decode(self, buf, pos):
+        definitions = self.definitions
+        handler = self.handler
+        unpack_from = struct.unpack_from
+        end = pos + min(self.data_left, len(buf) - pos)
+        start = pos
+        while pos < end:
+            h = buf[pos]
+            if h & 0x80: # Compressed timestamp header; a data message of local type 0-3.
+                mesg_num, size, fmt, nums, _ = definitions[(h >> 5) & 0x03]
+                if pos + size > end:
+                    break
+                offset = h & 0x1f
+                timestamp = (self.timestamp & ~0x1f) + offset
+                if offset < self.timestamp & 0x1f:
+                    timestamp += 0x20
+                self.timestamp = timestamp
+                if fmt is not None and mesg_num in handler.wanted:
+                    handler.message(mesg_num, nums, unpack_from(fmt, buf, pos + 1), timestamp)
+            elif h & 0x40: # Definition message.
+                if pos + 6 > end:
+                    break
+                n = pos + 6 + 3 * buf[pos + 5]
+                if h & 0x20: # Developer data fields.
+                    if n + 1 > end:
+                        break
+                    n += 1 + 3 * buf[n]
+                if n > end:
+                    break
+                definitions[h & 0x0f] = self.define(buf, pos)
+                size = n - pos
+            else: # Data message.
+                mesg_num, size, fmt, nums, i = definitions[h & 0x0f]
+                if pos + size > end:
+                    break
+                if fmt is not None:
+                    values = unpack_from(fmt, buf, pos + 1)
+                    if i is not None and values[i] != 0xffffffff:
+                        self.timestamp = values[i]
+                    if mesg_num in handler.wanted:
+                        handler.message(mesg_num, nums, values, self.timestamp)
+            pos += size
+        self.data_left -= pos - start
+        return pos
+
+    def define(self, buf, pos):
+        endian = '>' if buf[pos + 2] else '<'
+        mesg_num = struct.unpack_from(endian + 'H', buf, pos + 3)[0]
+        wanted = self.handler.wanted.get(mesg_num, ())
+        n_fields = buf[pos + 5]
+        size = 1
+        fmt = endian
+        nums = []
+        skip = 0
+        for i in range(pos + 6, pos + 6 + 3 * n_fields, 3):
+            num, field_size, base_type = buf[i], buf[i + 1], buf[i + 2] & 0x1f
+            size += field_size
+            code = BASE_TYPE_FMT[base_type] if base_type < len(BASE_TYPE_FMT) else None
+            # The timestamp is needed for compressed timestamp headers, even in messages not wanted.
+            if (num in wanted or num == 253) and code is not None and struct.calcsize(code) == field_size:
+                if skip:
+                    fmt += f'{skip}{SKIP_FMT}'
+                    if SKIP_FMT == 's': nums.append(None)
+                    skip = 0
+                fmt += code
+                nums.append(num)
+            else:
+                skip += field_size
+        if buf[pos] & 0x20: # Developer data fields are skipped.
+            i = pos + 6 + 3 * n_fields
+            size += sum(buf[j + 1] for j in range(i + 1, i + 1 + 3 * buf[i], 3))
+        if not nums:
+            return (mesg_num, size, None, None, None)
+        return (mesg_num, size, fmt, tuple(nums), nums.index(253) if 253 in nums else None)
+
+    def close(self, ok=True):
+        if self.error is None and ok and (self.header_size is None or self.data_left):
+            self.error = 'truncated records.'
+        self.ok = ok and self.error is None
+        return self.ok
+
+
+# Columns of record messages (global message number 20): name, typecode, field numbers (the former preferred),
+# scale, offset and invalid values of the fields.  A scaled column is in float (nan if invalid); others are raw (invalid kept).
+RECORD_COLUMNS = (
+    ('lat', 'd', (0,), 1 / SEMICIRCLES, 0, (0x7fffffff,)), # Degrees.
+    ('lon', 'd', (1,), 1 / SEMICIRCLES, 0, (0x7fffffff,)),
+    ('altitude', 'f', (78, 2), 5, 500, (0xffffffff, 0xffff)), # m; enhanced_altitude or altitude.
+    ('speed', 'f', (73, 6), 1000, 0, (0xffffffff, 0xffff)), # m/s; enhanced_speed or speed.
+    ('distance', 'f', (5,), 100, 0, (0xffffffff,)), # m.
+    ('heart_rate', 'B', (3,), None, 0, (0xff,)), # bpm.
+    ('cadence', 'B', (4,), None, 0, (0xff,)), # rpm.
+    ('power', 'H', (7,), None, 0, (0xffff,)), # W.
+)
+
+
+def record_layout(nums):
+    '''Where to find each of RECORD_COLUMNS in a record of the field numbers (nums);
+    [([(index in values, invalid), ...], scale, offset, missing value), ...].
+    '''
+    return [([(nums.index(num), invalid) for num, invalid in zip(fields, invalids) if num in nums],
+        scale, offset, invalids[0] if scale is None else NAN) for _, _, fields, scale, offset, invalids in RECORD_COLUMNS]
+
+
+class RideColumns:
+    '''Record messages of a ride in compact arrays, one per column; time is in unix time.
+    Use as the handler of FitDecoder.
+    '''
+    wanted = {20: set(num for column in RECORD_COLUMNS for num in column[2])}
+
+    def __init__(self):
+        self.time = array('q')
+        self.columns = {'time': self.time}
+        for column in RECORD_COLUMNS:
+            self.columns[column[0]] = array(column[1])
+        self.layouts = {} # Field numbers in a record: [(column, [(index in values, invalid), ...], scale, offset, missing), ...].
+
+    def __len__(self):
+        return len(self.time)
+
+    def layout(self, nums):
+        layout = self.layouts[nums] = [(self.columns[column[0]], ) + tuple(x) for column, x in zip(RECORD_COLUMNS, record_layout(nums))]
+        return layout
+
+    def message(self, mesg_num, nums, values, timestamp):
+        self.time.append(timestamp + FIT_EPOCH)
+        for column, found, scale, offset, missing in self.layouts.get(nums) or self.layout(nums):
+            for i, invalid in found:
+                if (value := values[i]) != invalid:
+                    column.append(value if scale is None else value / scale - offset)
+                    break
+            else:
+                column.append(missing)
+
+    def save_npz(self, path):
+        '''Save the columns to a compressed .npz file (CPython with NumPy).
+        '''
+        import numpy as np
+        with open(part := path + '.part', 'wb') as f:
+            np.savez_compressed(f, **{name: np.frombuffer(column, dtype=column.typecode)
+                for name, column in self.columns.items()})
+        os.replace(part, path)
+
+
+GPX_HEAD = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<gpx version="1.1" creator="xoss_sync" xmlns="http://www.topografix.com/GPX/1/1" '
+    'xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1">\n<trk><trkseg>\n')
+GPX_TAIL = '</trkseg></trk>\n</gpx>\n'
+CSV_HEAD = 'time,' + ','.join(x[0] for x in RECORD_COLUMNS) + '\n'
+CSV_FMT = ('{:.7f}', '{:.7f}', '{:.1f}', '{:.3f}', '{:.2f}', '{}', '{}', '{}') # Of RECORD_COLUMNS.
+
+
+def iso_time(t):
+    '''Unix time to ISO 8601 in UTC, e.g. 2024-07-15T06:23:36Z; time.gmtime() is not used, its epoch differs by port.
+    '''
+    days, t = divmod(t, 86400)
+    z = days + 719468 # Days from 0000-03-01; see, http://howardhinnant.github.io/date_algorithms.html
+    era = z // 146097
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    day = doy - (153 * mp + 2) // 5 + 1
+    month = mp + 3 if mp < 10 else mp - 9
+    year = yoe + era * 400 + (month <= 2)
+    return f'{year:04d}-{month:02d}-{day:02d}T{t // 3600:02d}:{t // 60 % 60:02d}:{t % 60:02d}Z'
+
+
+class TrackWriter:
+    '''Convert FIT records to a GPX or CSV track (by the extension of path) as chunks arrive; a sink like FileSink.
+    Only the current definition messages and a small output buffer are kept in memory.  The track is written to
+    path + '.part', and renamed to path on success; so it is ready at the same moment as the FIT file.
+    '''
+    wanted = RideColumns.wanted
+
+    def __init__(self, path, buffer_size=2048):
+        self.path = path
+        self.gpx = path.endswith('.gpx')
+        self.buffer_size = buffer_size
+        self.buf = []
+        self.buffered = 0
+        self.layouts = {}
+        self.decoder = FitDecoder(self)
+        with open(path + '.part', 'w') as f:
+            f.write(GPX_HEAD if self.gpx else CSV_HEAD)
+
+    def write(self, chunk):
+        self.decoder.write(chunk)
+
+    def message(self, mesg_num, nums, values, timestamp):
+        row = []
+        for found, scale, offset, _ in self.layouts.get(nums) or self.layouts.setdefault(nums, record_layout(nums)):
+            for i, invalid in found:
+                if (value := values[i]) != invalid:
+                    row.append(value if scale is None else value / scale - offset)
+                    break
+            else:
+                row.append(None)
+        time = iso_time(timestamp + FIT_EPOCH)
+        if self.gpx:
+            lat, lon, altitude, _, _, heart_rate, cadence, power = row
+            if lat is None or lon is None: # No fix.
+                return
+            line = f'<trkpt lat="{lat:.7f}" lon="{lon:.7f}">'
+            if altitude is not None:
+                line += f'<ele>{altitude:.1f}</ele>'
+            line += f'<time>{time}</time>'
+            if heart_rate is not None or cadence is not None or power is not None:
+                line += '<extensions>'
+                if heart_rate is not None or cadence is not None:
+                    line += '<gpxtpx:TrackPointExtension>'
+                    if heart_rate is not None: line += f'<gpxtpx:hr>{heart_rate}</gpxtpx:hr>'
+                    if cadence is not None: line += f'<gpxtpx:cad>{cadence}</gpxtpx:cad>'
+                    line += '</gpxtpx:TrackPointExtension>'
+                if power is not None: line += f'<power>{power}</power>'
+                line += '</extensions>'
+            line += '</trkpt>\n'
+        else:
+            line = time + ''.join(',' if x is None else ',' + fmt.format(x) for fmt, x in zip(CSV_FMT, row)) + '\n'
+        self.buf.append(line)
+        self.buffered += len(line)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        with open(self.path + '.part', 'a') as f:
+            f.write(''.join(self.buf))
+        self.buf = []
+        self.buffered = 0
+
+    def close(self, ok=True):
+        part = self.path + '.part'
+        if (ok := self.decoder.close(ok)):
+            if self.gpx: self.buf.append(GPX_TAIL)
+            self.flush()
+            try:
+                os.remove(self.path) # No os.replace() in MicroPython.
+            except OSError:
+                pass
+            os.rename(part, self.path)
+        else:
+            try:
+                os.remove(part)
+            except OSError:
+                pass
+        return ok
+
+
+class RideSummary:
+    '''Start time, duration, distance and ascent of a ride from session messages (from records, if no session);
+    use as the handler of FitDecoder.
+    '''
+    wanted = {18: {253, 2, 7, 8, 9, 22}, 20: {253, 5}}
+
+    def __init__(self):
+        self.sessions = 0
+        self.start = None # Unix time.
+        self.elapsed = self.timer = self.distance = 0.0 # s, s, m.
+        self.ascent = 0 # m.
+        self.first = self.last = None # Timestamps (FIT epoch) and distance of records.
+        self.last_distance = 0.0
+
+    def message(self, mesg_num, nums, values, timestamp):
+        if mesg_num == 20:
+            if self.first is None: self.first = timestamp
+            self.last = timestamp
+            if 5 in nums and (distance := values[nums.index(5)]) != 0xffffffff:
+                self.last_distance = distance / 100
+            return
+        fields = dict(zip(nums, values)) # A few sessions in a file.
+        self.sessions += 1
+        if (start := fields.get(2, 0xffffffff)) != 0xffffffff:
+            start += FIT_EPOCH
+            self.start = start if self.start is None else min(self.start, start)
+        if (x := fields.get(7, 0xffffffff)) != 0xffffffff: self.elapsed += x / 1000
+        if (x := fields.get(8, 0xffffffff)) != 0xffffffff: self.timer += x / 1000
+        if (x := fields.get(9, 0xffffffff)) != 0xffffffff: self.distance += x / 100
+        if (x := fields.get(22, 0xffff)) != 0xffff: self.ascent += x
+
+    def ride(self, name, size=0, sha256=''):
+        '''The summary as a dict; see RideIndex in xoss_archive.py and RideLog.
+        '''
+        if not self.sessions and self.first is not None:
+            self.start = self.first + FIT_EPOCH
+            self.elapsed = self.timer = float(self.last - self.first)
+            self.distance = self.last_distance
+        return {'name': name, 'start': self.start or 0, 'elapsed': self.elapsed, 'timer': self.timer,
+            'distance': self.distance, 'ascent': self.ascent, 'size': size, 'sha256': sha256}
+
+
+def summarize_fit_file(path, chunk_size=4096):
+    '''Summary of a FIT file (see RideSummary.ride()), with its size and SHA-256.
+    '''
+    import hashlib
+    decoder = FitDecoder(summary := RideSummary())
+    sha256 = hashlib.sha256()
+    size = 0
+    with open_fit(path) as f:
+        while (chunk := f.read(chunk_size)):
+            decoder.write(chunk)
+            sha256.update(chunk)
+            size += len(chunk)
+    if not decoder.close():
+        raise ValueError(f'{path}: {decoder.error}')
+    name = path.replace('\\', '/').rsplit('/', 1)[-1]
+    return summary.ride(name.rsplit('.', 1)[0] if is_compressed(name) else name, size, hexlify(sha256.digest()))
+
+
+def hexlify(data):
+    import binascii
+    return binascii.hexlify(data).decode()
+
+
+RIDE_LOG_FMT = '<14sIIIIHI32s' # name, start, elapsed (s), timer (s), distance (cm), ascent (m), size, SHA-256.
+RIDE_LOG_SIZE = struct.calcsize(RIDE_LOG_FMT)
+
+
+class RideLog:
+    '''Summaries of rides in a compact file of fixed-size records (e.g. /sd/rides.bin), for MicroPython;
+    RideIndex in xoss_archive.py is the SQLite version for CPython.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.buf = bytearray(RIDE_LOG_SIZE)
+
+    def records(self):
+        try:
+            f = open(self.path, 'rb')
+        except OSError: # Not yet.
+            return
+        with f:
+            while f.readinto(self.buf) == RIDE_LOG_SIZE:
+                yield struct.unpack(RIDE_LOG_FMT, self.buf)
+
+    def rides(self):
+        for name, start, elapsed, timer, distance, ascent, size, sha256 in self.records():
+            yield {'name': name.rstrip(b'\0').decode() + '.fit', 'start': start, 'elapsed': float(elapsed), 'timer': float(timer),
+                'distance': distance / 100, 'ascent': ascent, 'size': size, 'sha256': hexlify(sha256)}
+
+    def add(self, ride):
+        import binascii
+        record = struct.pack(RIDE_LOG_FMT, ride['name'][:14].encode(), ride['start'], int(ride['elapsed']),
+            int(ride['timer']), round(ride['distance'] * 100), ride['ascent'], ride['size'],
+            binascii.unhexlify(ride['sha256']) if ride['sha256'] else b'')
+        offset = None
+        for i, x in enumerate(self.records()):
+            if x[0] == record[:14]: # Replace the old one.
+                offset = i * RIDE_LOG_SIZE
+        with open(self.path, 'ab' if offset is None else 'r+b') as f:
+            if offset is not None: f.seek(offset)
+            f.write(record)
+
+    def totals(self, since=0, until=0xffffffff):
+        '''Number of rides, distance (m), elapsed time (s) and ascent (m) of rides started in [since, until) in unix time.
+        '''
+        count = distance = elapsed = ascent = 0
+        for x in self.records():
+            if since <= x[1] < until:
+                count += 1
+                elapsed += x[2]
+                distance += x[4]
+                ascent += x[5]
+        return {'count': count, 'distance': distance / 100, 'elapsed': float(elapsed), 'ascent': ascent}
+
+
+def decode_fit_file(path, handler=None, chunk_size=4096):
+    '''Decode a FIT file into the handler (RideColumns by default) and return it.
+    '''
+    decoder = FitDecoder(handler := handler or RideColumns())
+    with open_fit(path) as f:
+        while (chunk := f.read(chunk_size)):
+            decoder.write(chunk)
+    if not decoder.close():
+        raise ValueError(f'{path}: {decoder.error}')
+    return handler
+
+
+def write_ride_cache(path):
+    '''Write the columns of a FIT file to a .npz file next to it, e.g. as a hook in POST_HOOKS of xoss_sync.py.
+    '''
+    stem = path.rsplit('.', 2 if is_compressed(path) else 1)[0]
+    decode_fit_file(path).save_npz(npz := stem + '.npz')
+    return npz
+
+
+def load_ride_cache(path):
+    '''Load the columns saved by save_npz() as a dict of NumPy arrays.
+    '''
+    import numpy as np
+    with np.load(path) as npz:
+        return {name: npz[name] for name in npz.files}
+
+
+def layout_dir(name, layout):
+    '''Sub-directory of a file by the timestamp in its name (YYYYMMDDhhmmss.fit) and the layout, e.g.
+    '{year}/{month}' -> '2024/07'; '' for the flat layout and for the other names.
+    '''
+    if not layout or len(name) < 14 or not name[:14].isdigit():
+        return ''
+    return layout.format(year=name[:4], month=name[4:6], day=name[6:8])
+
+
+def makedirs(path):
+    # os.makedirs() is not in MicroPython.
+    head = ''
+    for i, part in enumerate(path.split('/')):
+        head = head + '/' + part if i else part
+        if head and head != '.':
+            try:
+                os.mkdir(head)
+            except OSError: # Exists.
+                pass
+
+
+def is_dir(path):
+    return os.stat(path)[0] & 0x4000 != 0
+
+
+def iter_dir(directory):
+    # Names one by one by os.ilistdir() on MicroPython, instead of a list of all the names.
+    if hasattr(os, 'ilistdir'):
+        for x in os.ilistdir(directory):
+            yield x[0]
+    else:
+        yield from os.listdir(directory)
+
+
+class Storage:
+    '''Files under root in sub-directories by the timestamp in their names (layout, e.g. '{year}/{month}').
+    Existence is checked by os.stat() of the path by the layout (then of the flat one); no names are kept in memory,
+    so that the heap does not grow with the number of rides (e.g. on ESP32).
+    A file is written as path + '.part' and renamed by commit(); a crash leaves only the .part (see, recover()).
+    Directories are synced in a batch by sync(), e.g. at the end of a session.
+    '''
+    def __init__(self, root='.', layout=''):
+        self.root = root.rstrip('/') or '/'
+        self.layout = layout
+        self.depth = layout.count('/') + 1 if layout else 0
+        self.dirty = set() # Directories to be synced.
+
+    def layout_path(self, name):
+        return f'{self.root}/{sub}/{name}' if (sub := layout_dir(name, self.layout)) else f'{self.root}/{name}'
+
+    def exists(self, name):
+        return self.existing(name) is not None
+
+    def existing(self, name):
+        # Path of the file, or None; files in the layout take precedence.
+        for path in (self.layout_path(name), f'{self.root}/{name}'):
+            try:
+                os.stat(path)
+                return path
+            except OSError:
+                pass
+        return None
+
+    def path(self, name):
+        '''Path of the file; the existing one, or a new one by the layout (the directory is created).
+        '''
+        if (path := self.existing(name)) is not None:
+            return path
+        if (sub := layout_dir(name, self.layout)):
+            makedirs(f'{self.root}/{sub}')
+        return self.layout_path(name)
+
+    def commit(self, name):
+        # Rename the .part of the file into place.
+        path = self.path(name)
+        try:
+            os.remove(path) # No os.replace() in MicroPython.
+        except OSError:
+            pass
+        os.rename(path + '.part', path)
+        self.committed(name, path)
+
+    def committed(self, name, path):
+        # Note a file renamed into place (e.g. by FileSink of xoss_sync.py).
+        self.dirty.add(path.rsplit('/', 1)[0] if '/' in path else '.')
+
+    def recover(self):
+        '''Remove .part files left by an interrupted session; returns their number.
+        '''
+        parts = []
+        self.find_parts(self.root, 0, parts)
+        for path in parts:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return len(parts)
+
+    def find_parts(self, directory, depth, parts):
+        for name in iter_dir(directory):
+            path = f'{directory}/{name}'
+            if name.endswith('.part'):
+                parts.append(path)
+            elif depth < self.depth and name.isdigit() and is_dir(path): # Only sub-directories of the layout.
+                self.find_parts(path, depth + 1, parts)
+
+    def sync(self):
+        '''Flush the directories changed since the last sync, in a batch.
+        '''
+        if not self.dirty:
+            return
+        if hasattr(os, 'fsync'):
+            for directory in self.dirty:
+                try:
+                    fd = os.open(directory, os.O_RDONLY)
+                except OSError: # e.g. directories on Windows.
+                    continue
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+        elif hasattr(os, 'sync'): # MicroPython.
+            os.sync()
+        self.dirty = set()
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+#coding:utf-8
+#
+# (c) 2024-2025 ekspla.
+# MIT License.  https://github.com/ekspla/xoss_sync
+#
+# A local gateway which owns the BLE connections to devices and serves requests of the other tools, so that
+# repeated operations pay no scan/connect cost.
+#
+# Usage: python xoss_gateway.py serve                          # Run the gateway.
+#        python xoss_gateway.py list [ADDRESS]                 # Names of the rides on the device.
+#        python xoss_gateway.py fetch NAME [ADDRESS]           # Fetch a file to the current directory.
+#        python xoss_gateway.py send PATH [ADDRESS]            # Send a file (e.g. Setting.json).
+#        python xoss_gateway.py diskspace|time_set [ADDRESS]
+#     The first device found is used if no address is given.
+#
+# Protocol (Unix socket, or localhost TCP on Windows): a request is a JSON line, e.g. {"op": "fetch", "name": "...",
+# "address": "..."}; "send" is followed by "size" bytes of the file.  A response is a JSON line; "fetch" is streamed as
+# a header line, frames of 4-byte length (big endian) and data, a zero length, and a trailer line.
+
+import asyncio
+import json
+import os
+import sys
+import time
+from xoss_sync import (BluetoothFileTransfer, BytesSink, TransferError, TARGET_NAME, CTL_CHARACTERISTIC_UUID,
+    TX_CHARACTERISTIC_UUID, VALUE_IDLE, VALUE_STATUS, AWAIT_NEW_DATA, FitValidator)
+
+GATEWAY_PATH = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or '/tmp', 'xoss_gateway.sock') # Unix socket; owner only.
+GATEWAY_PORT = 8765 # localhost TCP, where Unix sockets are not available.
+IDLE_TIMEOUT = 600 # Disconnect a device after this idle time in sec.
+KEEPALIVE = 30 # Check idle connections at this interval in sec.
+
+
+class Session:
+    '''A connected device, kept in the IDLE state between requests.
+    '''
+    def __init__(self, address, adapter=None):
+        self.address = address
+        self.transfer = BluetoothFileTransfer(adapter=adapter)
+        self.client = None
+        self.lock = asyncio.Lock() # One operation at a time on a device.
+        self.used = time.monotonic()
+
+    @property
+    def is_connected(self):
+        return self.client is not None and self.client.is_connected
+
+    async def open(self, device=None):
+        transfer = self.transfer
+        if device is None:
+            device = await transfer.discover_device(TARGET_NAME, (self.address, ))
+        if device is None:
+            raise TransferError(f'{self.address} not found.')
+        await transfer.link_policy.prepare()
+        self.client = transfer.make_client(device)
+        try:
+            await self.client.connect()
+        finally:
+            await transfer.link_policy.restore() # Used on connecting only; not kept while the gateway runs.
+        print(f"Connected to {device.name} - {device.address}")
+        transfer.device_id = device.address.replace(':', '')
+        await transfer.set_link(self.client)
+        await transfer.start_notify(self.client, CTL_CHARACTERISTIC_UUID)
+        await transfer.start_notify(self.client, TX_CHARACTERISTIC_UUID)
+
+    async def ping(self):
+        # Keep the device awake and check that it is IDLE.
+        transfer = self.transfer
+        transfer.notification_data = AWAIT_NEW_DATA
+        transfer.is_download = transfer.is_upload = False
+        await transfer.send_cmd(self.client, CTL_CHARACTERISTIC_UUID, VALUE_STATUS, 0.1)
+        await transfer.wait_until_data(self.client)
+        return transfer.notification_data == VALUE_IDLE
+
+    async def close(self):
+        if self.is_connected:
+            try:
+                await self.client.disconnect()
+            except Exception as e:
+                print(f"Failed to disconnect: {e}")
+        self.client = None
+
+
+class DevicePool:
+    '''Connections to devices keyed by address; made on the first request and kept until IDLE_TIMEOUT.
+    '''
+    def __init__(self, adapter=None):
+        self.adapter = adapter
+        self.sessions = {}
+        self.default = None # Address of the device found by scan, for requests without an address.
+
+    async def session(self, address=None):
+        device = None
+        if address is None and (address := self.default) is None:
+            device = await BluetoothFileTransfer(adapter=self.adapter).discover_device(TARGET_NAME)
+            if device is None:
+                raise TransferError('no device found.')
+            address = self.default = device.address
+        if (session := self.sessions.get(address)) is None:
+            session = self.sessions[address] = Session(address, self.adapter)
+        async with session.lock:
+            if not session.is_connected:
+                await session.open(device)
+        return session
+
+    async def keepalive(self):
+        while True:
+            await asyncio.sleep(KEEPALIVE)
+            for address, session in list(self.sessions.items()):
+                if session.lock.locked():
+                    continue
+                async with session.lock:
+                    if not session.is_connected:
+                        del self.sessions[address] # Reconnected on the next request.
+                    elif time.monotonic() - session.used > IDLE_TIMEOUT:
+                        print(f"Disconnect idle {address}")
+                        await session.close()
+                        del self.sessions[address]
+                    elif not await session.ping():
+                        await session.transfer.get_idle_status(session.client)
+
+    async def close(self):
+        for session in self.sessions.values():
+            await session.close()
+        self.sessions.clear()
+
+
+class Gateway:
+    '''Serve list, fetch, send, diskspace and time_set over a Unix socket (or localhost TCP).
+    '''
+    def __init__(self, pool=None):
+        self.pool = pool or DevicePool()
+
+    async def serve(self, path=GATEWAY_PATH, port=GATEWAY_PORT):
+        if hasattr(asyncio, 'start_unix_server'):
+            if os.path.exists(path): os.remove(path) # Left by the last run.
+            umask = os.umask(0o177) # Created as 0600; other users may not drive the devices.
+            try:
+                server = await asyncio.start_unix_server(self.handle, path)
+            finally:
+                os.umask(umask)
+        else:
+            server = await asyncio.start_server(self.handle, '127.0.0.1', port)
+        print(f"Gateway: {path if hasattr(asyncio, 'start_unix_server') else port}")
+        keepalive = asyncio.create_task(self.pool.keepalive())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            keepalive.cancel()
+            await self.pool.close()
+
+    async def handle(self, reader, writer):
+        try:
+            while (line := await reader.readline()):
+                try:
+                    await self.dispatch(json.loads(line), reader, writer) # ValueError on a malformed line.
+                except (TransferError, OSError, KeyError, TypeError, ValueError, asyncio.TimeoutError) as e:
+                    await self.reply(writer, {'ok': False, 'error': str(e) or e.__class__.__name__})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def reply(self, writer, response):
+        writer.write(json.dumps(response).encode() + b'\n')
+        await writer.drain()
+
+    async def dispatch(self, request, reader, writer):
+        op = request['op']
+        if op == 'send': # Read the file first; the stream has to be consumed even if the device fails.
+            data = await reader.readexactly(request['size'])
+        session = await self.pool.session(request.get('address'))
+        async with session.lock:
+            transfer, client = session.transfer, session.client
+            if op == 'fetch':
+                await self.fetch(transfer, client, request['name'], writer)
+            elif op == 'list':
+                name = request.get('name', 'filelist.txt') # The name may be 'workouts.json' on new devices.
+                if not await transfer.fetch_to(client, name, sink := BytesSink()):
+                    raise TransferError(f'fetch {name} failed.')
+                fit_files = transfer.parse_fit_filenames(sink.getvalue().decode(), name.endswith('.json'))
+                await self.reply(writer, {'ok': True, 'address': session.address, 'files': sorted(fit_files)})
+            elif op == 'send':
+                ok = await transfer.send_file(client, os.path.basename(request['name']), data)
+                await self.reply(writer, {'ok': ok})
+            elif op == 'diskspace':
+                diskspace = await transfer.read_diskspace(client)
+                await self.reply(writer, {'ok': diskspace is not None, 'diskspace': diskspace})
+            elif op == 'time_set':
+                await transfer.time_set(client)
+                await self.reply(writer, {'ok': True})
+            else:
+                raise ValueError(f'unknown op: {op}')
+            session.used = time.monotonic()
+
+    async def fetch(self, transfer, client, name, writer):
+        validator = FitValidator() if name.endswith('.fit') else None
+        await self.reply(writer, {'ok': True, 'stream': True})
+        response = {'ok': False}
+        chunks = transfer.stream_file(client, name)
+        try:
+            try:
+                async for chunk in chunks:
+                    if validator: validator.write(chunk)
+                    writer.write(len(chunk).to_bytes(4, 'big') + chunk)
+                    await writer.drain()
+            finally:
+                await chunks.aclose() # CAN if the client goes away.
+            if validator and not validator.close():
+                response['error'] = validator.error
+            else:
+                response = {'ok': True, 'size': transfer.data_received}
+        except TransferError as e:
+            response['error'] = str(e)
+        writer.write(bytes(4))
+        await self.reply(writer, response)
+
+
+class GatewayClient:
+    '''Requests to the gateway; e.g.
+        async with GatewayClient() as gateway:
+            print(await gateway.call('diskspace'))
+            async for chunk in gateway.fetch('20240715062336.fit'): ...
+    '''
+    def __init__(self, path=GATEWAY_PATH, port=GATEWAY_PORT, address=None):
+        self.path = path
+        self.port = port
+        self.address = address # Of the device; None for the default one.
+        self.reader = self.writer = None
+
+    async def __aenter__(self):
+        if hasattr(asyncio, 'open_unix_connection'):
+            self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+        else:
+            self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+        return self
+
+    async def __aexit__(self, *args):
+        self.writer.close()
+
+    async def request(self, op, data=None, **kwargs):
+        if self.address is not None: kwargs.setdefault('address', self.address)
+        self.writer.write(json.dumps({'op': op, **kwargs}).encode() + b'\n')
+        if data is not None:
+            self.writer.write(data)
+        await self.writer.drain()
+        return json.loads(await self.reader.readline())
+
+    async def call(self, op, **kwargs):
+        return await self.request(op, **kwargs)
+
+    async def send(self, name, data):
+        return await self.request('send', data, name=name, size=len(data))
+
+    async def fetch(self, name):
+        '''Yield chunks of the file while the device sends it; raises TransferError on failure.
+        '''
+        if not (response := await self.request('fetch', name=name))['ok']:
+            raise TransferError(response.get('error'))
+        while (n := int.from_bytes(await self.reader.readexactly(4), 'big')):
+            yield await self.reader.readexactly(n)
+        if not (response := json.loads(await self.reader.readline()))['ok']:
+            raise TransferError(response.get('error'))
+
+
+async def main(argv):
+    command = argv[1] if len(argv) > 1 else 'serve'
+    if command == 'serve':
+        return await Gateway().serve()
+    args = argv[2:]
+    address = args.pop() if len(args) > (1 if command in ('fetch', 'send') else 0) else None
+    async with GatewayClient(address=address) as gateway:
+        if command == 'fetch':
+            with open(args[0] + '.part', 'wb') as f:
+                async for chunk in gateway.fetch(args[0]):
+                    f.write(chunk)
+            os.replace(args[0] + '.part', args[0])
+            print(f"Fetched {args[0]}")
+        elif command == 'send':
+            with open(args[0], 'rb') as f:
+                print(await gateway.send(os.path.basename(args[0]), f.read()))
+        else:
+            print(await gateway.call(command))
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main(sys.argv))
+    except TransferError as e:
+        print(f"Error: {e}")
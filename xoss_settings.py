@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+#coding:utf-8
+#
+# (c) 2024-2025 ekspla.
+# MIT License.  https://github.com/ekspla/xoss_sync
+#
+# Settings of devices (Setting.json) as dicts; fetched once and cached per device, patched, and uploaded from memory
+# only if the content differs.
+#
+# Usage: python xoss_settings.py show [ADDRESS]                      # Settings of the device.
+#        python xoss_settings.py patch '{"key": value}' [ADDRESS ...]  # Or a JSON file; to all devices found if no address.
+#     A patch is a JSON merge patch (RFC 7386); null removes the key.
+
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import time
+from xoss_sync import BytesSink, TransferError, AdapterScheduler, TARGET_NAME, FILEPATH
+
+SETTINGS_DIR = 'settings' # Cache of the settings, e.g. settings/EC379Fxxyyzz_Setting.json.
+SETTINGS_MAX_AGE = 24 * 3600 # Fetch again if the cache is older than this in sec (e.g. changed on the device).
+
+
+def canonical(settings):
+    # Key order and white spaces do not matter in comparison.
+    return json.dumps(settings, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def digest(settings):
+    return hashlib.sha256(canonical(settings)).hexdigest()
+
+
+def merge_patch(target, patch):
+    '''Apply a JSON merge patch (RFC 7386) to target in place; returns target.
+    '''
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge_patch(target[key], value)
+        else:
+            target[key] = value
+    return target
+
+
+class DeviceSettings:
+    '''Settings of a connected device; e.g.
+        settings = DeviceSettings(transfer, client)
+        await settings.load()
+        settings.patch({'backlight': 1})
+        await settings.save() # No upload if nothing changed.
+    '''
+    def __init__(self, transfer, client, name=FILEPATH, cache_dir=SETTINGS_DIR):
+        self.transfer = transfer
+        self.client = client
+        self.name = name # 'settings.json' on some devices.
+        self.cache_path = os.path.join(cache_dir, f'{transfer.device_id or "unknown"}_{name}')
+        self.settings = None
+        self.sha256 = None # Of the settings on the device.
+
+    async def load(self, refresh=False):
+        if not refresh and self.read_cache():
+            return self.settings
+        if not await self.transfer.fetch_to(self.client, self.name, sink := BytesSink()):
+            raise TransferError(f'fetch {self.name} failed.')
+        self.settings = json.loads(sink.getvalue().decode('utf-8'))
+        self.sha256 = digest(self.settings)
+        self.write_cache(sink.getvalue())
+        return self.settings
+
+    def read_cache(self):
+        try:
+            if time.time() - os.path.getmtime(self.cache_path) > SETTINGS_MAX_AGE:
+                return False
+            with open(self.cache_path, 'rb') as f:
+                self.settings = json.loads(f.read().decode('utf-8'))
+        except (OSError, ValueError):
+            return False
+        self.sha256 = digest(self.settings)
+        print(f"Settings from cache: {self.cache_path}")
+        return True
+
+    def write_cache(self, data):
+        os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+        with open(self.cache_path + '.part', 'wb') as f:
+            f.write(data)
+        os.replace(self.cache_path + '.part', self.cache_path)
+
+    def patch(self, patch):
+        merge_patch(self.settings, patch)
+        return self.changed
+
+    @property
+    def changed(self):
+        return digest(self.settings) != self.sha256
+
+    async def save(self):
+        '''Upload the settings if they differ from those on the device; returns True if the device is up to date.
+        '''
+        if not self.changed:
+            print(f"Settings unchanged: {self.name}")
+            return True
+        # The key order of the device is kept.
+        data = json.dumps(self.settings, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        if not await self.transfer.send_file(self.client, self.name, data):
+            return False
+        self.sha256 = digest(self.settings)
+        self.write_cache(data)
+        return True
+
+
+async def patch_device(address, patch, adapter=None, name=FILEPATH):
+    from xoss_gateway import Session # Connection as in the gateway.
+    session = Session(address, adapter)
+    try:
+        await session.open()
+        settings = DeviceSettings(session.transfer, session.client, name)
+        await settings.load()
+        settings.patch(patch)
+        return await settings.save()
+    except TransferError as e:
+        print(f"[{address}] Error: {e}")
+        return False
+    finally:
+        await session.close()
+
+
+async def patch_fleet(addresses, patch, adapters=None, name=FILEPATH):
+    '''Apply a patch to the settings of devices concurrently, spread across adapters; {address: ok}.
+    '''
+    scheduler = AdapterScheduler(adapters)
+    results = await asyncio.gather(*(patch_device(x, patch, scheduler.assign(), name) for x in addresses))
+    return dict(zip(addresses, results))
+
+
+async def main(argv):
+    from xoss_sync import BluetoothFileTransfer
+    command = argv[1] if len(argv) > 1 else 'show'
+    if command == 'show':
+        from xoss_gateway import Session
+        if len(argv) > 2:
+            address = argv[2]
+        elif (device := await BluetoothFileTransfer().discover_device(TARGET_NAME)):
+            address = device.address
+        else:
+            return
+        session = Session(address)
+        try:
+            await session.open()
+            settings = DeviceSettings(session.transfer, session.client)
+            print(json.dumps(await settings.load(refresh=True), indent=2, ensure_ascii=False))
+        finally:
+            await session.close()
+    elif command == 'patch':
+        if os.path.exists(argv[2]):
+            with open(argv[2], 'rb') as f:
+                patch = json.loads(f.read().decode('utf-8'))
+        else:
+            patch = json.loads(argv[2])
+        addresses = argv[3:] or [x.address for x in await BluetoothFileTransfer().discover_devices(TARGET_NAME, 10)]
+        for address, ok in (await patch_fleet(addresses, patch)).items():
+            print(f"[{address}] {'OK' if ok else 'Failed'}")
+    else:
+        print(f"Unknown command: {command}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv))
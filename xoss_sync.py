@@ -19,18 +19,38 @@
 # 7. addition of send_file() to modify device settings via JSON file (e.g. Setting.json or settings.json).
 # 8. support for STX (1024-byte) block in YMODEM, though it's not well tested.
 # 9. support for parsing track list file in JSON format.
-#
-# TODO:
-# 1. handling of fit-file data more efficiently on memory.
+# 10. early detection of broken blocks (header check on the 1st packet, stall timeout scaled to the connection interval).
+# 11. stream_file() to yield verified chunks while the transfer runs, without holding the whole file in memory.
+# 12. check FIT header, size and CRC while downloading (see, xoss_fit.py).
+# 13. decode FIT records into columns (.npz) while downloading, optionally (see, RIDE_CACHE).
+# 14. convert FIT files to GPX/CSV tracks while downloading, optionally (see, TRACK_FORMATS).
+# 15. index of rides (start time, duration, distance, ascent, ...) updated after each fetch (see, RIDE_INDEX).
+# 16. content-addressed archive with deduplication across devices, optionally (see, ARCHIVE_DIR).
+# 17. date-sharded layout of FIT files (e.g. 2024/07/20240715062336.fit), optionally (see, STORAGE_LAYOUT).
+# 18. delete old rides on the device after they are verified locally, optionally (see, RETENTION_DAYS).
+# 19. a gateway to keep connections to devices open between requests of other tools (see, xoss_gateway.py).
+# 20. settings as dicts with patches, uploaded from memory only if changed (see, xoss_settings.py).
+# 21. discovery returns on the first advertisement of known addresses or the name (see, TARGET_ADDRESSES).
+# 22. fetch/send files in a batch; the next request is sent as soon as the device is IDLE (see, transfer_batch).
+# 23. claims of rides shared by workers on many hosts, so that a ride is fetched once (see, CLAIMS_DB).
+# 24. Bumble host stack as a backend, and a simulated device on a virtual link (see, xoss_bumble.py).
+# 25. files in the archive compressed as they arrive, readable at any offset, optionally (see, ARCHIVE_COMPRESSION).
+# 26. rides found broken by the audit of xoss_archive.py are re-fetched in the next session (see, REFETCH_PLAN).
 
 import asyncio
-from bleak import BleakScanner, BleakClient
-import re
 import os
-import datetime
+import sys
+import time
+from xoss_fit import (crc16_arc, FitValidator, check_fit_file, FitDecoder, RideColumns, TrackWriter,
+    RideSummary, Storage)
+# bleak, re and datetime are imported on use; e.g. workers of PostProcessor and the other tools start faster.
 
 #TARGET_NAME = "XOSS G-040989"
 TARGET_NAME = "XOSS"
+TARGET_ADDRESSES = () # e.g. ('EC:37:9F:xx:yy:zz', ); connect as soon as one of the known devices advertises.
+SCAN_TIMEOUT = 90 # in sec.
+SCAN_SERVICE_FILTER = False # Filter advertisements by SERVICE_UUID in the OS; only if the device advertises it.
+SERVICE_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e" # Nordic UART service.
 #SERVICE_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e"
 CTL_CHARACTERISTIC_UUID = "6e400004-b5a3-f393-e0a9-e50e24dcca9e"
 TX_CHARACTERISTIC_UUID = "6e400003-b5a3-f393-e0a9-e50e24dcca9e"
@@ -43,8 +63,8 @@ FILE_SEND = bytearray([0x07]) # w
 OK_FILE_SEND = bytearray([0x08]) # r
 VALUE_DISKSPACE = bytearray([0x09, 0x00, 0x09]) # w
 OK_DISKSPACE = bytearray([0x0a]) # r
-#FILE_DELETE = bytearray([0x0d]) # w
-#OK_FILE_DELETE = bytearray([0x0e]) # r
+FILE_DELETE = bytearray([0x0d]) # w
+OK_FILE_DELETE = bytearray([0x0e]) # r
 #VALUE_STOP = bytearray([0x1f, 0x00, 0x1f]) # w
 #VALUE_ERR_CMD = bytearray([0x11, 0x00, 0x11]) # r
 #ERR_FILE_NA = bytearray([0x12]) # r
@@ -66,17 +86,493 @@ VALUE_CAN = bytearray([0x18])                             # CAN
 
 AWAIT_NEW_DATA = bytearray(b'AwaitNewData')
 
+PACKET_TIMEOUT_CONN_EVENTS = 8 # A block stalls if no packet arrives within these connection events.
+DRAIN_CONN_EVENTS = 3 # Garbage of a broken block is gone if the link is quiet for these connection events.
+MAX_BLOCK_RETRIES = 10 # Cancel the transfer after these successive errors in a block.
+
 FILEPATH = "Setting.json"
 
-class BluetoothFileTransfer:
+REFETCH_RETRIES = 1 # Re-fetch a broken file in the same session.
+RESPONSE_DELAY = 0.1 # Delay in sec after a request answered by the device; 0 in a batch (see, transfer_batch).
+POST_HOOKS = () # e.g. (check_fit_file, ); run on fetched files in a process pool, see PostProcessor.
+RIDE_CACHE = False # Save the columns of records (e.g. 20240715062336.npz) while downloading; NumPy is required.
+TRACK_FORMATS = () # e.g. ('gpx', 'csv'); convert FIT files to tracks (e.g. 20240715062336.gpx) while downloading.
+RIDE_INDEX = None # e.g. 'rides.sqlite'; summaries of rides, see xoss_archive.py.
+ARCHIVE_DIR = None # e.g. 'archive'; store FIT files by SHA-256 instead of by name in the current directory.
+ARCHIVE_COMPRESSION = None # e.g. 'gzip:6' or 'zstd:3'; compress files in the archive as they arrive.
+REFETCH_PLAN = None # e.g. 'refetch.json'; rides to be fetched again though stored, made by 'xoss_archive.py audit'.
+CLAIMS_DB = None # e.g. '/mnt/shared/claims.sqlite'; rides are claimed before fetching, see xoss_claims.py.
+STORAGE_LAYOUT = '' # e.g. '{year}/{month}'; sub-directories of FIT files by the timestamp in the name ('' = flat).
+RETENTION_DAYS = None # e.g. 90; delete rides older than this on the device at the end of the session (opt-in).
+RETENTION_KEEP = 10 # The newest rides are kept on the device anyway.
+DELETE_DRY_RUN = True # Only show the rides to be deleted.
+
+MIN_CONN_INTERVAL_US = 7_500 # The minimum connection interval in BLE.
+MTU_SIZE = 209 # An STX block of 1029 bytes fits well in 206 * 5 (see, README).
+BLUEZ_DEBUGFS = False # Set the intervals of new connections via debugfs on Linux (root only; restored on exit).
+
+class LinkPolicy:
+    '''Request the tightest connection parameters and read back what was granted.
+    This base class requests nothing and reports what Bleak tells (e.g. Windows, MacOS).
+    '''
+    def __init__(self, conn_interval_us=MIN_CONN_INTERVAL_US, mtu=MTU_SIZE):
+        self.conn_interval_us = conn_interval_us
+        self.mtu = mtu
+
+    async def prepare(self):
+        # Called before connecting.
+        pass
+
+    async def apply(self, client):
+        # Called after connecting; returns the granted values (None if unknown).
+        return self.make_link(None, client.mtu_size, None)
+
+    async def restore(self):
+        # Called on exit, after prepare().
+        pass
+
+    def make_link(self, conn_interval_us, mtu, data_length):
+        return {
+            'conn_interval_us': conn_interval_us,
+            'mtu': mtu,
+            'data_length': data_length,
+            'stx': mtu > 23, # STX (1024-byte) blocks only with an increased MTU.
+        }
+
+
+class BlueZLinkPolicy(LinkPolicy):
+    '''BlueZ has no D-Bus API for connection parameters.  With BLUEZ_DEBUGFS, the min/max intervals of new connections
+    are set via debugfs (root only, see Note 5 in README) and restored on exit; the setting is system-wide.
+    BlueZ does not tell the granted interval; it is reported as None (timeouts assume 50 ms).  MTU is from BlueZ >= 5.62.
+    '''
+    saved = {} # {adapter: [(min, max), sessions]}; the intervals before the first of concurrent sessions.
+
+    def __init__(self, adapter='hci0', debugfs=None, **kwargs):
+        super().__init__(**kwargs)
+        self.adapter = adapter
+        self.use_debugfs = BLUEZ_DEBUGFS if debugfs is None else debugfs
+        self.debugfs = f'/sys/kernel/debug/bluetooth/{adapter}'
+        self.prepared = False
+
+    async def prepare(self):
+        if not self.use_debugfs or self.prepared:
+            return
+        if (saved := self.saved.get(self.adapter)) is not None:
+            saved[1] += 1
+            self.prepared = True
+            return
+        value = self.conn_interval_us * 4 // 5_000 # In units of 1.25 ms.
+        try:
+            old = self.read_intervals()
+            self.write_intervals(old, (value, value))
+        except (OSError, ValueError) as e:
+            print(f"Failed to set connection interval via debugfs: {e}")
+            return
+        self.saved[self.adapter] = [old, 1]
+        self.prepared = True
+
+    async def restore(self):
+        if not self.prepared:
+            return
+        self.prepared = False
+        saved = self.saved[self.adapter]
+        saved[1] -= 1
+        if saved[1] > 0: # Still used by other sessions.
+            return
+        del self.saved[self.adapter]
+        try:
+            self.write_intervals(self.read_intervals(), saved[0])
+        except (OSError, ValueError) as e:
+            print(f"Failed to restore connection interval via debugfs: {e}")
+
+    def read_intervals(self):
+        values = []
+        for name in ('conn_min_interval', 'conn_max_interval'):
+            with open(f'{self.debugfs}/{name}') as f:
+                values.append(int(f.read()))
+        return tuple(values)
+
+    def write_intervals(self, old, new):
+        # min <= max at each step; decrease min first, or increase max first.
+        names = ('conn_min_interval', 'conn_max_interval')
+        for i in ((0, 1) if new[0] <= old[1] else (1, 0)):
+            with open(f'{self.debugfs}/{names[i]}', 'w') as f:
+                f.write(str(new[i]))
+
+    async def apply(self, client):
+        return self.make_link(None, await self.read_mtu(client), None)
+
+    async def read_mtu(self, client, timeout=2.0):
+        # ATT MTU of the connection by the write size of RX; 20 (i.e. MTU 23) until exchanged, or on BlueZ < 5.62.
+        try:
+            rx = client.services.get_characteristic(RX_CHARACTERISTIC_UUID)
+            t_end = time.monotonic() + timeout
+            while (size := rx.max_write_without_response_size) == 20 and time.monotonic() < t_end:
+                await asyncio.sleep(0.1)
+            return size + 3
+        except Exception as e:
+            print(f"Failed to read MTU: {e}")
+            return 23
+
+
+class FakeLinkPolicy(LinkPolicy):
+    '''Grant fixed values without asking the stack, e.g. for tests with a fake client.
+    '''
+    def __init__(self, conn_interval_us=MIN_CONN_INTERVAL_US, mtu=23, data_length=None):
+        super().__init__(conn_interval_us, mtu)
+        self.data_length = data_length
+
+    async def apply(self, client):
+        return self.make_link(self.conn_interval_us, self.mtu, self.data_length)
+
+
+async def as_async(iterable):
+    # Items of an iterable or an async iterable.
+    if hasattr(iterable, '__aiter__'):
+        async for x in iterable:
+            yield x
+    else:
+        for x in iterable:
+            yield x
+
+
+def default_link_policy(adapter=None):
+    return BlueZLinkPolicy(adapter or 'hci0') if sys.platform.startswith('linux') else LinkPolicy()
+
+
+def archive_file(path, archive_dir):
+    # A hook to copy the file, e.g. functools.partial(archive_file, archive_dir='backup').
+    import shutil
+    os.makedirs(archive_dir, exist_ok=True)
+    return shutil.copy2(path, archive_dir)
+
+
+def run_hooks(path, hooks):
+    return [hook(path) for hook in hooks]
+
+
+class PostProcessor:
+    '''Run hooks (validation, conversion, archival, upload, ...) on fetched files in a process pool,
+    while the link keeps downloading the next file.  Hooks are called as hook(path) and have to be picklable.
+    At most max_pending files are queued; submit() waits for a free slot.
+    '''
+    def __init__(self, hooks=POST_HOOKS, max_workers=None, max_pending=4):
+        self.hooks = tuple(hooks)
+        self.max_workers = max_workers
+        self.slots = asyncio.Semaphore(max_pending)
+        self.pool = None
+        self.pending = set()
+        self.results = [] # [(path, [result of each hook]), ...]
+        self.errors = [] # [(path, exception), ...]
+
+    async def submit(self, path):
+        await self.slots.acquire()
+        if self.pool is None:
+            from concurrent.futures import ProcessPoolExecutor
+            self.pool = ProcessPoolExecutor(self.max_workers)
+        future = asyncio.get_running_loop().run_in_executor(self.pool, run_hooks, path, self.hooks)
+        future.add_done_callback(lambda f: self.done(path, f))
+        self.pending.add(future)
+
+    def done(self, path, future):
+        self.pending.discard(future)
+        self.slots.release()
+        if future.cancelled():
+            return
+        if (e := future.exception()) is not None:
+            print(f"Post-processing error: {e}")
+            self.errors.append((path, e))
+        else:
+            self.results.append((path, future.result()))
+
+    async def close(self):
+        if self.pending:
+            await asyncio.wait(self.pending)
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        print(f"Post-processed: {len(self.results)} OK, {len(self.errors)} errors.")
+        return self.errors
+
+
+class TransferError(Exception):
+    pass
+
+
+class FileSink:
+    '''Write chunks to a temporary file, which is renamed to path on success (after fsync, if specified).
+    '''
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self.file = open(f'{path}.part', 'wb')
+
+    def write(self, chunk):
+        self.file.write(chunk)
+
+    def close(self, ok=True):
+        if ok and self.fsync:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.file.close()
+        if ok:
+            os.replace(f'{self.path}.part', self.path)
+        else:
+            os.remove(f'{self.path}.part')
+
+
+class GzipSink(FileSink):
+    '''As FileSink, compressed by gzip; the trailer is written before the file is synced and renamed.
+    '''
+    def __init__(self, path, compresslevel=6, fsync=False):
+        import gzip
+        super().__init__(path, fsync)
+        self.gzip = gzip.GzipFile(path, 'wb', compresslevel, self.file)
+
+    def write(self, chunk):
+        self.gzip.write(chunk)
+
+    def close(self, ok=True):
+        self.gzip.close() # Leaves the file open.
+        super().close(ok)
+
+
+class BytesSink:
+    def __init__(self):
+        import io
+        self.buf = io.BytesIO()
+
+    def write(self, chunk):
+        self.buf.write(chunk)
+
+    def close(self, ok=True):
+        pass
+
+    def getvalue(self):
+        return self.buf.getvalue()
+
+
+class HashSink:
+    def __init__(self, name='sha256'):
+        import hashlib
+        self.hash = hashlib.new(name)
+
+    def write(self, chunk):
+        self.hash.update(chunk)
+
+    def close(self, ok=True):
+        pass
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+class SummarySink(HashSink):
+    '''Summarize a ride (RideSummary) and hash the file as chunks arrive; see RideIndex in xoss_archive.py.
+    '''
+    def __init__(self, name='sha256'):
+        super().__init__(name)
+        self.size = 0
+        self.summary = RideSummary()
+        self.decoder = FitDecoder(self.summary)
+
+    def write(self, chunk):
+        self.hash.update(chunk)
+        self.size += len(chunk)
+        self.decoder.write(chunk)
+
+    def close(self, ok=True):
+        self.decoder.close(ok)
+
+    def ride(self, name):
+        return self.summary.ride(name, self.size, self.hexdigest())
+
+
+class ArchiveSink:
+    '''Write chunks to a temporary file in the archive while hashing; stored by the hash on success (see Archive).
+    '''
+    def __init__(self, archive, device, name, replace=False):
+        import hashlib
+        self.archive = archive
+        self.device = device
+        self.name = name
+        self.replace = replace # Of a broken object.
+        self.temp = archive.temp_path(device, name)
+        self.file = open(self.temp, 'wb')
+        self.writer = archive.writer(self.file) # Compressing on the fly, if ARCHIVE_COMPRESSION.
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunk):
+        self.writer.write(chunk)
+        self.hash.update(chunk)
+        self.size += len(chunk)
+
+    def close(self, ok=True):
+        if ok:
+            self.writer.close() # The seek index of a compressed file.
+        self.file.close()
+        if ok:
+            self.archive.put(self.device, self.name, self.temp, self.hash.hexdigest(), self.size, self.replace)
+        else:
+            os.remove(self.temp)
+
+
+class RideCacheSink:
+    '''Decode FIT records as they arrive; the columns are saved to a .npz file on success.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.columns = RideColumns()
+        self.decoder = FitDecoder(self.columns)
+
+    def write(self, chunk):
+        self.decoder.write(chunk)
+
+    def close(self, ok=True):
+        if self.decoder.close(ok):
+            self.columns.save_npz(self.path)
+        elif ok:
+            print(f"Error: {self.path}: {self.decoder.error}")
+
+
+class SocketSink:
+    '''Send chunks to a connected socket as they arrive (blocking sendall; chunks are 1 kB at most).
+    '''
+    def __init__(self, sock):
+        self.sock = sock
+
+    def write(self, chunk):
+        self.sock.sendall(chunk)
+
+    def close(self, ok=True):
+        pass
+
+
+def list_adapters():
+    '''HCI controllers (hci0, hci1, ...) on Linux; [None] (the default adapter) elsewhere.
+    '''
+    import re
+    try:
+        adapters = [x for x in os.listdir('/sys/class/bluetooth') if re.fullmatch(r'hci\d+', x)]
+    except OSError:
+        adapters = []
+    return sorted(adapters, key=lambda x: int(x[3:])) or [None]
+
+
+class AdapterScheduler:
+    '''Assign each device to the least-loaded adapter, as links on an adapter compete for its connection events.
+    '''
+    def __init__(self, adapters=None):
+        self.load = {x: 0 for x in (adapters or list_adapters())}
+
+    def assign(self):
+        adapter = min(self.load, key=self.load.get)
+        self.load[adapter] += 1
+        return adapter
+
+
+class FleetProgress:
+    '''Aggregate progress of all the devices in one place (the controller).
+    '''
     def __init__(self):
+        self.ok = self.failed = 0
+
+    def __call__(self, address, filename, ok):
+        if ok: self.ok += 1
+        else: self.failed += 1
+        print(f"[{address}] {'Fetched' if ok else 'Failed'}: {filename} (total {self.ok} fetched, {self.failed} failed)")
+
+
+async def sync_device(device, adapter=None, progress=None):
+    # device is a BLEDevice (found on the adapter) or an address.
+    transfer = BluetoothFileTransfer(adapter=adapter)
+    transfer.progress = progress
+    address = device if isinstance(device, str) else device.address
+    transfer.list_prefix = f"{address.replace(':', '')}_" # Do not overwrite lists of the other devices.
+    await transfer.run(device)
+
+
+async def sync_adapter(adapter, addresses, progress=None):
+    # Resolve all the devices on the adapter in a scan, then sync them concurrently.
+    devices = await BluetoothFileTransfer(adapter=adapter).discover(addresses=addresses, count=None, timeout=30)
+    if (missing := set(x.upper() for x in addresses) - set(x.address.upper() for x in devices)):
+        print(f"Not found on {adapter}: {', '.join(sorted(missing))}")
+    await asyncio.gather(*(sync_device(x, adapter, progress) for x in devices))
+
+
+def adapter_worker(adapter, addresses, queue):
+    '''Worker process to sync devices on an adapter; progress is sent to the controller via queue.
+    '''
+    async def run():
+        await sync_adapter(adapter, addresses, lambda *args: queue.put(args))
+    try:
+        asyncio.run(run())
+    finally:
+        queue.put(None)
+
+
+async def sync_fleet(target_name=TARGET_NAME, adapters=None, processes=False, scan_timeout=10):
+    '''Sync all the devices found, spread across adapters (optionally, one worker process per adapter).
+    '''
+    scheduler = AdapterScheduler(adapters)
+    devices = await BluetoothFileTransfer(adapter=next(iter(scheduler.load))).discover_devices(target_name, scan_timeout)
+    groups = {}
+    for device in devices:
+        groups.setdefault(scheduler.assign(), []).append(device.address)
+    print(f"Adapters: {', '.join(f'{x}={len(y)}' for x, y in groups.items())}")
+    progress = FleetProgress()
+
+    if not processes:
+        await asyncio.gather(*(sync_adapter(adapter, addresses, progress) for adapter, addresses in groups.items()))
+        return progress
+
+    import multiprocessing
+    queue = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=adapter_worker, args=(adapter, addresses, queue))
+        for adapter, addresses in groups.items()]
+    for worker in workers:
+        worker.start()
+    running = len(workers)
+    loop = asyncio.get_running_loop()
+    while running > 0:
+        if (message := await loop.run_in_executor(None, queue.get)) is None:
+            running -= 1
+        else:
+            progress(*message)
+    for worker in workers:
+        worker.join()
+    return progress
+
+
+class BluetoothFileTransfer:
+    def __init__(self, link_policy=None, adapter=None):
         self.lock = asyncio.Lock()
+        self.data_event = asyncio.Event() # Set on a new notification_data.
+        self.adapter = adapter # e.g. 'hci1' on Linux; None for the default.
+        self.progress = None # Called with (address, filename, ok) after each fetch in run().
+        self.list_prefix = '' # Prefix of the local file of the track list.
+        self.post_hooks = POST_HOOKS
+        self.ride_index = None # RideIndex of xoss_archive.py, updated after each fetch_file().
+        self.archive = None # Archive of xoss_archive.py; FIT files are stored there if given.
+        self.claims = None # Claims of xoss_claims.py, shared by workers; rides claimed by others are skipped.
+        self.refetch = set() # Names to be fetched again though stored, by REFETCH_PLAN.
+        self.device_id = '' # Address of the device without colons.
+        self.storage = Storage('.', STORAGE_LAYOUT) # FIT files in the current directory, unless archived.
+        self.response_delay = RESPONSE_DELAY
+        self.overhead = 0.0 # Time in sec of the last fetch out of the data blocks; request, block 0 and EOT.
         # **Packet**
         self.notification_data = bytearray()
         self.mtu_size = 23
+        self.conn_interval = 0.05 # Connection interval in sec; 50 ms (BlueZ) unless known.
+        self.t_packet = 0.0 # Arrival time of the last packet.
+        self.link_policy = link_policy or default_link_policy(adapter)
+        self.link = {} # Granted connection parameters.
+        self.is_garbage = False # True while dropping the rest of a broken block.
         # **Block**
         self.block_buf = bytearray(3 + 1024 + 2)                                 # Header(SOH/STX, num, ~num); data(128 or 1024 bytes); CRC16
         self.block_num = 0 # Block number(0-255).
+        self.block_count = 0 # Number of data blocks received; block_num wraps around at 256.
         self.idx_block_buf = 0 # Index in block_buf.
         self.mv_block_buf = memoryview(self.block_buf)
         self.block_size = None
@@ -88,50 +584,100 @@ class BluetoothFileTransfer:
         )
         self.block_error = False
         # **File**                                                               A file is made of blocks; a block is made of packets.
-        self.data = bytearray()
         self.data_size = 0
         self.data_read = 0
+        self.data_received = 0 # Size of data received.
+        self.chunk = None # Data of the new block; memoryview of block_data.
         # **Download/Upload**
         self.is_download = self.is_upload = False
+        self.use_stx = False # True/False = STX/SOH in upload.
         self.upload_handshake = None # {VALUE_C, VALUE_ACK, VALUE_NAK, VALUE_CAN}
 
     def create_notification_handler(self):
+        _STX = VALUE_STX[0]
         async def notification_handler(sender, data):
             ##print(data) # For test.
             if data == VALUE_EOT:                                               # Receive EOT.
                 self.is_download = False
                 self.notification_data = data
+                self.data_event.set()
             elif self.is_download:                                              # Packets should be combined to make a block.
                 async with self.lock: # Use asyncio.Lock() for safety.
-                    self.mv_block_buf[self.idx_block_buf:self.idx_block_buf + (len_data := len(data))] = data
+                    self.t_packet = time.monotonic()
+                    if self.is_garbage: return                                  # Drop the rest of a broken block.
+                    if self.idx_block_buf == 0:                                 # The 1st packet of a block.
+                        if not self.check_block_header(data):
+                            self.is_garbage = True
+                            return
+                        self.block_size, self.block_data, self.block_crc = self.block_size_data_crc[int(data[0] == _STX)]
+                    if self.idx_block_buf + (len_data := len(data)) > self.block_size:
+                        self.is_garbage = True
+                        return
+                    self.mv_block_buf[self.idx_block_buf:self.idx_block_buf + len_data] = data
                     self.idx_block_buf += len_data
             elif self.is_upload:
                 if data in (VALUE_C, VALUE_ACK, VALUE_NAK, VALUE_CAN): # 'G' not implemented.
                     self.upload_handshake = data
                 else:
                     self.notification_data = data
+                    self.data_event.set()
             else:
                 self.notification_data = data                                   # Other messages/responses.
+                self.data_event.set()
 
         return notification_handler
 
-    async def discover_device(self, target_name):
-        async with BleakScanner() as scanner:
-            async def lookup_device():
-                async for bd, ad in scanner.advertisement_data():
-                    print(f"Found device: {bd.name} - {bd.address}")
-                    #print(f" {bd!r} with {ad!r}")
-                    if target_name in (bd.name or "") or target_name in (ad.local_name or ""):
-                        return bd
+    def adapter_kwargs(self):
+        return {'adapter': self.adapter} if self.adapter else {}
+
+    def make_scanner(self, detection_callback, **kwargs):
+        # The stack; overridden by the other backends (see, xoss_bumble.py).
+        from bleak import BleakScanner
+        return BleakScanner(detection_callback, **kwargs, **self.adapter_kwargs())
+
+    def make_client(self, device):
+        from bleak import BleakClient
+        return BleakClient(device, timeout=60.0, **self.adapter_kwargs())
+
+    async def discover(self, target_name=TARGET_NAME, addresses=(), count=1, timeout=SCAN_TIMEOUT):
+        '''Devices of the addresses, or matched by name (substring), in a scan window.
+        Returns as soon as count devices (all the addresses if None) are found, or at timeout with those found.
+        '''
+        wanted = set(x.upper() for x in addresses)
+        devices = {}
+        done = asyncio.Event()
+
+        def detection_callback(bd, ad):
+            if bd.address in devices:
+                return
+            if wanted:
+                if bd.address.upper() not in wanted: return
+            elif not (target_name in (bd.name or "") or target_name in (ad.local_name or "")):
+                return
+            print(f"Found target device: {bd.name} - {bd.address}")
+            devices[bd.address] = bd
+            if len(devices) >= (count or len(wanted) or sys.maxsize):
+                done.set()
 
-            print("Scanning for Bluetooth devices...")
+        kwargs = {'service_uuids': [SERVICE_UUID]} if SCAN_SERVICE_FILTER else {}
+        print(f"Scanning for Bluetooth devices ({timeout} s)...")
+        async with self.make_scanner(detection_callback, **kwargs):
             try:
-                device = await asyncio.wait_for(lookup_device(), timeout=90)
+                await asyncio.wait_for(done.wait(), timeout=timeout)
             except asyncio.TimeoutError:
-                print(f"Device with name {target_name} not found.")
-                return None
-            print(f"Found target device: {device.name} - {device.address}")
-            return device
+                pass
+        return list(devices.values())
+
+    async def discover_devices(self, target_name, timeout):
+        # All the devices found in a scan window.
+        return await self.discover(target_name, count=None, timeout=timeout)
+
+    async def discover_device(self, target_name, addresses=TARGET_ADDRESSES):
+        # The first device found; one of the known addresses, if any.
+        if not (devices := await self.discover(target_name, addresses)):
+            print(f"Device {', '.join(addresses) or f'with name {target_name}'} not found.")
+            return None
+        return devices[0]
 
     async def start_notify(self, client, uuid):
         try:
@@ -166,31 +712,37 @@ class BluetoothFileTransfer:
         self.idx_block_buf = 0
         self.is_download = True
         self.block_error = False
-        await self.send_cmd(client, RX_CHARACTERISTIC_UUID, VALUE_C, 0.1)      # Send 'C'.
+        await self.send_cmd(client, RX_CHARACTERISTIC_UUID, VALUE_C, 0)   # Send 'C'.
         await self.read_block(client)
 
-    async def read_block(self, client):
-        #_SOH = VALUE_SOH[0] # SOH == 128-byte data
-        _STX = VALUE_STX[0] # STX == 1024-byte data
+    async def read_block(self, client, timeout=10):
         async def check_block_buf():
-            while self.is_download and self.idx_block_buf == 0:
+            while self.is_download and self.idx_block_buf == 0 and not self.is_garbage:
                 await asyncio.sleep(0.01)
-            if not self.is_download: return
-            self.block_size, self.block_data, self.block_crc = self.block_size_data_crc[int(self.block_buf[0] == _STX)]
-            while self.idx_block_buf < self.block_size:
+            packet_timeout = self.packet_timeout()
+            while self.is_download and self.idx_block_buf < self.block_size and not self.is_garbage:
+                if time.monotonic() - self.t_packet > packet_timeout:
+                    self.is_garbage = True                                       # Stalled; a packet was lost.
+                    break
                 await asyncio.sleep(0.01)
 
         try:
-            await asyncio.wait_for(check_block_buf(), timeout=10)
+            await asyncio.wait_for(check_block_buf(), timeout=timeout)
             if not self.is_download: return # The 1st EOT may arrive very late.
-            if int.from_bytes(self.block_crc, 'big') != self.crc16_arc(self.block_data):
+            if self.is_garbage or int.from_bytes(self.block_crc, 'big') != self.crc16_arc(self.block_data):
+                self.block_error = True
+            elif self.block_num >= 0 and self.block_buf[1] == self.block_num:   # Resent as our ACK was lost; discard and ACK again.
+                print(f'Duplicate block{self.block_num} (#{self.block_count}).')
+                self.block_error = False
+            elif self.block_num >= 0 and self.data_received >= self.data_size:  # Beyond the expected total from block 0.
+                print(f'Unexpected block{self.block_buf[1]} after {self.block_count} blocks.')
                 self.block_error = True
             else:
-                self.data.extend(self.block_data)                                # Blocks should be combined to make a file.
-                if self.block_buf[1] == (self.block_num + 1) % 256:
-                    if self.block_error: print(f'Fixed error in block{self.block_buf[1]}.')
-                else:
-                    print(f'Unexpected block: {self.block_num} -> {self.block_buf[1]}')
+                if self.block_error: print(f'Fixed error in block{self.block_buf[1]}.')
+                if self.block_num >= 0:                                          # Blocks should be combined to make a file.
+                    self.block_count += 1
+                    self.chunk = self.block_data[:min(len(self.block_data), self.data_size - self.data_received)]
+                    self.data_received += len(self.chunk)                         # Padding at the end is stripped.
                 self.block_num = self.block_buf[1]
                 self.block_error = False
         except asyncio.TimeoutError:
@@ -198,68 +750,164 @@ class BluetoothFileTransfer:
         # Prepare for the next data block.
         self.idx_block_buf = 0
 
+    def check_block_header(self, data):
+        '''Check header (SOH/STX, num, ~num) in the 1st packet of a block.
+        The previous num is also accepted as it is resent if our ACK was lost.
+        '''
+        return (len(data) >= 3 and data[0] in (VALUE_SOH[0], VALUE_STX[0]) and data[1] ^ data[2] == 0xff and
+            (data[1] == (self.block_num + 1) % 256 or (self.block_num >= 0 and data[1] == self.block_num)))
+
+    def packet_timeout(self):
+        return max(0.1, PACKET_TIMEOUT_CONN_EVENTS * self.conn_interval)
+
+    def block_timeout(self):
+        # The 1st packet of a data block; the device may need several connection events to respond to ACK/NAK.
+        return max(1.0, 10 * PACKET_TIMEOUT_CONN_EVENTS * self.conn_interval)
+
+    async def drain_garbage(self):
+        # Wait until the rest of a broken block has gone, i.e. no packets for a few connection events.
+        self.is_garbage = True
+        quiet = max(0.03, DRAIN_CONN_EVENTS * self.conn_interval)
+        t_start = time.monotonic()
+        while (t := time.monotonic()) - self.t_packet < quiet and t - t_start < 1.0:
+            await asyncio.sleep(0.01)
+        async with self.lock:
+            self.idx_block_buf = 0
+            self.is_garbage = False
+
     async def end_of_transfer(self, client):
-        # The first EOT was received already.
-        await asyncio.sleep(0.1) # This avoids NAK to be sent too fast.
+        # The first EOT was received already; each reply is sent as soon as the notification arrives.
         self.notification_data = AWAIT_NEW_DATA
-        await self.send_cmd(client, RX_CHARACTERISTIC_UUID, VALUE_NAK, 0.1) # Send NAK.
+        await self.send_cmd(client, RX_CHARACTERISTIC_UUID, VALUE_NAK, 0)    # Send NAK.
         await self.wait_until_data(client)                                   # Receive the second EOT.
-        await asyncio.sleep(0.1) # This avoids ACK to be sent too fast.
         self.notification_data = AWAIT_NEW_DATA
-        await self.send_cmd(client, RX_CHARACTERISTIC_UUID, VALUE_ACK, 0.1) # Send ACK.
+        await self.send_cmd(client, RX_CHARACTERISTIC_UUID, VALUE_ACK, 0)    # Send ACK.
         await self.wait_until_data(client)                                   # Receive IDLE (0x04, 0x00, 0x04)
 
-    async def fetch_file(self, client, filename):
+    async def stream_file(self, client, filename):
+        '''Yield verified chunks (memoryview, padding stripped) of the file while it is transferred.
+        A chunk is valid until the next iteration; the block is ACKed after that.  Raises TransferError.
+        '''
+        t_start = time.monotonic()
         if self.notification_data != VALUE_IDLE:
-            if not await self.get_idle_status(client): return
+            if not await self.get_idle_status(client): raise TransferError('device is not idle.')
         # Request the File
         self.notification_data = AWAIT_NEW_DATA
         value_file_fetch = self.make_command(FILE_FETCH, filename)
-        await self.send_cmd(client, CTL_CHARACTERISTIC_UUID, value_file_fetch, 0.1) # Request starts with 0x05
+        await self.send_cmd(client, CTL_CHARACTERISTIC_UUID, value_file_fetch, self.response_delay) # Request starts with 0x05
         await self.wait_until_data(client)
+        if self.notification_data != self.make_command(OK_FILE_FETCH, filename):    # Response starts with 0x06
+            raise TransferError(f'fetch {filename} not accepted.')
 
-        if self.notification_data == self.make_command(OK_FILE_FETCH, filename):    # Response starts with 0x06
-            retries = 3
-            while retries > 0:
-                await self.read_block_zero(client) # Block 0 consists of name and size of the file.
-                if self.block_error:
-                    retries -= 1
-                    self.is_download = False # Wait 0.2 s for garbage.
-                    await asyncio.sleep(0.2)
-                    self.is_download = True
-                    await self.send_cmd(client, RX_CHARACTERISTIC_UUID, VALUE_NAK, 0.1) # Send NAK on error.
-                else:
-                    break
-            if retries == 0: # Too many errors in reading block zero; cancel transport.
-                await self.send_cmd(client, RX_CHARACTERISTIC_UUID, VALUE_CAN, 0.1)    # Send CAN (cancel).
-                return
+        retries = 3
+        while retries > 0:
+            await self.read_block_zero(client) # Block 0 consists of name and size of the file.
+            if self.block_error:
+                retries -= 1
+                await self.drain_garbage()
+                await self.send_cmd(client, RX_CHARACTERISTIC_UUID, VALUE_NAK, 0.1) # Send NAK on error.
+            else:
+                break
+        if retries == 0: # Too many errors in reading block zero; cancel transport.
+            await self.send_cmd(client, RX_CHARACTERISTIC_UUID, VALUE_CAN, 0.1)    # Send CAN (cancel).
+            raise TransferError('too many errors in block0.')
 
-            self.data_size = int(self.block_data.tobytes().rstrip(b'\x00').decode('utf-8').split()[1])
-            self.data = bytearray() # Where the file to be stored.
+        self.data_size = int(self.block_data.tobytes().rstrip(b'\x00').decode('utf-8').split()[1])
+        self.data_received = self.block_count = 0
+        self.chunk = None # Not of the last file, e.g. stopped by the consumer.
 
-            await self.send_cmd(client, RX_CHARACTERISTIC_UUID, VALUE_ACK, 0.1)       # Send ACK.
-            await self.send_cmd(client, RX_CHARACTERISTIC_UUID, VALUE_C, 0.1)         # Send 'C'.
+        await self.send_cmd(client, RX_CHARACTERISTIC_UUID, VALUE_ACK, 0)         # Send ACK.
+        await self.send_cmd(client, RX_CHARACTERISTIC_UUID, VALUE_C, 0)           # Send 'C'; writes are in order.
 
-            # Blocks of num>=1 should be combined to obtain the file.
+        # Blocks of num>=1 should be combined to obtain the file.
+        t_data = time.monotonic()
+        errors = 0
+        try:
             while self.is_download:                                                       # Receive EOT to exit this loop.
-                await self.read_block(client)
+                await self.read_block(client, self.block_timeout())
                 if not self.is_download: break # The 1st EOT may arrive very late.
                 if self.block_error:
-                    self.is_download = False # Wait 0.2 s for garbage.
-                    await asyncio.sleep(0.2)
-                    self.is_download = True
+                    if (errors := errors + 1) > MAX_BLOCK_RETRIES:                         # Too many errors; cancel transport.
+                        self.is_download = False
+                        await self.send_cmd(client, RX_CHARACTERISTIC_UUID, VALUE_CAN, 0.1) # Send CAN (cancel).
+                        raise TransferError(f'too many errors in block{(self.block_num + 1) % 256}.')
+                    await self.drain_garbage()
                     await self.send_cmd(client, RX_CHARACTERISTIC_UUID, VALUE_NAK, 0.1) # Send NAK on error.
                 else:
+                    errors = 0
+                    if self.chunk is not None:
+                        yield self.chunk
+                        self.chunk = None
                     await self.send_cmd(client, RX_CHARACTERISTIC_UUID, VALUE_ACK, 0.1) # Send ACK.
-            await self.end_of_transfer(client)
-            self.save_file_raw(filename)
+        except (GeneratorExit, asyncio.CancelledError):                               # The consumer stopped.
+            self.chunk = None
+            if self.is_download:
+                self.is_download = False
+                await self.send_cmd(client, RX_CHARACTERISTIC_UUID, VALUE_CAN, 0.1)     # Send CAN (cancel).
+            raise
+        t_eot = time.monotonic()
+        await self.end_of_transfer(client)
+        self.overhead = (t_data - t_start) + (time.monotonic() - t_eot)
+        if self.data_received != self.data_size:
+            raise TransferError(f'{self.data_received}(file size) != {self.data_size}(spec)')
+
+    async def fetch_to(self, client, filename, *sinks, validator=None):
+        '''Fetch a file into sinks (e.g. FileSink, BytesSink, HashSink, GzipSink and SocketSink).
+        The validator (e.g. FitValidator) is checked at EOT before the sinks are closed.  Returns True on success.
+        '''
+        ok = False
+        chunks = self.stream_file(client, filename)
+        try:
+            try:
+                async for chunk in chunks:
+                    if validator: validator.write(chunk)
+                    for sink in sinks:
+                        sink.write(chunk)
+            finally:
+                await chunks.aclose() # CAN on error in a sink.
+            if validator and not validator.close():
+                print(f"Error: {filename}: {validator.error}")
+            else:
+                ok = True
+        except TransferError as e:
+            print(f"Error: {e}")
+        finally:
+            for sink in sinks:
+                sink.close(ok)
+        return ok
+
+    async def fetch_file(self, client, filename, filepath=None):
+        validator = FitValidator() if filename.endswith('.fit') else None
+        in_storage = validator is not None and self.archive is None and filepath is None # By STORAGE_LAYOUT.
+        if (in_archive := validator is not None and self.archive is not None):
+            sinks = [ArchiveSink(self.archive, self.device_id, filename, replace=filename in self.refetch)]
+            filepath = self.archive.view_path(self.device_id, filename) # Tracks, etc. are saved next to the link.
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        elif in_storage:
+            sinks = [FileSink(filepath := self.storage.path(filename), fsync=True)]
+        else:
+            sinks = [FileSink(filepath := filepath or filename)]
+        if validator and RIDE_CACHE:
+            sinks.append(RideCacheSink(filepath.rsplit('.', 1)[0] + '.npz'))
+        if validator:
+            sinks.extend(TrackWriter(f"{filepath.rsplit('.', 1)[0]}.{x}") for x in TRACK_FORMATS)
+        if validator and self.ride_index is not None:
+            sinks.append(summary := SummarySink())
+        if (ok := await self.fetch_to(client, filename, *sinks, validator=validator)):
+            print(f"Successfully wrote combined data to {self.local_path(filename) if in_archive else filepath}")
+            if in_storage: self.storage.committed(filename, filepath)
+            if validator and self.ride_index is not None and summary.decoder.ok:
+                self.ride_index.add(summary.ride(os.path.basename(filepath)))
+        return ok
 
     async def wait_until_data(self, client):
-        i = 0
+        # Wakes up on the notification, not by polling.
+        t_end = time.monotonic() + 10
         while self.notification_data == AWAIT_NEW_DATA:
-            await asyncio.sleep(0.01)
-            i = i + 1
-            if i >= 1000:
+            self.data_event.clear()
+            try:
+                await asyncio.wait_for(self.data_event.wait(), t_end - time.monotonic())
+            except asyncio.TimeoutError:
                 print(f"Something went wrong. No new notification data.")
                 break
 
@@ -273,9 +921,11 @@ class BluetoothFileTransfer:
             self.notification_data.startswith(OK_DISKSPACE)):
             diskspace = self.notification_data[1:-1].decode('utf-8')
             print(f"Free Diskspace: {diskspace}kb")
+            return diskspace # e.g. '556/8104' (free/total in kb).
 
     async def time_set(self, client):
         # Set RTC on the device (32-bit uint, UTC, and 1970/1/1 epoch)
+        import datetime
         self.notification_data = AWAIT_NEW_DATA
         self.is_download = False
         value_time_set = (TIME_SET
@@ -286,7 +936,9 @@ class BluetoothFileTransfer:
         #await self.wait_until_data(client)                                             # Response starts with 0x55
         await asyncio.sleep(1) # Wait 1 sec because of no response from XOSS-G+ gen1.
 
-    async def send_file(self, client, filepath=FILEPATH):
+    async def send_file(self, client, filepath=FILEPATH, data=None):
+        '''Send a file, or data (bytes) from memory as the file of the name (e.g. data of Setting.json).
+        '''
         def construct_block_zero():
             self.block_num = -1
             header = bytes(f'{filename} {self.data_size}', 'utf-8')
@@ -330,10 +982,10 @@ class BluetoothFileTransfer:
             return self.upload_handshake
 
         if self.notification_data != VALUE_IDLE:
-            if not await self.get_idle_status(client): return
+            if not await self.get_idle_status(client): return False
 
         # Request to send the file.
-        self.data_size = os.path.getsize(filepath)
+        self.data_size = os.path.getsize(filepath) if data is None else len(data)
         filename = filepath.split('/')[-1]
         #filename = filepath
         self.is_upload = True
@@ -347,7 +999,7 @@ class BluetoothFileTransfer:
             await receive_handshake() != VALUE_C):                                   # Receive 'C'.
             print("Send file not accepted.")
             self.is_upload = False
-            return
+            return False
 
         # Send block number zero.  Always use SOH for block zero.
         self.block_size, self.block_data, self.block_crc = self.block_size_data_crc[int(use_stx:=False)]
@@ -365,13 +1017,15 @@ class BluetoothFileTransfer:
         if retries == 0:
             print("Too many errors.")
             self.is_upload = False
-            return
+            return False
 
         # Send blocks of number >= 1
-        use_stx = True if self.mtu_size > 23 else False
+        use_stx = self.use_stx
         self.block_size, self.block_data, self.block_crc = self.block_size_data_crc[int(use_stx)]
         self.data_read = 0
-        with open(filepath, 'rb') as f:
+        ok = False
+        if data is not None: import io
+        with open(filepath, 'rb') if data is None else io.BytesIO(data) as f:
             while client.is_connected:
                 if (nbytes := f.readinto(self.block_data)):
                     construct_block(nbytes)
@@ -392,88 +1046,223 @@ class BluetoothFileTransfer:
                         elif self.notification_data == VALUE_IDLE:
                             print('File transmission finished.') # A short beep from the device.
                             print(f'File size: {self.data_size}.  Transmitted size: {self.data_read}.')
+                            ok = self.data_read == self.data_size
                         else:
                             print(f"Unexpected response: {self.notification_data}")
                     else: print("Error: CRC.")
                     break
             self.is_upload = False
+        return ok
 
-    async def run(self):
-        device = await self.discover_device(TARGET_NAME)
+    async def run(self, device=None):
+        if device is None:
+            device = await self.discover_device(TARGET_NAME)
+        elif isinstance(device, str): # Address; resolve it on our adapter.
+            device = await self.discover_device(TARGET_NAME, (device, ))
         if not device:
             return
 
-        async with BleakClient(device.address, timeout=60.0) as client:
-            if client.is_connected:
-                print(f"Connected to {device.name}")
-                ##print(f"MTU {client.mtu_size}")
-                self.mtu_size = client.mtu_size
+        if RIDE_INDEX and self.ride_index is None:
+            from xoss_archive import RideIndex
+            self.ride_index = RideIndex(RIDE_INDEX)
+        if ARCHIVE_DIR and self.archive is None:
+            from xoss_archive import Archive
+            self.archive = Archive(ARCHIVE_DIR, layout=STORAGE_LAYOUT, compression=ARCHIVE_COMPRESSION)
+        if CLAIMS_DB and self.claims is None:
+            from xoss_claims import Claims, open_store
+            self.claims = Claims(open_store(CLAIMS_DB))
+        self.device_id = device.address.replace(':', '')
+        if REFETCH_PLAN:
+            from xoss_archive import load_plan
+            plan = load_plan(REFETCH_PLAN)
+            self.refetch = set(plan.get(self.device_id, ())) | set(plan.get('', ()))
+
+        await self.link_policy.prepare()
+        try:
+            async with self.make_client(device) as client:
+                if client.is_connected:
+                    print(f"Connected to {device.name}")
+                    await self.set_link(client)
 
-                await self.start_notify(client, CTL_CHARACTERISTIC_UUID)
-                await self.start_notify(client, TX_CHARACTERISTIC_UUID)
-                print(f"Notifications started")
+                    await self.start_notify(client, CTL_CHARACTERISTIC_UUID)
+                    await self.start_notify(client, TX_CHARACTERISTIC_UUID)
+                    print(f"Notifications started")
 
-                #await self.time_set(client)
-                await self.read_diskspace(client)
+                    #await self.time_set(client)
+                    await self.read_diskspace(client)
 
-                ##await self.fetch_file(client, 'Setting.json')
-                ##await self.send_file(client, 'Setting.json')
-                ##return
+                    ##await self.fetch_file(client, 'Setting.json')
+                    ##await self.send_file(client, 'Setting.json')
+                    ##return
 
-                # The name of the list may be 'workouts.json' on new devices.
-                await self.fetch_file(client, 'filelist.txt')
-                fit_files = self.extract_fit_filenames('filelist.txt')
+                    # The name of the list may be 'workouts.json' on new devices.
+                    await self.fetch_file(client, 'filelist.txt', f'{self.list_prefix}filelist.txt')
+                    fit_files = self.extract_fit_filenames(f'{self.list_prefix}filelist.txt')
 
-                for fit_file in fit_files:
-                    if os.path.exists(fit_file):
-                        print(f'Skip: {fit_file}')
-                    else:
-                        print(f"Retrieving {fit_file}")
-                        await self.fetch_file(client, fit_file)
+                    post_processor = PostProcessor(self.post_hooks) if self.post_hooks else None
+                    fetches = []
+                    for fit_file in fit_files:
+                        if self.local_path(fit_file) and fit_file not in self.refetch:
+                            print(f'Skip: {fit_file}')
+                        else:
+                            fetches.append(fit_file)
+                    fetches = sorted(fetches)
+                    if (claims := self.claims) is not None:
+                        for fit_file in self.refetch & fit_files: # Done by a worker, but broken since.
+                            await claims.reopen(claims.key(self.device_id, fit_file)) # Unless claimed now.
+                        fetches = claims.filter(self.device_id, fetches) # Claimed one by one in the batch.
+                        keepalive = asyncio.create_task(claims.keepalive())
+                    overhead = []
+                    refetched = []
+                    try:
+                        async for fit_file, ok in self.transfer_batch(client, fetches=fetches):
+                            overhead.append(self.overhead)
+                            if ok and fit_file in self.refetch: refetched.append(fit_file)
+                            if claims is not None: await claims.release(claims.key(self.device_id, fit_file), ok)
+                            if self.progress: self.progress(device.address, fit_file, ok)
+                            if ok and post_processor: await post_processor.submit(self.local_path(fit_file))
+                    finally:
+                        if claims is not None:
+                            keepalive.cancel()
+                            await claims.release_all()
+                            if claims.skipped: print(f"Skipped {claims.skipped} rides claimed by other workers or done.")
+                        if refetched:
+                            from xoss_archive import done_plan
+                            done_plan(self.device_id, refetched, REFETCH_PLAN)
+                            print(f"Re-fetched {len(refetched)} rides of {REFETCH_PLAN}.")
+                    if overhead:
+                        print(f"Fetched {len(overhead)} files; overhead {sum(overhead) / len(overhead):.2f} s/file.")
+                    if post_processor: await post_processor.close()
+                    if self.archive is not None:
+                        print(f"Archive: {self.archive.stored} stored, {self.archive.deduplicated} deduplicated.")
+                    self.storage.sync() # Before deleting the rides on the device.
 
-                await client.stop_notify(CTL_CHARACTERISTIC_UUID)
-                await client.stop_notify(TX_CHARACTERISTIC_UUID)
-            else:
-                print(f"Failed to connect to {device.name}")
+                    if RETENTION_DAYS is not None and client.is_connected:
+                        await self.delete_files(client, self.select_for_deletion(fit_files))
+
+                    await client.stop_notify(CTL_CHARACTERISTIC_UUID)
+                    await client.stop_notify(TX_CHARACTERISTIC_UUID)
+                else:
+                    print(f"Failed to connect to {device.name}")
+        finally:
+            await self.link_policy.restore()
+
+    async def transfer_batch(self, client, fetches=(), sends=()):
+        '''Fetch (names, or an async iterable of them, e.g. Claims.filter; see fetch_file) and send files (paths or
+        (name, data)) in a batch; yields (name, ok) of each.
+        No delays after requests answered by the device; the next request is sent as soon as the device is IDLE.
+        '''
+        self.response_delay = 0
+        try:
+            async for filename in as_async(fetches):
+                print(f"Retrieving {filename}")
+                for retry in range(REFETCH_RETRIES + 1):
+                    if retry: print(f"Re-fetching {filename}")
+                    if (ok := await self.fetch_file(client, filename)) or not client.is_connected: break
+                yield filename, ok
+                if not client.is_connected: return
+            for x in sends:
+                filepath, data = x if isinstance(x, tuple) else (x, None)
+                yield filepath, await self.send_file(client, filepath, data)
+                if not client.is_connected: return
+        finally:
+            self.response_delay = RESPONSE_DELAY
+
+    def select_for_deletion(self, fit_files, keep_days=None, keep_last=None):
+        '''Rides to be deleted on the device; older than keep_days (by the timestamp in the name) except the newest
+        keep_last, and verified locally (size and CRC).  RETENTION_DAYS and RETENTION_KEEP at the time of the call
+        by default.
+        '''
+        import datetime
+        if keep_days is None: keep_days = RETENTION_DAYS
+        if keep_last is None: keep_last = RETENTION_KEEP
+        cutoff = (datetime.datetime.now() - datetime.timedelta(days=keep_days)).strftime('%Y%m%d%H%M%S')
+        names = sorted(x for x in fit_files if x[:14].isdigit())
+        selected = []
+        for fit_file in names[:max(0, len(names) - keep_last)]:
+            if fit_file[:14] >= cutoff:
+                break
+            if (path := self.local_path(fit_file)) is None:
+                continue
+            try:
+                check_fit_file(path)
+            except (ValueError, OSError) as e:
+                print(f"Keep {fit_file} on the device: {e}")
+                continue
+            selected.append(fit_file)
+        return selected
+
+    async def delete_files(self, client, filenames, dry_run=None):
+        '''Delete files on the device in a batch; returns the names deleted.  DELETE_DRY_RUN by default.
+        '''
+        if dry_run is None: dry_run = DELETE_DRY_RUN
+        if dry_run:
+            for filename in filenames:
+                print(f"Would delete: {filename}")
+            return []
+        deleted = []
+        if filenames and (self.notification_data == VALUE_IDLE or await self.get_idle_status(client)):
+            for filename in filenames:
+                if not client.is_connected: break
+                if await self.delete_file(client, filename): deleted.append(filename)
+        print(f"Deleted {len(deleted)} of {len(filenames)} files on the device.")
+        return deleted
+
+    async def delete_file(self, client, filename):
+        self.notification_data = AWAIT_NEW_DATA
+        self.is_download = self.is_upload = False
+        await self.send_cmd(client, CTL_CHARACTERISTIC_UUID, self.make_command(FILE_DELETE, filename), 0.1) # Request starts with 0x0d
+        await self.wait_until_data(client)
+        if self.notification_data == self.make_command(OK_FILE_DELETE, filename):                          # Response starts with 0x0e
+            return True
+        print(f"Failed to delete {filename}: {self.notification_data}")
+        return False
+
+    def local_path(self, fit_file):
+        # Path of the fetched file (in the archive or in the current directory), or None if not yet.
+        if self.archive is not None:
+            if (path := self.archive.path(self.device_id, fit_file)) is None:
+                return None
+            return self.archive.view(self.device_id, fit_file) or path # The hard link, if any, has the name.
+        return self.storage.existing(fit_file)
+
+    async def set_link(self, client):
+        self.link = await self.link_policy.apply(client)
+        self.mtu_size = self.link['mtu'] or self.mtu_size
+        if self.link['conn_interval_us']:
+            self.conn_interval = self.link['conn_interval_us'] / 1_000_000
+        self.use_stx = self.link['stx']
+        print(f"Link: interval {self.link['conn_interval_us']} us, MTU {self.mtu_size}, "
+            f"data length {self.link['data_length']}, {'STX' if self.use_stx else 'SOH'}")
 
     def extract_fit_filenames(self, file_path):
         '''The list should be either a plain text (e.g. filelist.txt) or a JSON file.
         '''
-        fit_files = set()
-
         try:
             with open(file_path, 'r') as file:
-                if not file_path.endswith(('.json','.JSON')):
-                    pattern = re.compile(r'\d{14}\.fit')
-                    lines = file.readlines()
-                    for line in lines:
-                        match = pattern.search(line)
-                        if match:
-                            fit_files.add(match.group(0))
-                else:
-                    import json
-                    json_dict = json.load(file)
-                    for x in json_dict['workouts']:
-                        fit_files.add(f'{x[0]}.fit')
+                return self.parse_fit_filenames(file.read(), file_path.endswith(('.json','.JSON')))
         except Exception as e:
             print(f"Failed to read/parse file: {e}")
+        return set()
 
-        return fit_files
-
-    def save_file_raw(self, filename):
-        mv_file_data = memoryview(self.data)
-        i = -1
-        while self.data[i] == 0x00: # Remove padded zeros at the end.
-            i -= 1
-
-        with open(filename, "wb") as file:
-            size = file.write(mv_file_data[:i+1] if i < -1 else self.data)
-        if size != self.data_size:
-            print(f"Error: {size}(file size) != {self.data_size}(spec)")
+    def parse_fit_filenames(self, text, is_json=False):
+        fit_files = set()
+        if not is_json:
+            import re
+            pattern = re.compile(r'\d{14}\.fit')
+            for line in text.splitlines():
+                match = pattern.search(line)
+                if match:
+                    fit_files.add(match.group(0))
         else:
-            print(f"Successfully wrote combined data to {filename}")
+            import json
+            json_dict = json.loads(text)
+            for x in json_dict['workouts']:
+                fit_files.add(f'{x[0]}.fit')
+        return fit_files
 
-    def crc8_xor(self, data):
+    @staticmethod
+    def crc8_xor(data):
         '''crc8/xor
         See make_command() how to use.
         '''
@@ -482,19 +1271,11 @@ class BluetoothFileTransfer:
             crc ^= x
         return crc & 0xff
 
-    def crc16_arc(self, data):
+    def crc16_arc(self, data, crc=0):
         '''crc16/arc
         XOSS uses CRC16/ARC instead of CRC16/XMODEM.
         '''
-        crc = 0
-        for x in data:
-            crc ^= x
-            for _ in range(8):
-                if (crc & 0x0001) > 0:
-                    crc = (crc >> 1) ^ 0xa001
-                else:
-                    crc = crc >> 1
-        return crc & 0xffff
+        return crc16_arc(data, crc)
 
     def make_command(self, cmd, string=None):
         byte_array = cmd + bytearray(string.encode('utf-8') if string is not None else b'\x00') + bytearray([0x00])